@@ -0,0 +1,209 @@
+# Per-request database profiler. Enable it with the DB_PROFILER setting (on
+# by default in DEBUG mode). Every database operation made while serving a
+# request is recorded, and responses get a summary header such as
+#
+#   X-Rev-DB: 42 queries / 180ms
+#
+# Queries with the same shape that are issued repeatedly from the same line
+# of code (usually a loop that should have been a single query) are flagged
+# as likely N+1 query patterns. The reports for recent requests are served
+# as JSON from /_rev/db_profiles
+
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import g, request, Response, current_app, abort
+from flask.ext.classy import FlaskView, route
+
+from rev.app.instrumentation import DBListener
+from rev.db.criteria import get_criteria_shape
+from rev.db.state import get_state, get_call_site
+
+class RequestProfile():
+    """
+    The database operations made while serving one request
+    """
+    def __init__(self, profile_id, method, path):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.operations = []  # List of operation dictionaries
+        self.n_plus_one = []
+
+    def add_operation(self, provider, model, operation, criteria, duration, error, call_site):
+        entry = {
+            'database' : provider.name,
+            'model' : model._name,
+            'operation' : operation,
+            'criteria' : get_criteria_shape(criteria) if criteria is not None else None,
+            'duration_ms' : round(duration * 1000, 3),
+            'rows' : 0,
+            'error' : str(error) if error is not None else None,
+            'call_site' : '{}:{} ({})'.format(*call_site) if call_site else None,
+        }
+        self.operations.append(entry)
+        return entry
+
+    def get_db_time(self):
+        return sum(op['duration_ms'] for op in self.operations)
+
+    def finish(self, status, n_plus_one_threshold):
+        """
+        Record the end of the request and find repeated queries
+        """
+        self.duration = time.perf_counter() - self.start
+        self.status = status
+        groups = {}  # Dictionary of (model, operation, criteria shape, call site) => [operations]
+        for op in self.operations:
+            key = (op['database'], op['model'], op['operation'],
+                   json.dumps(op['criteria'], sort_keys=True, default=str), op['call_site'])
+            groups.setdefault(key, []).append(op)
+        self.n_plus_one = []
+        for (database, model, operation, criteria, call_site), ops in groups.items():
+            if len(ops) >= n_plus_one_threshold:
+                self.n_plus_one.append({
+                    'database' : database,
+                    'model' : model,
+                    'operation' : operation,
+                    'criteria' : ops[0]['criteria'],
+                    'call_site' : call_site,
+                    'count' : len(ops),
+                    'duration_ms' : round(sum(op['duration_ms'] for op in ops), 3),
+                })
+        self.n_plus_one.sort(key=lambda pattern: -pattern['count'])
+
+    def get_summary(self):
+        summary = '{} queries / {}ms'.format(len(self.operations), int(round(self.get_db_time())))
+        if self.n_plus_one:
+            summary += ', {} N+1 patterns'.format(len(self.n_plus_one))
+        return summary
+
+    def to_dict(self):
+        return {
+            'id' : self.id,
+            'method' : self.method,
+            'path' : self.path,
+            'status' : self.status,
+            'duration_ms' : round(self.duration * 1000, 3) if self.duration is not None else None,
+            'query_count' : len(self.operations),
+            'db_time_ms' : round(self.get_db_time(), 3),
+            'n_plus_one' : self.n_plus_one,
+            'operations' : self.operations,
+        }
+
+class DBProfiler(DBListener):
+    """
+    Records the database operations of each request. Settings:
+
+     - DB_PROFILER_N_PLUS_ONE: how many times a query must be repeated from
+       the same call site to be flagged (default 3)
+     - DB_PROFILER_HISTORY: the number of request reports kept (default 50)
+     - DB_PROFILER_REPORT_HEADER: add an X-Rev-DB-Report header with the
+       URL of the request's JSON report (default False)
+    """
+
+    def __init__(self, app):
+        self.n_plus_one_threshold = app.config.get('DB_PROFILER_N_PLUS_ONE', 3)
+        self.report_header = app.config.get('DB_PROFILER_REPORT_HEADER', False)
+        self.profiles = deque(maxlen=app.config.get('DB_PROFILER_HISTORY', 50))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def register(self, app):
+        """
+        Register the request hooks and the report endpoints
+        """
+        app.before_request(self.begin_request)
+        app.after_request(self.end_request)
+        app.teardown_request(self.discard_request)
+        DBProfilerEndpoint.register(app)
+
+    def on_db_operation(self, provider, model, operation, criteria, duration, error):
+        # get_state() also returns the request's profile in the threads that
+        # run its async operations
+        profile = getattr(get_state(), '_rev_db_profile', None)
+        if profile is None:
+            return None
+        entry = profile.add_operation(provider, model, operation, criteria, duration, error, get_call_site())
+        if error is None and operation == 'find':
+            # Most databases run the query when the first records are read,
+            # so add the time spent reading them
+            def count_rows(count, duration):
+                entry['rows'] += count
+                entry['duration_ms'] = round(entry['duration_ms'] + duration * 1000, 3)
+            return count_rows
+
+    def begin_request(self):
+        if request.path.startswith('/_rev/'):
+            return
+        g._rev_db_profile = RequestProfile(str(next(self._ids)), request.method, request.full_path.rstrip('?'))
+
+    def end_request(self, response):
+        profile = getattr(g, '_rev_db_profile', None)
+        if profile is None:
+            return response
+        g._rev_db_profile = None
+        profile.finish(response.status_code, self.n_plus_one_threshold)
+        with self._lock:
+            self.profiles.append(profile)
+
+        response.headers['X-Rev-DB'] = profile.get_summary()
+        if self.report_header:
+            response.headers['X-Rev-DB-Report'] = '/_rev/db_profiles/' + profile.id
+        for pattern in profile.n_plus_one:
+            logging.warning("Possible N+1 query in {} {}: {} {}() on model '{}' with criteria {} from {}".format(
+                profile.method, profile.path, pattern['count'], pattern['operation'], pattern['model'],
+                json.dumps(pattern['criteria'], default=str), pattern['call_site']))
+        return response
+
+    def discard_request(self, exception=None):
+        # Only still set if the request ended with an exception
+        g._rev_db_profile = None
+
+    def get_profile(self, profile_id):
+        with self._lock:
+            for profile in self.profiles:
+                if profile.id == profile_id:
+                    return profile
+        return None
+
+    def get_profiles(self):
+        with self._lock:
+            return list(self.profiles)
+
+class DBProfilerEndpoint(FlaskView):
+    route_base = '/'
+
+    @route('/_rev/db_profiles')
+    def db_profiles(self):
+        """
+        Returns a summary of the most recent requests, newest first
+        """
+        res = []
+        for profile in reversed(current_app.db_profiler.get_profiles()):
+            res.append({
+                'id' : profile.id,
+                'method' : profile.method,
+                'path' : profile.path,
+                'status' : profile.status,
+                'summary' : profile.get_summary(),
+                'url' : '/_rev/db_profiles/' + profile.id,
+            })
+        return Response(json.dumps(res, indent=2), mimetype='application/json')
+
+    @route('/_rev/db_profiles/<profile_id>')
+    def db_profile(self, profile_id):
+        """
+        Returns the report for one request
+        """
+        profile = current_app.db_profiler.get_profile(profile_id)
+        if profile is None:
+            abort(404)
+        return Response(json.dumps(profile.to_dict(), indent=2, default=str), mimetype='application/json')
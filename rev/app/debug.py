@@ -0,0 +1,53 @@
+
+# HTTP endpoints that expose debugging information. Only registered when the
+# app is running in DEBUG mode
+
+import json
+import threading
+import time
+
+from flask import Response, current_app, request, abort
+from flask.ext.classy import FlaskView, route
+
+from rev.app.profiler import SamplingProfiler
+
+MAX_PROFILE_SECONDS = 60
+
+class DebugEndpoint(FlaskView):
+    route_base = '/'
+    
+    @route('/_rev/slow_queries')
+    def slow_queries(self):
+        """
+        Returns the most recent slow queries logged by each database provider
+        """
+        res = {}
+        for db_name, provider in current_app.databases.items():
+            slow_queries = getattr(provider, 'slow_queries', None)
+            if slow_queries is not None:
+                res[db_name] = list(slow_queries)
+        return Response(json.dumps(res, indent=2, default=str), mimetype='application/json')
+
+    @route('/_rev/profile')
+    def profile(self):
+        """
+        Samples the stacks of all other threads for 'seconds' (default 10),
+        every 'interval' milliseconds (default 5), and returns them in the
+        collapsed stack format
+        
+        This request waits while sampling, so the server must handle other
+        requests at the same time, e.g. with threaded=True as in runserver
+        """
+        try:
+            seconds = float(request.args.get('seconds', 10))
+            interval = float(request.args.get('interval', 5))
+        except ValueError:
+            abort(400)
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or interval <= 0:
+            abort(400)
+        
+        # Leave out this request's thread, which is only waiting
+        profiler = SamplingProfiler(interval / 1000.0, exclude_thread_ids=[threading.get_ident()])
+        with profiler:
+            time.sleep(seconds)
+        return Response(profiler.get_collapsed(), mimetype='text/plain')
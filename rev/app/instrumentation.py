@@ -0,0 +1,116 @@
+# Wrapper for DatabaseProviders that reports each operation to listeners,
+# such as the metrics registry and the per-request database profiler.
+# Providers are only wrapped when a listener is enabled
+
+import time
+import weakref
+
+INSTRUMENTED_OPERATIONS = ['find', 'create', 'update', 'delete', 'aggregate', 'bulk_write',
+                           'create_many', 'update_many', 'delete_many', 'upsert_many']
+
+# Operations whose first argument after the model is the criteria
+CRITERIA_OPERATIONS = ['find', 'update', 'delete', 'aggregate']
+
+class DBListener():
+    """
+    Base class for listeners added to an InstrumentedProvider
+    """
+
+    def on_db_operation(self, provider, model, operation, criteria, duration, error):
+        """
+        Called after each operation, with its criteria (or None) and its
+        duration in seconds. 'error' is the exception raised, if any.
+
+        For find(), the duration only covers creating the result. Most
+        databases run the query when the first records are read, so the
+        listener may return a function that is called with the number of
+        records and the seconds taken for each block read from the result.
+        It is also called with (0, 0.0) when the result is discarded, so
+        results that were never read are still reported. For count_only
+        finds, it is called once with (0, 0.0)
+        """
+        return None
+
+class InstrumentedProvider():
+    """
+    Wraps a DatabaseProvider to report each operation to its listeners.
+    All other attributes are passed through to the provider
+    """
+
+    def __init__(self, provider, listeners=()):
+        self._provider = provider
+        self._listeners = list(listeners)
+
+    def __getattr__(self, name):
+        return getattr(self._provider, name)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _observe(self, operation, model, criteria, func, *args, **kwargs):
+        """
+        Call func, reporting it as 'operation' on 'model'
+        """
+        start = time.perf_counter()
+        try:
+            res = func(*args, **kwargs)
+        except Exception as e:
+            self._notify(operation, model, criteria, time.perf_counter() - start, e)
+            raise
+        fetch_observers = self._notify(operation, model, criteria, time.perf_counter() - start, None)
+        if fetch_observers and operation == 'find':
+            if isinstance(res, int):
+                # Counts are complete when they are returned
+                for observer in fetch_observers:
+                    observer(0, 0.0)
+            else:
+                if len(fetch_observers) == 1:
+                    res._fetch_observer = fetch_observers[0]
+                else:
+                    res._fetch_observer = lambda count, duration: [observer(count, duration) for observer in fetch_observers]
+                weakref.finalize(res, res._fetch_observer, 0, 0.0)
+        return res
+
+    def _notify(self, operation, model, criteria, duration, error):
+        fetch_observers = []
+        for listener in self._listeners:
+            observer = listener.on_db_operation(self._provider, model, operation, criteria, duration, error)
+            if observer is not None:
+                fetch_observers.append(observer)
+        return fetch_observers
+
+    def prepare_query(self, model, criteria, read_fields='*', order_by=None):
+        db_query = self._provider.prepare_query(model, criteria, read_fields, order_by)
+        if db_query is None:
+            return None
+        return InstrumentedPreparedQuery(self, model, criteria, db_query)
+
+def _instrument(operation):
+    def method(self, model, *args, **kwargs):
+        criteria = None
+        if operation in CRITERIA_OPERATIONS:
+            criteria = args[0] if args else kwargs.get('criteria', {})
+        return self._observe(operation, model, criteria, getattr(self._provider, operation), model, *args, **kwargs)
+    method.__name__ = operation
+    return method
+
+for _operation in INSTRUMENTED_OPERATIONS:
+    setattr(InstrumentedProvider, _operation, _instrument(_operation))
+
+class InstrumentedPreparedQuery():
+    """
+    Wraps a provider's prepared query, reporting its operations like
+    InstrumentedProvider. The criteria reported are the query's template
+    """
+
+    def __init__(self, instrumented_provider, model, criteria, db_query):
+        self._instrumented_provider = instrumented_provider
+        self._model = model
+        self._criteria = criteria
+        self._db_query = db_query
+
+    def find(self, *args, **kwargs):
+        return self._instrumented_provider._observe('find', self._model, self._criteria, self._db_query.find, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._instrumented_provider._observe('update', self._model, self._criteria, self._db_query.update, *args, **kwargs)
@@ -0,0 +1,243 @@
+# Lightweight metrics for RevApps. Enable them with the METRICS_ENABLED
+# setting. Database calls are then timed per model and operation, and all
+# metrics are served in Prometheus text format at /_rev/metrics
+
+import threading
+from bisect import bisect_left
+
+from flask import Response, current_app
+from flask.ext.classy import FlaskView, route
+
+from rev.app.instrumentation import DBListener
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Metric():
+    """
+    Base class for metrics. Each thread updates its own shard of the
+    values, so recording a value never takes a lock. The shards are
+    combined when the metrics are read
+    """
+    type_name = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        shard = self._local.shard = {}  # Dictionary of label values => value
+        with self._lock:
+            self._shards.append(shard)
+        return shard
+
+    def _get_shard_items(self):
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for labels, value in list(shard.items()):
+                yield labels, value
+
+    def get_values(self):
+        raise NotImplementedError()
+
+    def render(self):
+        raise NotImplementedError()
+
+    def _get_label_str(self, labels, extra=()):
+        pairs = list(zip(self.label_names, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape_label_value(value)) for name, value in pairs) + '}'
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. the number of records read
+    """
+    type_name = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def get_values(self):
+        """
+        Returns a dictionary of label values => total
+        """
+        totals = {}
+        for labels, value in self._get_shard_items():
+            totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self):
+        return ['{}{} {}'.format(self.name, self._get_label_str(labels), _format_value(value))
+                    for labels, value in sorted(self.get_values().items())]
+
+class Histogram(Metric):
+    """
+    Counts observed values (e.g. durations in seconds) in fixed buckets
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket, one for values above the last bucket, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def get_values(self):
+        """
+        Returns a dictionary of label values => (bucket counts, sum). The
+        last bucket count is for values above the highest bucket
+        """
+        totals = {}
+        for labels, counts in self._get_shard_items():
+            total = totals.get(labels)
+            if total is None:
+                totals[labels] = list(counts)
+            else:
+                for idx, count in enumerate(counts):
+                    total[idx] += count
+        return dict((labels, (counts[:-1], counts[-1])) for labels, counts in totals.items())
+
+    def render(self):
+        lines = []
+        for labels, (counts, total) in sorted(self.get_values().items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name,
+                    self._get_label_str(labels, [('le', _format_value(bucket))]), cumulative))
+            label_str = self._get_label_str(labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_str, _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, label_str, cumulative))
+        return lines
+
+class MetricsRegistry():
+    """
+    Holds the metrics of a RevApp
+    """
+
+    def __init__(self):
+        self.metrics = {}  # Dictionary of name => Metric
+        self._lock = threading.Lock()
+
+    def _get_metric(self, metric_class, name, description, label_names, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, description, label_names, **kwargs)
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+                raise Exception("Metric '{}' is already registered with a different type or labels".format(name))
+        return metric
+
+    def counter(self, name, description, label_names=()):
+        """
+        Returns the Counter called 'name', creating it if needed
+        """
+        return self._get_metric(Counter, name, description, label_names)
+
+    def histogram(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        """
+        Returns the Histogram called 'name', creating it if needed
+        """
+        return self._get_metric(Histogram, name, description, label_names, buckets=buckets)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text format
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.description.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(name, metric.type_name))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+class DBMetrics(DBListener):
+    """
+    Records the duration and errors of each database operation, per model,
+    and the number of records read.
+
+    The duration of a find() covers creating the result and fetching its
+    first block of records, which is when most databases run the query. It
+    is recorded when that block is fetched, or when the result is discarded
+    if no block was fetched (e.g. it was only counted or indexed). The time
+    spent fetching all blocks is also added to rev_db_fetch_seconds_total
+    """
+
+    def __init__(self, metrics, buckets=DEFAULT_BUCKETS):
+        self._durations = metrics.histogram('rev_db_operation_duration_seconds',
+            'Duration of database operations', ['database', 'model', 'operation'], buckets)
+        self._errors = metrics.counter('rev_db_operation_errors_total',
+            'Database operations that raised an exception', ['database', 'model', 'operation'])
+        self._records = metrics.counter('rev_db_records_read_total',
+            'Records read from find() results', ['database', 'model'])
+        self._fetch_time = metrics.counter('rev_db_fetch_seconds_total',
+            'Time spent reading records from find() results', ['database', 'model'])
+
+    def on_db_operation(self, provider, model, operation, criteria, duration, error):
+        labels = (provider.name, model._name, operation)
+        if operation == 'find' and error is None:
+            return FindObserver(self, labels, duration)
+        self._durations.observe(duration, labels)
+        if error is not None:
+            self._errors.inc(labels)
+
+class FindObserver():
+    """
+    Records a find() operation when its first block of records is fetched,
+    or when the result is discarded
+    """
+    __slots__ = ('metrics', 'labels', 'duration')
+
+    def __init__(self, metrics, labels, duration):
+        self.metrics = metrics
+        self.labels = labels
+        self.duration = duration  # Set to None once the find() is recorded
+
+    def __call__(self, count, duration):
+        metrics = self.metrics
+        if self.duration is not None:
+            metrics._durations.observe(self.duration + duration, self.labels)
+            self.duration = None
+        if count:
+            metrics._records.inc(self.labels[:2], count)
+        if duration:
+            metrics._fetch_time.inc(self.labels[:2], duration)
+
+class MetricsEndpoint(FlaskView):
+    route_base = '/'
+
+    @route('/_rev/metrics')
+    def metrics(self):
+        """
+        Returns the app's metrics in the Prometheus text format
+        """
+        return Response(current_app.metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
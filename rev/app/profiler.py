@@ -0,0 +1,104 @@
+# Statistical CPU profiler. A background thread samples the stacks of the
+# profiled threads at a fixed interval, so the profiled code runs at close
+# to full speed (unlike deterministic profilers such as cProfile, which add
+# overhead to every function call). Results are written in the collapsed
+# stack format read by flamegraph tools:
+#
+#   thread;outer_func (file.py:10);inner_func (file.py:42) 17
+
+import sys
+import threading
+import time
+
+class SamplingProfiler():
+    """
+    Samples the stacks of running threads. Use it via:
+
+        with SamplingProfiler(interval=0.005) as profiler:
+            ...
+        profiler.write_collapsed('app.collapsed')
+
+    By default all threads except the sampler's own are sampled. Pass
+    'thread_ids' to only sample specific threads, or 'exclude_thread_ids'
+    to leave some out.
+    """
+
+    def __init__(self, interval=0.005, thread_ids=None, exclude_thread_ids=(), include_thread_names=True):
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.exclude_thread_ids = set(exclude_thread_ids)
+        self.include_thread_names = include_thread_names
+        self.samples = {}  # Dictionary of stack tuple => count
+        self.sample_count = 0
+        self.duration = 0
+        self._labels = {}  # Dictionary of code object => frame label
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def start(self):
+        if self._thread is not None:
+            raise Exception('The profiler is already running')
+        self._stop.clear()
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='rev-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.duration += time.perf_counter() - self._start_time
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        exclude_ids = self.exclude_thread_ids | {threading.get_ident()}
+        while not self._stop.wait(self.interval):
+            self.sample(exclude_ids)
+
+    def _get_label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+        return label
+
+    def sample(self, exclude_ids=()):
+        """
+        Record the current stack of each profiled thread
+        """
+        thread_names = None
+        if self.include_thread_names:
+            thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in exclude_ids or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._get_label(frame.f_code))
+                frame = frame.f_back
+            if thread_names is not None:
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+            stack = tuple(reversed(stack))
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+        self.sample_count += 1
+
+    def get_collapsed(self):
+        """
+        Returns the samples in the collapsed stack format, one stack per line
+        """
+        lines = []
+        for stack, count in sorted(self.samples.items()):
+            lines.append('{} {}'.format(';'.join(frame.replace(';', ':') for frame in stack), count))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as collapsed_file:
+            collapsed_file.write(self.get_collapsed())
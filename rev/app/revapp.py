@@ -3,14 +3,21 @@ from flask import Flask
 from werkzeug.contrib.cache import SimpleCache
 from jinja2 import FileSystemLoader, ChoiceLoader
 
+import atexit
 import logging
 import importlib
 import sys
 
 from rev import PKG_NAME, PKG_VERSION
 from rev.db.registry import ModelRegistry
+from rev.db.indexes import IndexAdvisor
+from rev.db import unitofwork
 from rev.modules import Module
 from rev.modules.staticfiles import StaticFiles, StaticFilesEndpoint
+from rev.app.debug import DebugEndpoint
+from rev.app.metrics import MetricsRegistry, MetricsEndpoint, DBMetrics, DEFAULT_BUCKETS
+from rev.app.dbprofiler import DBProfiler
+from rev.app.instrumentation import InstrumentedProvider
 
 # Main RevFramework Application object
 
@@ -29,6 +36,9 @@ class RevApp(Flask):
 
         # Initialise instance variables
         self.registry = None
+        self.index_advisor = None
+        self.metrics = None
+        self.db_profiler = None
         self.staticfiles = None
         self.template_paths = []
         self.module_info = {}
@@ -63,6 +73,15 @@ class RevApp(Flask):
         if not syncdb or syncdb == 'auto':
             logging.info("Starting Rev App '{}' ...".format(self.name))
         
+        # initialise metrics and database profiler
+        db_listeners = []
+        if self.config.get('METRICS_ENABLED', False):
+            self.metrics = MetricsRegistry()
+            db_listeners.append(DBMetrics(self.metrics, self.config.get('METRICS_BUCKETS', DEFAULT_BUCKETS)))
+        if self.config.get('DB_PROFILER', self.debug):
+            self.db_profiler = DBProfiler(self)
+            db_listeners.append(self.db_profiler)
+        
         # initialise database providers
         self.databases = {}
         for db_name in self.config['DATABASES'].keys():
@@ -70,6 +89,13 @@ class RevApp(Flask):
             prov_module = importlib.import_module(provider_conf['provider'])
             prov_class = getattr(prov_module, 'DatabaseProvider')
             self.databases[db_name] = prov_class(provider_conf, db_name)
+            if db_listeners:
+                self.databases[db_name] = InstrumentedProvider(self.databases[db_name], db_listeners)
+        atexit.register(self.shutdown)
+        
+        # initialise unindexed query advisor
+        if self.config.get('DB_INDEX_ADVISOR', self.debug):
+            self.index_advisor = IndexAdvisor()
         
         # initialise model registry
         self.registry = ModelRegistry(self)
@@ -173,6 +199,25 @@ class RevApp(Flask):
             self.staticfiles = StaticFiles(self)
             StaticFilesEndpoint.register(self)
             
+            # profile each request's database operations. Registered first,
+            # so the after_request hook sees the unit of work being written
+            if self.db_profiler is not None:
+                self.db_profiler.register(self)
+            
+            # write each request's database changes in one unit of work
+            if self.config.get('DB_REQUEST_UNIT_OF_WORK', False):
+                self.before_request(unitofwork.begin_request_unit_of_work)
+                self.after_request(unitofwork.end_request_unit_of_work)
+                self.teardown_request(unitofwork.discard_request_unit_of_work)
+            
+            # register metrics endpoint
+            if self.metrics is not None:
+                MetricsEndpoint.register(self)
+            
+            # register debugging endpoints
+            if self.debug:
+                DebugEndpoint.register(self)
+            
             # configure jinja template paths
             template_loaders = [self.jinja_loader]
             for template_path in self.template_paths:
@@ -191,3 +236,10 @@ class RevApp(Flask):
                 logging.debug('  '+rule.rule+' => '+rule.endpoint)
 
             logging.info("Rev App '{}' Initialised.".format(self.name))
+
+    def shutdown(self):
+        """
+        Stop the database providers' async thread pools
+        """
+        for provider in self.databases.values():
+            provider.shutdown_executor()
@@ -12,6 +12,8 @@ def register_command(command, description, parser, command_class):
 
 from .runserver import RunServerArgParser, RunServerCommand
 from .syncdb import SyncDBArgParser, SyncDBCommand
+from .profile import ProfileArgParser, ProfileCommand
 
 register_command('runserver', 'starts the rev framework test server', RunServerArgParser, RunServerCommand)
-register_command('syncdb', 'synchronise application data with the database', SyncDBArgParser, SyncDBCommand)
\ No newline at end of file
+register_command('syncdb', 'synchronise application data with the database', SyncDBArgParser, SyncDBCommand)
+register_command('profile', 'replay requests under a sampling profiler', ProfileArgParser, ProfileCommand)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import argparse
+import json
+from .args import BaseArgParser, BaseCommand
+
+class ProfileArgParser(BaseArgParser):
+
+    def __init__(self, app, **kwargs):
+
+        super().__init__(
+                usage='%(prog)s profile REQUESTS_FILE [options]',
+                **kwargs)
+
+        self.description += '\n\n  profile - Replays a list of requests under a sampling profiler'
+        self.description += '\n\n  REQUESTS_FILE is a JSON list of requests, e.g.'
+        self.description += '\n    [{"method": "GET", "path": "/orders?page=2", "headers": {"Cookie": "..."}},'
+        self.description += '\n     {"method": "POST", "path": "/orders", "json": {"item": "abc"}}]'
+        self.description += '\n  or a text file with one "METHOD /path" per line'
+
+        self.add_argument('command', help=argparse.SUPPRESS)
+
+        self.add_argument('requests_file',
+                          type=str,
+                          help='The file of requests to replay')
+
+        self.add_argument('--output',
+                          type=str,
+                          default='profile.collapsed',
+                          help='The file to write the collapsed stacks to (default: profile.collapsed)')
+
+        self.add_argument('--interval',
+                          type=float,
+                          default=5,
+                          help='The sampling interval in milliseconds (default: 5)')
+
+        self.add_argument('--repeat',
+                          type=int,
+                          default=1,
+                          help='The number of times to replay the requests (default: 1)')
+
+        self.add_argument('--warmup',
+                          type=int,
+                          default=1,
+                          help='The number of times to replay the requests before profiling (default: 1)')
+
+        self.add_argument('--no-syncdb',
+                          default=False,
+                          action='store_true',
+                          help='Disables automatic reloading of module data on application load')
+
+import logging
+import threading
+import time
+
+from rev.app.profiler import SamplingProfiler
+
+def load_requests(path):
+    """
+    Returns a list of request dictionaries from a JSON or text requests file
+    """
+    with open(path) as requests_file:
+        content = requests_file.read()
+    if content.lstrip().startswith('['):
+        requests = json.loads(content)
+    else:
+        requests = []
+        for line in content.splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                method, path = line.split(None, 1)
+                requests.append({'method' : method, 'path' : path})
+    for req in requests:
+        if 'path' not in req:
+            raise Exception("Request {} does not have a 'path'".format(req))
+    return requests
+
+def replay_requests(client, requests):
+    """
+    Sends the requests through a Flask test client. Returns the number of
+    responses with an error status
+    """
+    errors = 0
+    for req in requests:
+        kwargs = {
+            'method' : req.get('method', 'GET').upper(),
+            'headers' : req.get('headers', {}),
+        }
+        if 'json' in req:
+            kwargs['data'] = json.dumps(req['json'])
+            kwargs['content_type'] = 'application/json'
+        elif 'data' in req:
+            kwargs['data'] = req['data']
+        response = client.open(req['path'], **kwargs)
+        if response.status_code >= 400:
+            errors += 1
+        response.close()
+    return errors
+
+class ProfileCommand(BaseCommand):
+    def run(self, app, args, **kwargs):
+
+        app.init(syncdb=False if args.no_syncdb else 'auto')
+
+        requests = load_requests(args.requests_file)
+        client = app.test_client()
+
+        for i in range(args.warmup):
+            replay_requests(client, requests)
+
+        logging.info('Profiling {} request(s) x {}...'.format(len(requests), args.repeat))
+        errors = 0
+        profiler = SamplingProfiler(args.interval / 1000.0, thread_ids=[threading.get_ident()], include_thread_names=False)
+        start = time.perf_counter()
+        with profiler:
+            for i in range(args.repeat):
+                errors += replay_requests(client, requests)
+        elapsed = time.perf_counter() - start
+
+        if errors:
+            logging.warning('{} response(s) had an error status'.format(errors))
+        profiler.write_collapsed(args.output)
+        logging.info('{} requests in {:.2f}s ({:.1f} requests/s). {} samples written to {}'.format(
+            len(requests) * args.repeat, elapsed, len(requests) * args.repeat / elapsed if elapsed else 0,
+            profiler.sample_count, args.output))
@@ -72,10 +72,12 @@ class RunServerCommand(BaseCommand):
                         if filename[-4:].lower() == '.xml':
                             files_to_monitor.append(os.path.join(root, filename))
         
-        # Launch debug server
+        # Launch debug server. Threaded, so the /_rev/profile endpoint can
+        # sample other requests while it waits
         app.run(
             host=args.ip_address,
             port=args.port,
             use_reloader=reload,
             extra_files=files_to_monitor,
-            debug=True)
\ No newline at end of file
+            debug=True,
+            threaded=True)
\ No newline at end of file
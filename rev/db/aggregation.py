@@ -0,0 +1,78 @@
+
+from rev.db.exceptions import ValidationError
+
+AGGREGATE_FUNCTIONS = ['count', 'sum', 'avg', 'min', 'max']
+
+def get_aggregate_metrics(model, group_by, metrics):
+    """
+    Validates aggregate() arguments and returns the metrics as a dictionary
+    of metric_name => (function, field_name). 'count' metrics can be given
+    as just 'count' and have a field_name of None.
+    """
+    for field_name in group_by:
+        if field_name != 'id' and field_name not in model._fields:
+            raise ValidationError("Cannot group by '{}'. Model '{}' has no such field.".format(field_name, model._name))
+    
+    res = {}
+    for metric_name, metric in metrics.items():
+        if metric_name in group_by or metric_name[:1] == '$' or '.' in metric_name or metric_name == '_id':
+            raise ValidationError("Invalid aggregate metric name '{}'".format(metric_name))
+        if isinstance(metric, str):
+            metric = (metric,)
+        func = metric[0]
+        field_name = metric[1] if len(metric) > 1 else None
+        if func not in AGGREGATE_FUNCTIONS:
+            raise ValidationError("Invalid aggregate function '{}'. Valid options are: {}".format(func, ', '.join(AGGREGATE_FUNCTIONS)))
+        if func != 'count' and (field_name is None or field_name not in model._fields):
+            raise ValidationError("Aggregate function '{}' for '{}' requires a valid field of model '{}'".format(func, metric_name, model._name))
+        res[metric_name] = (func, field_name)
+    return res
+
+def aggregate_records(records, group_by, metrics):
+    """
+    Pure python implementation of aggregate() for providers that hold their
+    records in memory. 'records' is an iterable of record dictionaries.
+    Values of None are ignored by all functions except 'count'.
+    """
+    groups = {}
+    group_order = []
+    for record in records:
+        group_key = tuple(_hashable(record.get(field_name)) for field_name in group_by)
+        if group_key not in groups:
+            group_order.append(group_key)
+            groups[group_key] = {
+                'group' : dict((field_name, record.get(field_name)) for field_name in group_by),
+                'count' : 0,
+                'values' : dict((metric_name, []) for metric_name in metrics),
+            }
+        group = groups[group_key]
+        group['count'] += 1
+        for metric_name, (func, field_name) in metrics.items():
+            if func != 'count' and record.get(field_name) is not None:
+                group['values'][metric_name].append(record[field_name])
+    
+    res = []
+    for group_key in group_order:
+        group = groups[group_key]
+        row = dict(group['group'])
+        for metric_name, (func, field_name) in metrics.items():
+            values = group['values'][metric_name]
+            if func == 'count':
+                row[metric_name] = group['count']
+            elif func == 'sum':
+                row[metric_name] = sum(values)
+            elif func == 'avg':
+                row[metric_name] = sum(values) / len(values) if values else None
+            elif func == 'min':
+                row[metric_name] = min(values) if values else None
+            elif func == 'max':
+                row[metric_name] = max(values) if values else None
+        res.append(row)
+    return res
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((key, _hashable(val)) for key, val in value.items()))
+    return value
@@ -0,0 +1,97 @@
+
+from array import array
+
+from rev.db import fields
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array typecodes for fields that can be stored in typed arrays
+ARRAY_TYPECODES = {
+    fields.IntegerField : 'q',
+    fields.FloatField : 'd',
+    fields.BooleanField : 'b',
+}
+
+NUMPY_DTYPES = {
+    'q' : 'int64',
+    'd' : 'float64',
+    'b' : 'bool',
+}
+
+class Column():
+    """
+    Accumulates the values of one field. Values of IntegerFields,
+    FloatFields and BooleanFields are held in typed arrays; other values are
+    held in a list.
+
+    Missing (None) values are stored as NaN in float columns, and convert
+    integer columns to float columns. Values that do not fit the column
+    type (including None in a boolean column) convert it to a list.
+    """
+    def __init__(self, field=None):
+        self.field = field
+        self.typecode = None
+        for field_class, typecode in ARRAY_TYPECODES.items():
+            if isinstance(field, field_class):
+                self.typecode = typecode
+        self.values = array(self.typecode) if self.typecode else []
+
+    def extend(self, vals):
+        if self.typecode is None:
+            self.values.extend(vals)
+            return
+        if None in vals:
+            if self.typecode == 'q':
+                self._convert('d')
+            if self.typecode == 'd':
+                nan = float('nan')
+                vals = [nan if val is None else val for val in vals]
+            else:
+                self._convert(None)
+                self.values.extend(vals)
+                return
+        length = len(self.values)
+        try:
+            self.values.extend(vals)
+        except (TypeError, OverflowError):
+            del self.values[length:]
+            self._convert(None)
+            self.values.extend(vals)
+
+    def _convert(self, typecode):
+        if typecode is None:
+            self.values = self.values.tolist()
+        else:
+            self.values = array(typecode, self.values)
+        self.typecode = typecode
+
+    def get_values(self, use_numpy=False):
+        """
+        Returns the column as an array or list, or as a NumPy array
+        """
+        if not use_numpy:
+            return self.values
+        if self.typecode is not None:
+            return numpy.frombuffer(self.values, dtype=NUMPY_DTYPES[self.typecode])
+        if isinstance(self.field, fields.DateTimeField):
+            try:
+                return numpy.array(self.values, dtype='datetime64[us]')
+            except (TypeError, ValueError):
+                pass
+        res = numpy.empty(len(self.values), dtype=object)
+        res[:] = self.values
+        return res
+
+def get_use_numpy(use_numpy=None):
+    """
+    Returns whether to build NumPy arrays. By default they are used if NumPy
+    is installed
+    """
+    if use_numpy is None:
+        return numpy is not None
+    if use_numpy and numpy is None:
+        raise Exception('NumPy is not installed')
+    return use_numpy
@@ -0,0 +1,112 @@
+
+import datetime
+import decimal
+
+from rev.db.exceptions import ValidationError
+
+# Utility functions for working with find() criteria
+
+def get_criteria_shape(criteria):
+    """
+    Returns a copy of criteria with every value replaced by '?', keeping the
+    field names and operators. Useful for logging queries without their data
+    """
+    if isinstance(criteria, dict):
+        return dict((key, get_criteria_shape(val)) for key, val in criteria.items())
+    elif isinstance(criteria, (list, tuple)) and criteria and \
+            all(isinstance(item, dict) for item in criteria):
+        # e.g. the list of sub-criteria in an '$or'
+        return [get_criteria_shape(item) for item in criteria]
+    return '?'
+
+# Pure python evaluation of find() criteria, for providers that hold their
+# records in memory. Follows MongoDB's rules: a criteria value matches a list
+# field if it equals the list or any item in it, and missing fields are None
+
+CRITERIA_OPERATORS = ['$eq', '$ne', '$in', '$nin', '$gt', '$gte', '$lt', '$lte', '$exists']
+
+_COMPARE_FUNCTIONS = {
+    '$gt' : lambda a, b: a > b,
+    '$gte' : lambda a, b: a >= b,
+    '$lt' : lambda a, b: a < b,
+    '$lte' : lambda a, b: a <= b,
+}
+
+def match_criteria(record, criteria):
+    """
+    Returns True if the record dictionary matches criteria
+    """
+    for key, val in criteria.items():
+        if key == '$and':
+            if not all(match_criteria(record, sub_criteria) for sub_criteria in val):
+                return False
+        elif key == '$or':
+            if not any(match_criteria(record, sub_criteria) for sub_criteria in val):
+                return False
+        elif key == '$nor':
+            if any(match_criteria(record, sub_criteria) for sub_criteria in val):
+                return False
+        elif isinstance(val, dict) and val and all(op[:1] == '$' for op in val):
+            for op, op_val in val.items():
+                if not _match_operator(record, key, op, op_val):
+                    return False
+        elif not _match_value(record.get(key), val):
+            return False
+    return True
+
+def _match_value(value, criteria_value):
+    if value == criteria_value:
+        return True
+    return isinstance(value, list) and criteria_value in value
+
+def _match_operator(record, key, op, op_val):
+    value = record.get(key)
+    if op == '$eq':
+        return _match_value(value, op_val)
+    elif op == '$ne':
+        return not _match_value(value, op_val)
+    elif op == '$in':
+        return any(_match_value(value, item) for item in op_val)
+    elif op == '$nin':
+        return not any(_match_value(value, item) for item in op_val)
+    elif op == '$exists':
+        return (key in record) == bool(op_val)
+    elif op in _COMPARE_FUNCTIONS:
+        compare = _COMPARE_FUNCTIONS[op]
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            try:
+                if item is not None and compare(item, op_val):
+                    return True
+            except TypeError:
+                pass  # Values of different types never match
+        return False
+    raise ValidationError("Unsupported criteria operator '{}'. Valid options are: {}".format(op, ', '.join(CRITERIA_OPERATORS)))
+
+# Sort order of value types, as used by MongoDB. None sorts first
+_TYPE_ORDER = [
+    (bool, 8),
+    ((int, float, decimal.Decimal), 1),
+    (str, 2),
+    (list, 4),
+    (bytes, 5),
+    ((datetime.datetime, datetime.date), 9),
+]
+
+def _sort_key(value):
+    if value is None:
+        return (0, 0)
+    for types, order in _TYPE_ORDER:
+        if isinstance(value, types):
+            return (order, value)
+    if isinstance(value, dict):
+        return (3, str(value))
+    return (6, str(value))
+
+def sort_records(records, order_by):
+    """
+    Sort a list of record dictionaries in place by order_by, a list of
+    (field_name, 'asc' / 'desc') tuples
+    """
+    for field_name, direction in reversed(order_by):
+        records.sort(key=lambda record: _sort_key(record.get(field_name)), reverse=(direction == 'desc'))
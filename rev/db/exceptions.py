@@ -9,4 +9,13 @@ class ModelNotFoundError(Exception):
     pass
 
 class XMLImportError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class BulkWriteError(Exception):
+    """
+    Raised when one or more operations in a bulk write fail. 'errors' is a
+    list of (operation_index, message) tuples
+    """
+    def __init__(self, message, errors):
+        super().__init__(message)
+        self.errors = errors
\ No newline at end of file
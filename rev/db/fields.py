@@ -10,6 +10,7 @@ class Field():
         self.default_value = kwargs.get('default_value', None)
         self.default_widget = kwargs.get('widget', self.__class__.__name__)
         self.stored = kwargs.get('stored', True)
+        self.index = kwargs.get('index', False)  # True, 'asc' or 'desc'
     
     @property
     def type(self):
@@ -114,8 +115,14 @@ class RecordLinkField(Field):
 class RecordListField(Field):
     """
     Returns a list of related records
+    
+    'filter' is the name of the RecordLinkField on the related model that
+    links back to this model's records
     """
     def __init__(self, label, related_model, filter, **kwargs):
+        # The records are looked up, not stored
+        kwargs.setdefault('required', False)
+        kwargs.setdefault('stored', False)
         super().__init__(label, **kwargs)
         self.related_model = related_model
         self.filter = filter
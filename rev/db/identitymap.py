@@ -0,0 +1,68 @@
+
+from flask import has_request_context
+
+from rev.db.state import get_state
+
+class IdentityMap():
+    """
+    Request-scoped store of records that have been looked up by id, so that
+    repeated lookups of the same record within a request only hit the
+    database once. Enable it with the DB_IDENTITY_MAP setting.
+    """
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._records = {}  # Dictionary of ModelName => {id : (read_fields, record)}
+    
+    def get(self, model, record_id, read_fields='*'):
+        """
+        Returns a (read_fields, record) tuple if the record has been cached
+        with (at least) the requested read_fields, otherwise None. The record
+        is None when it is known not to exist.
+        """
+        entry = self._records.get(model._name, {}).get(record_id)
+        if entry is not None and (entry[0] == '*' or \
+                (read_fields != '*' and set(read_fields) <= set(entry[0]))):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+    
+    def add(self, model, record_id, read_fields, record):
+        self._records.setdefault(model._name, {})[record_id] = (read_fields, record)
+    
+    def invalidate(self, model):
+        """
+        Discard all cached records for the specified model
+        """
+        self._records.pop(model._name, None)
+    
+    def invalidate_missing(self, model):
+        """
+        Discard the entries for records of the specified model that were
+        not found, as they may now have been created
+        """
+        records = self._records.get(model._name, {})
+        for record_id in [record_id for record_id, entry in records.items() if entry[1] is None]:
+            del records[record_id]
+    
+    def clear(self):
+        self._records = {}
+
+def get_identity_map():
+    """
+    Returns the IdentityMap for the current request, or None when called
+    outside of a request (unless an async operation was started from one)
+    """
+    state = get_state()
+    identity_map = getattr(state, '_rev_identity_map', None)
+    if identity_map is None and has_request_context():
+        identity_map = state._rev_identity_map = IdentityMap()
+    return identity_map
+
+def is_id_lookup(criteria):
+    """
+    Returns True if criteria only selects a single record by its id
+    """
+    return len(criteria) == 1 and isinstance(criteria.get('id'), str)
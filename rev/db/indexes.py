@@ -0,0 +1,227 @@
+
+import logging
+
+from rev.db.exceptions import ValidationError
+
+INDEX_DIRECTIONS = ['asc', 'desc']
+
+def normalise_index_spec(spec):
+    """
+    Converts an index declaration into a list of (field_name, direction)
+    tuples. Declarations can be a field name, or a list of field names
+    and / or (field_name, direction) pairs
+    """
+    if isinstance(spec, str):
+        spec = [spec]
+    index_spec = []
+    for item in spec:
+        if isinstance(item, str):
+            field_name, direction = item, 'asc'
+        else:
+            field_name, direction = item
+        if direction not in INDEX_DIRECTIONS:
+            raise Exception("Invalid direction '{}' for index on field '{}'".format(direction, field_name))
+        index_spec.append((field_name, direction))
+    return index_spec
+
+def get_model_indexes(model):
+    """
+    Returns a list of (index_spec, unique) tuples for all the indexes
+    declared on a model, via field 'index' options, _indexes and _unique
+    """
+    indexes = []
+    
+    def _add_index(spec, unique):
+        index_spec = normalise_index_spec(spec)
+        for existing_spec, existing_unique in indexes:
+            if existing_spec == index_spec:
+                return
+        indexes.append((index_spec, unique))
+    
+    for unq_key in getattr(model, '_unique', []):
+        if unq_key:
+            _add_index(unq_key, True)
+    
+    for field_name in sorted(model._fields.keys()):
+        field_index = model._fields[field_name].index
+        if field_index:
+            _add_index([(field_name, field_index if field_index in INDEX_DIRECTIONS else 'asc')], False)
+    
+    for index in getattr(model, '_indexes', []):
+        _add_index(index, False)
+    
+    return indexes
+
+def get_lookup_values(criteria_value):
+    """
+    Returns the set of values that criteria_value matches by equality, or
+    None if it is not a plain value or an '$in' list
+    """
+    if isinstance(criteria_value, dict):
+        if list(criteria_value.keys()) == ['$in']:
+            try:
+                return set(criteria_value['$in'])
+            except TypeError:
+                return None
+        return None
+    try:
+        return {criteria_value}
+    except TypeError:
+        return None
+
+def get_hashable(value):
+    # Returns a hashable version of a field value
+    if isinstance(value, list):
+        return tuple(get_hashable(item) for item in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((key, get_hashable(val)) for key, val in value.items()))
+    return value
+
+class HashIndex():
+    """
+    Maps the values of one or more fields to the ids of the records that
+    have them. Records whose single indexed field is a list are indexed
+    under each of the list's items, as well as the list itself.
+
+    Compound indexes are only used for lookups until a list value is
+    indexed, as list items cannot be matched on a compound key.
+    """
+    def __init__(self, model, fields, unique=False):
+        self.model = model
+        self.fields = fields
+        self.unique = unique
+        self.multikey = False
+        self._entries = {}  # Dictionary of key => set of ids
+
+    def _get_keys(self, record):
+        values = [record.get(field_name) for field_name in self.fields]
+        if len(values) == 1:
+            keys = {get_hashable(values[0])}
+            if isinstance(values[0], list):
+                keys.update(get_hashable(item) for item in values[0])
+            return keys
+        if any(isinstance(value, list) for value in values):
+            self.multikey = True
+        return {tuple(get_hashable(value) for value in values)}
+
+    def add(self, record):
+        for key in self._get_keys(record):
+            self._entries.setdefault(key, set()).add(record['id'])
+
+    def remove(self, record):
+        for key in self._get_keys(record):
+            ids = self._entries.get(key)
+            if ids is not None:
+                ids.discard(record['id'])
+                if not ids:
+                    del self._entries[key]
+
+    def check_unique(self, record):
+        """
+        Raise a ValidationError if 'record' would duplicate the indexed
+        values of another record, for unique indexes
+        """
+        if not self.unique:
+            return
+        for key in self._get_keys(record):
+            if self._entries.get(key, set()) - {record['id']}:
+                raise ValidationError("Duplicate values for unique fields {} of model '{}'".format(
+                    ', '.join(self.fields), self.model._name))
+
+    def lookup(self, criteria):
+        """
+        Returns the set of ids of records that may match criteria, or None
+        if the index cannot be used for them
+        """
+        if len(self.fields) == 1:
+            if self.fields[0] not in criteria:
+                return None
+            values = get_lookup_values(criteria[self.fields[0]])
+            if values is None:
+                return None
+            ids = set()
+            for value in values:
+                ids.update(self._entries.get(get_hashable(value), ()))
+            return ids
+
+        if self.multikey:
+            return None
+        key = []
+        for field_name in self.fields:
+            criteria_value = criteria.get(field_name)
+            if field_name not in criteria or isinstance(criteria_value, (dict, list)):
+                return None
+            key.append(criteria_value)
+        return set(self._entries.get(tuple(key), ()))
+
+    def dump(self):
+        """
+        Returns the index entries, so they can be saved and restored with load()
+        """
+        return self._entries, self.multikey
+
+    def load(self, entries, multikey):
+        self._entries = entries
+        self.multikey = multikey
+
+def get_candidate_ids(indexes, criteria):
+    """
+    Returns the set of ids of the records that may match criteria, using
+    the 'id' criteria or the first of the HashIndexes that can be used, or
+    None if all records need to be checked
+    """
+    if 'id' in criteria:
+        candidate_ids = get_lookup_values(criteria['id'])
+        if candidate_ids is not None:
+            return candidate_ids
+    for index in indexes:
+        candidate_ids = index.lookup(criteria)
+        if candidate_ids is not None:
+            return candidate_ids
+    return None
+
+class IndexAdvisor():
+    """
+    Records find() criteria and sort keys that cannot use any of the indexes
+    declared on the model. Enable it with the DB_INDEX_ADVISOR setting (on
+    by default in DEBUG mode)
+    """
+    
+    def __init__(self):
+        self.unindexed_queries = {}  # Dictionary of (ModelName, criteria fields, sort fields) => count
+        self._model_indexes = {}  # Dictionary of ModelName => [first field of each index]
+    
+    def _get_leading_fields(self, model):
+        if model._name not in self._model_indexes:
+            self._model_indexes[model._name] = set(
+                    [spec[0][0] for spec, unique in get_model_indexes(model)])
+        return self._model_indexes[model._name]
+    
+    def check(self, model, criteria, order_by=None):
+        """
+        Record the query if no declared index covers it. Returns True if the
+        query is covered
+        """
+        criteria_fields = tuple(sorted([fld for fld in criteria.keys() if fld[:1] != '$']))
+        sort_fields = tuple([ob[0] for ob in order_by]) if order_by else ()
+        
+        if not criteria_fields and not sort_fields:
+            return True # Reading the whole collection is intentional
+        if 'id' in criteria_fields:
+            return True
+        
+        leading_fields = self._get_leading_fields(model)
+        if criteria_fields:
+            covered = any(fld in leading_fields for fld in criteria_fields)
+        else:
+            covered = sort_fields[0] in leading_fields
+        
+        if not covered:
+            query_key = (model._name, criteria_fields, sort_fields)
+            if query_key not in self.unindexed_queries:
+                logging.warning("Unindexed query on model '{}'. Criteria fields: {}, Sort fields: {}".format(
+                                    model._name, ', '.join(criteria_fields) or '-', ', '.join(sort_fields) or '-'))
+                self.unindexed_queries[query_key] = 0
+            self.unindexed_queries[query_key] += 1
+        
+        return covered
@@ -3,6 +3,15 @@ import logging
 
 from rev.db import fields
 from rev.db.exceptions import ValidationError
+from rev.db.records import ListRecordSet, AsyncRecordSet
+from rev.db.identitymap import get_identity_map, is_id_lookup
+from rev.db.querycache import QueryCache
+from rev.db.related import get_related_records
+from rev.db.pagination import decode_token, get_keyset_order, get_keyset_criteria
+from rev.db.aggregation import get_aggregate_metrics
+from rev.db.unitofwork import get_unit_of_work
+from rev.db.schema import get_model_schema
+from rev.db.query import PreparedQuery
 
 class OverrideModel:  # Empty class used to indicate model classes that extend existing models
     pass
@@ -21,14 +30,18 @@ class Model:
         self._module = self.__class__.__module__
         self._registry = registry
         self._database = registry.app.databases[self._database]
+        self._use_identity_map = registry.app.config.get('DB_IDENTITY_MAP', False)
+        self._index_advisor = getattr(registry.app, 'index_advisor', None)
+        
+        self._query_cache = None
+        if getattr(self, '_cache_queries', None) and getattr(registry.app, 'cache', None) is not None:
+            self._query_cache = QueryCache(registry.app.cache, self, self._cache_queries.get('ttl', 60))
 
         logging.debug('Loading Model: %s (%s)', self._name, self._description)
         
-        # configure self._fields
-        self._fields = {}
-        for attr in dir(self):
-            if isinstance(getattr(self, attr), fields.Field):
-                self._fields[attr] = getattr(self, attr)
+        # configure self._fields from the class's schema
+        self._schema = get_model_schema(self.__class__)
+        self._fields = self._schema.fields
         
         # initialise model in database #TODO: This should really be done via syncdb
         self._database.init_model(self)
@@ -44,23 +57,181 @@ class Model:
     def fields(self):
         return self._fields
     
-    def find(self, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
+    def find(self, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}, prefetch=None, after=None, raw=False):
         """
         Search the database using the specified criteria, and return the matching data
+        
+        Set raw=True to iterate over plain record dictionaries, or
+        raw='tuple' for named tuples of the id and read_fields, instead of
+        ModelRecord objects. This is much cheaper when reading many records
+        
+        'prefetch' is a list of RecordLinkField / RecordListField names. The
+        related records for all results are loaded with one query per field,
+        and are returned by ModelRecord.related()
+        
+        Passing 'after' enables keyset pagination: use after='' for the first
+        page, then the token from the previous page's get_next_token()
         """
         
+        if raw and not count_only:
+            if prefetch:
+                raise Exception('find() cannot prefetch related records for raw results')
+            res = self.find(criteria, read_fields, order_by, limit, offset, count_only, context, None, after)
+            res.raw = raw
+            return res
+        
+        if after is not None:
+            return self._find_after(criteria, read_fields, order_by, limit, offset, count_only, context, prefetch, after)
+        
+        if prefetch and not count_only:
+            return self._find_prefetch(criteria, read_fields, order_by, limit, offset, context, prefetch)
+        
+        if self._index_advisor is not None:
+            self._index_advisor.check(self, criteria, order_by)
+        
+        if self._use_identity_map and not count_only and not offset and is_id_lookup(criteria):
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                return self._find_by_id_cached(identity_map, criteria['id'], read_fields, context)
+        
+        if self._query_cache is not None and not context.get('no_cache'):
+            return self._find_cached(criteria, read_fields, order_by, limit, offset, count_only, context)
+        
         return self._database.find(self, criteria, read_fields, order_by, limit, offset, count_only, context)
 
+    def prepare(self, criteria, read_fields='*', order_by=None):
+        """
+        Returns a PreparedQuery for criteria containing rev.db.query.Param
+        placeholders, e.g.
+        
+            by_email = model.prepare({'email' : Param('email')}, ['name'])
+            res = by_email.find({'email' : 'bob@example.com'})
+        
+        The query is normalised for the database once, so this is faster than
+        find() for queries that are run many times
+        """
+        return PreparedQuery(self, criteria, read_fields, order_by)
+
+    def _find_after(self, criteria, read_fields, order_by, limit, offset, count_only, context, prefetch, after):
+        """
+        Perform a find() that returns the records following the 'after'
+        continuation token, in order_by order with 'id' as a tie-breaker
+        """
+        order_by = get_keyset_order(order_by)
+        if after:
+            keyset_criteria = get_keyset_criteria(order_by, decode_token(after))
+            criteria = {'$and' : [criteria, keyset_criteria]} if criteria else keyset_criteria
+        
+        query_read_fields = read_fields
+        if read_fields != '*':
+            # Make sure the sort keys are read so the next token can be built
+            query_read_fields = list(read_fields) + [ob[0] for ob in order_by
+                if ob[0] != 'id' and ob[0] not in read_fields]
+        
+        res = self.find(criteria, query_read_fields, order_by, limit, offset, count_only, context, prefetch)
+        if not count_only:
+            res.read_fields = read_fields
+            res.keyset_order = order_by
+        return res
+
+    def _find_prefetch(self, criteria, read_fields, order_by, limit, offset, context, prefetch):
+        """
+        Perform a find() and resolve the 'prefetch' fields for all results
+        """
+        query_read_fields = read_fields
+        if read_fields != '*':
+            # Make sure the link fields are read
+            query_read_fields = list(read_fields) + [fld for fld in prefetch
+                if fld not in read_fields and isinstance(self._fields.get(fld), fields.RecordLinkField)]
+        
+        records = [rec.record for rec in self.find(criteria, query_read_fields, order_by, limit, offset, False, context)]
+        res = ListRecordSet(self, read_fields, records)
+        for field_name in prefetch:
+            res.related[field_name] = get_related_records(self, field_name, records)
+        return res
+
+    def _find_by_id_cached(self, identity_map, record_id, read_fields, context={}):
+        """
+        Look up a single record by id via the request's identity map
+        """
+        entry = identity_map.get(self, record_id, read_fields)
+        if entry is None:
+            records = [rec.record for rec in self._database.find(self, {'id' : record_id}, read_fields, context=context)]
+            identity_map.add(self, record_id, read_fields, records[0] if records else None)
+        else:
+            records = [entry[1]] if entry[1] is not None else []
+        # Return copies, so changes to the results do not affect the cache
+        return ListRecordSet(self, read_fields, [dict(record) for record in records])
+
+    def _find_cached(self, criteria, read_fields, order_by, limit, offset, count_only, context={}):
+        """
+        Perform a find() via the model's query cache
+        """
+        key = self._query_cache.get_key(criteria, read_fields, order_by, limit, offset, count_only)
+        res = self._query_cache.get(key)
+        if res is None:
+            res = self._database.find(self, criteria, read_fields, order_by, limit, offset, count_only, context)
+            if not count_only:
+                res = [rec.record for rec in res]
+            self._query_cache.set(key, res)
+        if count_only:
+            return res
+        return ListRecordSet(self, read_fields, [dict(record) for record in res])
+
+    def _get_unit_of_work(self, limit=0):
+        """
+        Returns the active UnitOfWork that writes should be queued in, if any
+        """
+        unit_of_work = get_unit_of_work()
+        if unit_of_work is not None and limit:
+            # Bulk writes cannot be limited, so write the queued operations
+            # now and let the caller perform this one directly
+            unit_of_work.flush()
+            return None
+        return unit_of_work
+
+    def _invalidate_caches(self, operation):
+        """
+        Discard any cached copies of this model's records. Called after
+        records are created ('create'), updated ('update') or deleted ('delete')
+        """
+        if self._query_cache is not None:
+            self._query_cache.invalidate()
+        if self._use_identity_map:
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                if operation == 'create':
+                    # Existing records are unchanged, but ids that were not
+                    # found may have been created
+                    identity_map.invalidate_missing(self)
+                else:
+                    identity_map.invalidate(self)
+
+    def aggregate(self, criteria={}, group_by=[], metrics={}, context={}):
+        """
+        Calculate aggregate values in the database for the records matching
+        criteria. Returns a list of dictionaries, one per distinct
+        combination of the group_by field values, e.g.:
+        
+            orders.aggregate({'status' : 'paid'}, group_by=['customer'],
+                             metrics={'total' : ('sum', 'amount'), 'orders' : 'count'})
+        
+        Available functions are 'count', 'sum', 'avg', 'min' and 'max'
+        """
+        
+        metrics = get_aggregate_metrics(self, group_by, metrics)
+        
+        if self._index_advisor is not None:
+            self._index_advisor.check(self, criteria)
+        
+        return self._database.aggregate(self, criteria, list(group_by), metrics, context)
+
     def get_create_vals(self, vals, context={}):
         """
         Process and validate values for new records
         """
-        create_vals = {}
-        
         # Start from default values
-        for fld, fld_obj in self._fields.items():
-            create_vals[fld] = fld_obj.get_default_value()
-        
+        create_vals = self._schema.get_default_vals()
         create_vals.update(vals)
         
         self.validate_field_values(create_vals)
@@ -74,14 +245,7 @@ class Model:
         
         Raises a rev.models.exceptions.ValidationError if there is a problem
         """
-        
-        extra_fields = set(vals.keys()) - set(self._fields.keys())
-        
-        if extra_fields != set():
-            raise ValidationError("Object '{}' does not have the following fields: {}".format(self._name, ', '.join(extra_fields)))
-        
-        for field_name in vals:
-            self._fields[field_name].validate_value(self, field_name, vals[field_name])
+        self._schema.validate(self, vals)
 
     def create(self, vals, context={}):
         """
@@ -90,8 +254,19 @@ class Model:
 
         create_vals = self.get_create_vals(vals, context)
         
+        unit_of_work = self._get_unit_of_work()
+        if unit_of_work is not None:
+            id = self._database.create_record_id(self, create_vals, context)
+            if id is not None:
+                create_vals['id'] = id
+                unit_of_work.add(self, ('create', create_vals))
+                return id
+            # The database assigns ids, so the create cannot be queued
+            unit_of_work.flush()
+        
         # Do Create
         id = self._database.create(self, create_vals, context)
+        self._invalidate_caches('create')
         
         return id        
 
@@ -102,8 +277,14 @@ class Model:
                 
         self.validate_field_values(vals)
         
+        unit_of_work = self._get_unit_of_work(limit)
+        if unit_of_work is not None:
+            unit_of_work.add(self, ('update', criteria, vals))
+            return True
+        
         # Do Update
         res = self._database.update(self, criteria, vals, limit, context)
+        self._invalidate_caches('update')
         
         return True
     
@@ -112,10 +293,168 @@ class Model:
         Deletes existing records. Returns True if successful
         """
         
+        unit_of_work = self._get_unit_of_work(limit)
+        if unit_of_work is not None:
+            unit_of_work.add(self, ('delete', criteria))
+            return True
+        
         # Do Delete
         res = self._database.delete(self, criteria, limit, context)
+        self._invalidate_caches('delete')
+        
+        return True
+
+    def create_many(self, vals_list, ordered=True, context={}):
+        """
+        Creates multiple records using a single bulk write. Returns a list of
+        the ids of the created records
+        
+        If ordered is False the database may apply the writes in any order
+        and will attempt all of them even if some fail
+        """
+        
+        create_vals_list = [self.get_create_vals(vals, context) for vals in vals_list]
+        
+        unit_of_work = self._get_unit_of_work()
+        if unit_of_work is not None:
+            ids = [self._database.create_record_id(self, create_vals, context) for create_vals in create_vals_list]
+            if None not in ids:
+                for id, create_vals in zip(ids, create_vals_list):
+                    create_vals['id'] = id
+                    unit_of_work.add(self, ('create', create_vals))
+                return ids
+            # The database assigns ids, so the creates cannot be queued
+            unit_of_work.flush()
+        
+        # Do Create
+        try:
+            ids = self._database.create_many(self, create_vals_list, ordered, context)
+        finally:
+            # Some writes may have been applied even if others failed
+            self._invalidate_caches('create')
+        
+        return ids
+
+    def update_many(self, updates, ordered=True, context={}):
+        """
+        Applies a list of (criteria, vals) updates using a single bulk write.
+        Returns True if successful
+        """
+        
+        for criteria, vals in updates:
+            self.validate_field_values(vals)
+        
+        unit_of_work = self._get_unit_of_work()
+        if unit_of_work is not None:
+            for criteria, vals in updates:
+                unit_of_work.add(self, ('update', criteria, vals))
+            return True
+        
+        # Do Update
+        try:
+            res = self._database.update_many(self, updates, ordered, context)
+        finally:
+            self._invalidate_caches('update')
+        
+        return True
+
+    def delete_many(self, criteria_list, ordered=True, context={}):
+        """
+        Deletes the records matching each criteria in criteria_list using a
+        single bulk write. Returns True if successful
+        """
+        
+        unit_of_work = self._get_unit_of_work()
+        if unit_of_work is not None:
+            for criteria in criteria_list:
+                unit_of_work.add(self, ('delete', criteria))
+            return True
+        
+        # Do Delete
+        try:
+            res = self._database.delete_many(self, criteria_list, ordered, context)
+        finally:
+            self._invalidate_caches('delete')
         
         return True
 
+    def upsert_many(self, vals_list, key=None, ordered=True, context={}):
+        """
+        Updates the records matching each set of vals on the 'key' field(s),
+        creating them if they do not exist, using a single bulk write.
+        
+        'key' defaults to the first of the model's _unique constraints.
+        Default values are only applied to records that get created.
+        
+        Returns a list containing the id of each created record, or None
+        where an existing record was updated
+        """
+        
+        if key is None:
+            if not getattr(self, '_unique', None):
+                raise ValidationError("Model '{}' has no _unique constraint to upsert on. Please specify a key.".format(self._name))
+            key = self._unique[0]
+        key_fields = [key] if isinstance(key, str) else list(key)
+        
+        defaults = self._schema.get_default_vals()
+        defaults.pop('id', None)
+        
+        upserts = []
+        for vals in vals_list:
+            missing_keys = [fld for fld in key_fields if fld not in vals]
+            if missing_keys:
+                raise ValidationError("Upsert values for '{}' must include the key field(s): {}".format(self._name, ', '.join(missing_keys)))
+            criteria = dict((fld, vals[fld]) for fld in key_fields)
+            insert_vals = dict((fld, val) for fld, val in defaults.items() if fld not in vals)
+            # Validate the record that would be created, as create() does
+            self.validate_field_values(dict(insert_vals, **vals))
+            upserts.append((criteria, vals, insert_vals))
+        
+        # Upserts return which records were created, so are not queued.
+        # Write any queued operations first to keep them in order
+        unit_of_work = get_unit_of_work()
+        if unit_of_work is not None:
+            unit_of_work.flush()
+        
+        # Do Upsert
+        try:
+            ids = self._database.upsert_many(self, upserts, ordered, context)
+        finally:
+            self._invalidate_caches('update')
+        
+        return ids
+
+    # asyncio versions of the methods above. These run the blocking methods
+    # via the database provider's _run_async(), in a thread pool by default
+
+    async def afind(self, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}, prefetch=None, after=None, raw=False):
+        """
+        Awaitable version of find(). Returns an AsyncRecordSet for use with
+        'async for', or the number of matching records if count_only is set
+        """
+        res = await self._database._run_async(self.find, criteria, read_fields, order_by, limit, offset, count_only, context, prefetch, after, raw)
+        return res if count_only else AsyncRecordSet(res, self._database)
+
+    async def aaggregate(self, criteria={}, group_by=[], metrics={}, context={}):
+        return await self._database._run_async(self.aggregate, criteria, group_by, metrics, context)
+
+    async def acreate(self, vals, context={}):
+        return await self._database._run_async(self.create, vals, context)
+
+    async def aupdate(self, criteria, vals, limit=0, context={}):
+        return await self._database._run_async(self.update, criteria, vals, limit, context)
+
+    async def adelete(self, criteria, limit=0, context={}):
+        return await self._database._run_async(self.delete, criteria, limit, context)
+
+    async def acreate_many(self, vals_list, ordered=True, context={}):
+        return await self._database._run_async(self.create_many, vals_list, ordered, context)
+
+    async def aupdate_many(self, updates, ordered=True, context={}):
+        return await self._database._run_async(self.update_many, updates, ordered, context)
+
+    async def adelete_many(self, criteria_list, ordered=True, context={}):
+        return await self._database._run_async(self.delete_many, criteria_list, ordered, context)
+
     def __repr__(self):
         return self.__class__.__name__
\ No newline at end of file
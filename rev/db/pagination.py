@@ -0,0 +1,85 @@
+
+# Keyset (cursor-based) pagination helpers. Rather than skipping 'offset'
+# records, the next page is selected with criteria on the sort keys of the
+# last record returned, with the record id as a tie-breaker
+
+import base64
+import datetime
+import decimal
+import json
+
+from rev.db.exceptions import ValidationError
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'$datetime' : value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {'$date' : value.isoformat()}
+    elif isinstance(value, decimal.Decimal):
+        return {'$decimal' : str(value)}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if '$datetime' in value:
+            return datetime.datetime.fromisoformat(value['$datetime'])
+        elif '$date' in value:
+            return datetime.date.fromisoformat(value['$date'])
+        elif '$decimal' in value:
+            return decimal.Decimal(value['$decimal'])
+    return value
+
+def encode_token(values):
+    """
+    Encode a list of sort key values as an opaque continuation token
+    """
+    token_json = json.dumps([_encode_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(token_json.encode('utf-8')).decode('ascii')
+
+def decode_token(token):
+    """
+    Decode a continuation token back into its list of sort key values
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValidationError("Invalid continuation token '{}'".format(token))
+    if not isinstance(values, list):
+        raise ValidationError("Invalid continuation token '{}'".format(token))
+    return [_decode_value(value) for value in values]
+
+def get_keyset_order(order_by):
+    """
+    Returns order_by with 'id' appended as a tie-breaker, so that every
+    record has a unique position in the sort order
+    """
+    order_by = [(ob[0], ob[1]) for ob in order_by] if order_by else []
+    if 'id' not in [ob[0] for ob in order_by]:
+        order_by.append(('id', order_by[-1][1] if order_by else 'asc'))
+    return order_by
+
+def get_keyset_criteria(order_by, values):
+    """
+    Returns criteria that select the records that sort after the record
+    with the specified sort key values. Null (or missing) values sort before
+    all other values, i.e. first in ascending and last in descending order
+    """
+    if len(values) != len(order_by):
+        raise ValidationError("Continuation token does not match the sort order")
+    clauses = []
+    for key_idx, (field_name, direction) in enumerate(order_by):
+        value = values[key_idx]
+        if value is None and direction == 'desc':
+            # Nothing sorts after null in descending order
+            continue
+        clause = {}
+        for prev_idx in range(key_idx):
+            clause[order_by[prev_idx][0]] = values[prev_idx]
+        if value is None:
+            clause[field_name] = {'$ne' : None}
+        elif direction == 'asc':
+            clause[field_name] = {'$gt' : value}
+        else:
+            clause['$or'] = [{field_name : {'$lt' : value}}, {field_name : None}]
+        clauses.append(clause)
+    return {'$or' : clauses}
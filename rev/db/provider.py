@@ -1,10 +1,19 @@
 
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .exceptions import BulkWriteError
+from .records import AsyncRecordSet
+from .state import bind_state
 
 class DBProvider():
     """
     Base Class for Rev DB Providers
     """
     
+    async_workers = 4  # Size of the thread pool used by the async methods
+    
     def __init__(self, db_config, name):
         # Initialise database including recording settings from app.config
         pass
@@ -19,8 +28,127 @@ class DBProvider():
     def create(self, model, vals, context={}):
         raise NotImplementedError("Provider does not implement the create() method.")
     
+    def create_record_id(self, model, vals, context={}):
+        # Return a new id for a record, or None if the database assigns ids
+        # when records are created
+        return None
+    
     def update(self, model, critria, vals, limit=0, context={}):
         raise NotImplementedError("Provider does not implement the update() method.")
     
     def delete(self, model, criteria, limit=0, context={}):
         raise NotImplementedError("Provider does not implement the delete() method.")
+    
+    def aggregate(self, model, criteria={}, group_by=[], metrics={}, context={}):
+        raise NotImplementedError("Provider does not implement the aggregate() method.")
+
+    def prepare_query(self, model, criteria, read_fields='*', order_by=None):
+        """
+        Returns an object with find(params, limit, offset, count_only, context)
+        and update(params, vals, limit, context) methods that run a query whose
+        criteria contain rev.db.query.Params, or None to run prepared queries
+        through find() and update()
+        """
+        return None
+
+    def bulk_write(self, model, operations, ordered=True, context={}):
+        """
+        Applies a list of write operations to a model's records. Each
+        operation is one of:
+        
+         - ('create', vals)
+         - ('update', criteria, vals)
+         - ('delete', criteria)
+         - ('upsert', criteria, vals, insert_vals)
+        
+        Returns a list with one result per operation (the new id for creates
+        and upserts that inserted a record, otherwise None).
+        
+        Providers should override this to send the operations to the
+        database in a single request. This default applies them one by one.
+        """
+        results = []
+        errors = []
+        for idx, op in enumerate(operations):
+            res = None
+            try:
+                if op[0] == 'create':
+                    res = self.create(model, op[1], context)
+                elif op[0] == 'update':
+                    self.update(model, op[1], op[2], 0, context)
+                elif op[0] == 'delete':
+                    self.delete(model, op[1], 0, context)
+                elif op[0] == 'upsert':
+                    if self.find(model, op[1], count_only=True, context=context):
+                        self.update(model, op[1], op[2], 0, context)
+                    else:
+                        create_vals = dict(op[3])
+                        create_vals.update(op[2])
+                        res = self.create(model, create_vals, context)
+                else:
+                    raise ValueError("Invalid bulk operation '{}'".format(op[0]))
+            except Exception as e:
+                errors.append((idx, str(e)))
+                if ordered:
+                    break
+            results.append(res)
+        if errors:
+            raise BulkWriteError("{} bulk write operation(s) failed for model '{}'".format(len(errors), model._name), errors)
+        return results
+
+    def create_many(self, model, vals_list, ordered=True, context={}):
+        return self.bulk_write(model, [('create', vals) for vals in vals_list], ordered, context)
+
+    def update_many(self, model, updates, ordered=True, context={}):
+        self.bulk_write(model, [('update', criteria, vals) for criteria, vals in updates], ordered, context)
+        return True
+
+    def delete_many(self, model, criteria_list, ordered=True, context={}):
+        self.bulk_write(model, [('delete', criteria) for criteria in criteria_list], ordered, context)
+        return True
+
+    def upsert_many(self, model, upserts, ordered=True, context={}):
+        return self.bulk_write(model, [('upsert',) + tuple(upsert) for upsert in upserts], ordered, context)
+
+    # asyncio methods. By default these run the blocking methods above in a
+    # thread pool. Providers with non-blocking drivers can override them
+
+    def _run_async(self, func, *args, **kwargs):
+        """
+        Runs a blocking function in the provider's thread pool and returns an
+        awaitable for its result. The function sees the caller's unit of
+        work, identity map and database profile
+        """
+        executor = getattr(self, '_executor', None)
+        if executor is None:
+            executor = self._executor = ThreadPoolExecutor(max_workers=self.async_workers)
+        func = bind_state(functools.partial(func, *args, **kwargs))
+        return asyncio.get_running_loop().run_in_executor(executor, func)
+
+    def shutdown_executor(self, wait=True):
+        """
+        Stops the thread pool used by the async methods, if it was started
+        """
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            self._executor = None
+            executor.shutdown(wait=wait)
+
+    async def afind(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
+        res = await self._run_async(self.find, model, criteria, read_fields, order_by, limit, offset, count_only, context)
+        return res if count_only else AsyncRecordSet(res, self)
+
+    async def acreate(self, model, vals, context={}):
+        return await self._run_async(self.create, model, vals, context)
+
+    async def aupdate(self, model, criteria, vals, limit=0, context={}):
+        return await self._run_async(self.update, model, criteria, vals, limit, context)
+
+    async def adelete(self, model, criteria, limit=0, context={}):
+        return await self._run_async(self.delete, model, criteria, limit, context)
+
+    async def aaggregate(self, model, criteria={}, group_by=[], metrics={}, context={}):
+        return await self._run_async(self.aggregate, model, criteria, group_by, metrics, context)
+
+    async def abulk_write(self, model, operations, ordered=True, context={}):
+        return await self._run_async(self.bulk_write, model, operations, ordered, context)
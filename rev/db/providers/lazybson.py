@@ -0,0 +1,133 @@
+
+import struct
+from collections.abc import MutableMapping
+
+import bson
+
+try:
+    from bson import decode as decode_bson
+except ImportError:  # pymongo < 3.9
+    def decode_bson(data):
+        return bson.BSON(data).decode()
+
+_INT32 = struct.Struct('<i')
+
+# Size of the value for fixed size BSON element types
+_FIXED_SIZES = {
+    0x01 : 8,   # double
+    0x06 : 0,   # undefined
+    0x07 : 12,  # ObjectId
+    0x08 : 1,   # boolean
+    0x09 : 8,   # UTC datetime
+    0x0A : 0,   # null
+    0x10 : 4,   # int32
+    0x11 : 8,   # timestamp
+    0x12 : 8,   # int64
+    0x13 : 16,  # decimal128
+    0xFF : 0,   # min key
+    0x7F : 0,   # max key
+}
+
+# Element types whose value is prefixed by its length
+_STRING_TYPES = (0x02, 0x0D, 0x0E)  # string, javascript code, symbol
+_DOCUMENT_TYPES = (0x03, 0x04, 0x0F)  # document, array, code with scope
+
+def get_element_offsets(data):
+    """
+    Scan the top level elements of a BSON document without decoding them.
+    Returns a dictionary of element name => (start, end) offsets in 'data'
+    """
+    offsets = {}
+    pos = 4
+    end = len(data) - 1
+    while pos < end:
+        start = pos
+        element_type = data[pos]
+        name_end = data.index(b'\x00', pos + 1)
+        name = data[pos + 1:name_end].decode('utf-8')
+        pos = name_end + 1
+        if element_type in _FIXED_SIZES:
+            pos += _FIXED_SIZES[element_type]
+        elif element_type in _STRING_TYPES:
+            pos += 4 + _INT32.unpack_from(data, pos)[0]
+        elif element_type in _DOCUMENT_TYPES:
+            pos += _INT32.unpack_from(data, pos)[0]
+        elif element_type == 0x05:  # binary
+            pos += 5 + _INT32.unpack_from(data, pos)[0]
+        elif element_type == 0x0B:  # regular expression
+            pos = data.index(b'\x00', data.index(b'\x00', pos) + 1) + 1
+        elif element_type == 0x0C:  # DBPointer
+            pos += 4 + _INT32.unpack_from(data, pos)[0] + 12
+        else:
+            raise Exception("Unknown BSON element type: {}".format(element_type))
+        offsets[name] = (start, pos)
+    return offsets
+
+class LazyBSONRecord(MutableMapping):
+    """
+    A record dictionary backed by a raw BSON document. Each field is only
+    decoded when it is first read, and '_id' is returned as a string 'id'
+    field. The BSON document itself is never modified; values that are set
+    are held separately.
+    """
+    __slots__ = ('_data', '_offsets', '_values', '_removed')
+
+    def __init__(self, data):
+        self._data = data
+        self._offsets = None
+        self._values = {}  # Decoded and assigned values
+        self._removed = set()
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            self._offsets = get_element_offsets(self._data)
+        return self._offsets
+
+    def _decode(self, name):
+        start, end = self._get_offsets()[name]
+        element = self._data[start:end]
+        value = decode_bson(_INT32.pack(len(element) + 5) + element + b'\x00')[name]
+        return str(value) if name == '_id' else value
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        if key in self._removed:
+            raise KeyError(key)
+        name = '_id' if key == 'id' else key
+        if key == '_id' or name not in self._get_offsets():
+            raise KeyError(key)
+        value = self._values[key] = self._decode(name)
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        self._removed.add(key)
+
+    def __contains__(self, key):
+        if key in self._values:
+            return True
+        if key in self._removed or key == '_id':
+            return False
+        return ('_id' if key == 'id' else key) in self._get_offsets()
+
+    def __iter__(self):
+        for name in self._get_offsets():
+            key = 'id' if name == '_id' else name
+            if key not in self._removed:
+                yield key
+        for key in self._values:
+            if ('_id' if key == 'id' else key) not in self._offsets and key != '_id':
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, dict(self))
@@ -0,0 +1,505 @@
+
+import logging
+import mmap
+import os
+import pickle
+import re
+import struct
+import threading
+import zlib
+from uuid import uuid4
+
+from rev.db import DBProvider
+from rev.db.exceptions import ValidationError
+from rev.db.records import ModelRecordSet
+from rev.db.aggregation import aggregate_records
+from rev.db.criteria import match_criteria, sort_records
+from rev.db.indexes import get_model_indexes, get_candidate_ids, HashIndex
+
+# Append-only log DatabaseProvider. Each model's records are written to a
+# segment file as length-prefixed entries:
+#
+#   <payload length : uint32> <crc32 of payload : uint32> <payload>
+#
+# where the payload is a pickled (operation, id, record) tuple. An update
+# appends the new version of the record, and a delete appends a tombstone.
+# An in-memory index maps each id to its latest entry, which is read via an
+# mmap of the segment. The index and the _unique / declared index keys are
+# checkpointed to '<segment>.idx' and rebuilt from the log at open if the
+# checkpoint is missing or stale. A background thread compacts segments that
+# are mostly superseded entries.
+#
+# Settings:
+#   'path' - directory to store the segment files in
+#   'fsync' - fsync after every write (default False)
+#   'compact_ratio' - compact once this fraction of a segment is dead (default 0.5)
+#   'compact_min_size' - don't compact segments smaller than this (default 1MB)
+#   'maintenance_interval' - seconds between compaction / checkpoint runs (default 30)
+#
+# The segment files hold pickled data, so must only be read by trusted code.
+
+HEADER = struct.Struct('<II')
+
+OP_PUT = 1
+OP_DELETE = 2
+
+CHECKPOINT_VERSION = 1
+
+class DatabaseProvider(DBProvider):
+
+    def __init__(self, db_config, name):
+        # Initialise database provider including recording settings from app.config
+        self.name = name
+        self.path = db_config['path']
+        self.fsync = db_config.get('fsync', False)
+        self.compact_ratio = db_config.get('compact_ratio', 0.5)
+        self.compact_min_size = db_config.get('compact_min_size', 1024 * 1024)
+        self.maintenance_interval = db_config.get('maintenance_interval', 30)
+        self.async_workers = db_config.get('async_workers', self.async_workers)
+
+        os.makedirs(self.path, exist_ok=True)
+        self._segments = {}  # Dictionary of ModelName => Segment
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._maintenance_thread = None
+
+    def init_model(self, model):
+        # Open the model's segment, loading or rebuilding its index
+
+        # _table_name is CamelCaseName converted to camel_case_name
+        model._table_name = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', model._name)
+        model._table_name = re.sub('([a-z0-9])([A-Z])', r'\1_\2', model._table_name).lower()
+
+        with self._lock:
+            if model._name in self._segments:
+                self._segments[model._name].close()
+            self._segments[model._name] = Segment(
+                os.path.join(self.path, model._table_name + '.log'), model, self.fsync)
+
+            if self._maintenance_thread is None and self.maintenance_interval:
+                self._maintenance_thread = threading.Thread(target=self._maintenance,
+                                                            name='logstore-' + self.name, daemon=True)
+                self._maintenance_thread.start()
+
+    def close(self):
+        """
+        Stop background compaction, checkpoint the indexes and close the segments
+        """
+        self._stop.set()
+        if self._maintenance_thread is not None:
+            self._maintenance_thread.join()
+            self._maintenance_thread = None
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+    def _maintenance(self):
+        while not self._stop.wait(self.maintenance_interval):
+            for model_name in list(self._segments.keys()):
+                try:
+                    segment = self._segments.get(model_name)
+                    if segment is None:
+                        continue
+                    if segment.size >= self.compact_min_size and segment.dead_bytes >= segment.size * self.compact_ratio:
+                        self.compact(model_name)
+                    elif segment.size != segment.checkpoint_size:
+                        with self._lock:
+                            segment.write_checkpoint()
+                except Exception:
+                    logging.exception("Logstore maintenance failed for model '{}'".format(model_name))
+
+    def compact(self, model_name):
+        """
+        Rewrite a model's segment with only the latest version of each
+        record. Writes can continue while the live records are copied
+        """
+        segment = self._segments[model_name]
+        with segment.compact_lock:
+            with self._lock:
+                entries = list(segment.offsets.items())
+                view = segment.get_view()
+                copied_size = segment.size
+            logging.info("Compacting segment '{}' ({} bytes, {} dead)".format(
+                            segment.path, segment.size, segment.dead_bytes))
+
+            compact_path = segment.path + '.compact'
+            new_offsets = {}
+            with open(compact_path, 'wb') as compact_file:
+                position = 0
+                for record_id, (start, length) in entries:
+                    compact_file.write(view[start:start + length])
+                    new_offsets[record_id] = (position, length)
+                    position += length
+
+                with self._lock:
+                    # Copy entries written while the live records were copied
+                    view = segment.get_view()
+                    for start, length, op, record_id, record in segment.scan(view, copied_size):
+                        compact_file.write(view[start:start + length])
+                        new_offsets.pop(record_id, None)
+                        if op == OP_PUT:
+                            new_offsets[record_id] = (position, length)
+                        position += length
+                    compact_file.flush()
+                    os.fsync(compact_file.fileno())
+                    segment.replace(compact_path, new_offsets, position)
+
+    def _get_segment(self, model):
+        return self._segments[model._name]
+
+    def _find_entries(self, segment, criteria):
+        """
+        Returns the (id, (start, length)) entries of the records that may
+        match criteria, in the order they were last written
+        """
+        candidate_ids = get_candidate_ids(segment.indexes, criteria)
+        if candidate_ids is None:
+            return list(segment.offsets.items())
+        return sorted(((record_id, segment.offsets[record_id]) for record_id in candidate_ids if record_id in segment.offsets),
+                      key=lambda entry: entry[1][0])
+
+    def _iter_records(self, segment, view, entries, criteria):
+        for record_id, (start, length) in entries:
+            record = segment.read(view, start, length)
+            if match_criteria(record, criteria):
+                yield record
+
+    def _find_records(self, model, criteria, limit=0):
+        """
+        Returns a list of the records that match criteria
+        """
+        segment = self._get_segment(model)
+        with self._lock:
+            records = []
+            for record in self._iter_records(segment, segment.get_view(), self._find_entries(segment, criteria), criteria):
+                records.append(record)
+                if limit and len(records) >= limit:
+                    break
+            return records
+
+    def find(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
+        """
+        Search the model data using the specified criteria, and return the matching data
+        """
+        if count_only:
+            return len(self._find_records(model, criteria))
+
+        fields = None if read_fields == '*' else ['id'] + [fld for fld in read_fields if fld != 'id']
+
+        if order_by:
+            records = self._find_records(model, criteria)
+            sort_records(records, order_by)
+            records = records[offset:offset + limit] if limit else records[offset:]
+            if fields is not None:
+                records = list(_project(records, fields))
+            return LogStoreRecordSet(model, read_fields, records=records)
+
+        # Stream the records from a snapshot of the index. The snapshot can
+        # be read again from the start when the results are indexed
+        segment = self._get_segment(model)
+        with self._lock:
+            view = segment.get_view()
+            entries = self._find_entries(segment, criteria)
+
+        def read_records():
+            records = self._iter_records(segment, view, entries, criteria)
+            if offset or limit:
+                records = _slice(records, offset, limit)
+            return _project(records, fields) if fields is not None else records
+
+        count_func = lambda: self._count(model, criteria, limit, offset)
+        return LogStoreRecordSet(model, read_fields, read_records=read_records, count_func=count_func)
+
+    def _count(self, model, criteria, limit, offset):
+        count = max(len(self._find_records(model, criteria, (limit + offset) if limit else 0)) - offset, 0)
+        return min(count, limit) if limit else count
+
+    def aggregate(self, model, criteria={}, group_by=[], metrics={}, context={}):
+        """
+        Calculate aggregate values for the matching records
+        """
+        return aggregate_records(self._find_records(model, criteria), group_by, metrics)
+
+    def create_record_id(self, model, vals, context={}):
+        """
+        Generate a unique ID for the new record
+        """
+        return str(uuid4())
+
+    def create(self, model, vals, context={}):
+        """
+        Creates a new record. Returns the id of the created record
+        """
+        record = dict(vals)
+        if not record.get('id'):
+            record['id'] = self.create_record_id(model, vals, context)
+
+        segment = self._get_segment(model)
+        with self._lock:
+            if record['id'] in segment.offsets:
+                raise ValidationError("The id '{}' already exists".format(record['id']))
+            for index in segment.indexes:
+                index.check_unique(record)
+            segment.write(OP_PUT, record['id'], record)
+
+        return record['id']
+
+    def update(self, model, criteria, vals, limit=0, context={}):
+        """
+        Updates existing records by appending their new versions. Returns True if successful
+        """
+        segment = self._get_segment(model)
+        with self._lock:
+            records = self._find_records(model, criteria, limit)
+            new_records = []
+            for record in records:
+                if vals.get('id', record['id']) != record['id']:
+                    raise ValidationError("The id of an existing record cannot be changed")
+                new_record = dict(record)
+                new_record.update(vals)
+                new_records.append(new_record)
+
+            # Check the new values of every record before writing any, so a
+            # duplicate unique value leaves all of them unchanged
+            for index in segment.indexes:
+                for record in records:
+                    index.remove(record)
+            try:
+                for new_record in new_records:
+                    for index in segment.indexes:
+                        index.check_unique(new_record)
+                        index.add(new_record)
+            finally:
+                # Writing the records updates the indexes
+                for index in segment.indexes:
+                    for new_record in new_records:
+                        index.remove(new_record)
+                    for record in records:
+                        index.add(record)
+
+            for new_record in new_records:
+                segment.write(OP_PUT, new_record['id'], new_record)
+
+        return True
+
+    def delete(self, model, criteria, limit=0, context={}):
+        """
+        Deletes existing records by appending tombstones. Returns True if successful
+        """
+        segment = self._get_segment(model)
+        with self._lock:
+            for record in self._find_records(model, criteria, limit):
+                segment.write(OP_DELETE, record['id'], None)
+
+        return True
+
+def _project(records, fields):
+    for record in records:
+        yield dict((fld, record[fld]) for fld in fields if fld in record)
+
+def _slice(records, offset, limit):
+    for idx, record in enumerate(records):
+        if idx >= offset:
+            yield record
+            if limit and idx + 1 >= offset + limit:
+                break
+
+class Segment():
+    """
+    A model's log file, with its index of id => (start, length) of the
+    latest entry for each record, and the model's HashIndexes.
+    Callers must hold the provider's lock
+    """
+    def __init__(self, path, model, fsync=False):
+        self.path = path
+        self.model = model
+        self.fsync = fsync
+        self.compact_lock = threading.Lock()
+        self.indexes = [HashIndex(model, [field_name for field_name, direction in index_spec], unique)
+                            for index_spec, unique in get_model_indexes(model)]
+        self._open()
+        self.offsets = {}
+        self.dead_bytes = 0
+        self.checkpoint_size = 0
+
+        replay_from = 0
+        if self._load_checkpoint():
+            replay_from = self.checkpoint_size
+        view = self.get_view()
+        for start, length, op, record_id, record in self.scan(view, replay_from, truncate=True):
+            self._apply(start, length, op, record_id, record)
+
+    def _open(self):
+        self.file = open(self.path, 'a+b')
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self._view = None
+
+    def close(self):
+        self.write_checkpoint()
+        self.file.close()
+        self._view = None
+
+    def get_view(self, end=None):
+        """
+        Returns an mmap covering the segment up to 'end' (by default the whole
+        segment). Earlier views stay valid for the entries they cover
+        """
+        if end is None:
+            end = self.size
+        if end and (self._view is None or len(self._view) < end):
+            self._view = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._view
+
+    def read(self, view, start, length):
+        op, record_id, record = pickle.loads(view[start + HEADER.size:start + length])
+        return record
+
+    def scan(self, view, start, truncate=False):
+        """
+        Yields (start, length, op, id, record) for the entries from 'start'.
+        If truncate is set, a torn or corrupt entry at the end of the log
+        (from a crash during a write) is removed
+        """
+        end = self.size
+        while start < end:
+            try:
+                if start + HEADER.size > end:
+                    raise ValueError('Incomplete entry header')
+                payload_length, checksum = HEADER.unpack_from(view, start)
+                length = HEADER.size + payload_length
+                if start + length > end:
+                    raise ValueError('Incomplete entry')
+                payload = view[start + HEADER.size:start + length]
+                if zlib.crc32(payload) != checksum:
+                    raise ValueError('Checksum mismatch')
+            except ValueError as e:
+                if not truncate:
+                    raise
+                logging.warning("Truncating segment '{}' at offset {}: {}".format(self.path, start, e))
+                self.file.truncate(start)
+                self.size = start
+                self._view = None
+                return
+            op, record_id, record = pickle.loads(payload)
+            yield start, length, op, record_id, record
+            start += length
+
+    def _apply(self, start, length, op, record_id, record):
+        # Update the indexes for a new entry
+        previous = self.offsets.pop(record_id, None)
+        if previous is not None:
+            self.dead_bytes += previous[1]
+            previous_record = self.read(self.get_view(previous[0] + previous[1]), *previous)
+            for index in self.indexes:
+                index.remove(previous_record)
+        if op == OP_PUT:
+            self.offsets[record_id] = (start, length)
+            for index in self.indexes:
+                index.add(record)
+        else:
+            self.dead_bytes += length
+
+    def write(self, op, record_id, record):
+        payload = pickle.dumps((op, record_id, record), protocol=pickle.HIGHEST_PROTOCOL)
+        entry = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        start = self.size
+        self.file.write(entry)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.size += len(entry)
+        self._apply(start, len(entry), op, record_id, record)
+
+    def replace(self, compact_path, offsets, size):
+        """
+        Switch to a compacted copy of the segment
+        """
+        # The checkpoint's offsets are for the old file. Remove it first, so
+        # a crash before the new checkpoint is written rebuilds the index
+        try:
+            os.remove(self._get_checkpoint_path())
+        except FileNotFoundError:
+            pass
+        self.file.close()
+        os.replace(compact_path, self.path)
+        self._open()
+        if self.size != size:
+            raise Exception("Compacted segment '{}' has an unexpected size".format(self.path))
+        self.offsets = offsets
+        self.dead_bytes = size - sum(length for start, length in offsets.values())
+        self.write_checkpoint()
+
+    def _get_checkpoint_path(self):
+        return self.path + '.idx'
+
+    def _get_index_specs(self):
+        return [(index.fields, index.unique) for index in self.indexes]
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._get_checkpoint_path(), 'rb') as checkpoint_file:
+                checkpoint = pickle.load(checkpoint_file)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.warning("Ignoring invalid checkpoint for segment '{}': {}".format(self.path, e))
+            return False
+        if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint['size'] > self.size \
+                or checkpoint['index_specs'] != self._get_index_specs():
+            logging.info("Rebuilding index for segment '{}'".format(self.path))
+            return False
+        self.offsets = checkpoint['offsets']
+        self.dead_bytes = checkpoint['dead_bytes']
+        self.checkpoint_size = checkpoint['size']
+        for index, (entries, multikey) in zip(self.indexes, checkpoint['indexes']):
+            index.load(entries, multikey)
+        return True
+
+    def write_checkpoint(self):
+        checkpoint = {
+            'version' : CHECKPOINT_VERSION,
+            'size' : self.size,
+            'offsets' : self.offsets,
+            'dead_bytes' : self.dead_bytes,
+            'index_specs' : self._get_index_specs(),
+            'indexes' : [index.dump() for index in self.indexes],
+        }
+        checkpoint_path = self._get_checkpoint_path()
+        with open(checkpoint_path + '.tmp', 'wb') as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        self.checkpoint_size = self.size
+
+class LogStoreRecordSet(ModelRecordSet):
+    """
+    Encapsulates the results of a find() on a log store model. Sorted
+    results are passed as a list of 'records'. Otherwise records are read
+    from the segment as they are iterated over, using 'read_records', which
+    returns an iterator over the results from the start
+    """
+    def __init__(self, model, read_fields, records=None, read_records=None, count_func=None):
+        super().__init__(model, read_fields)
+        self._records = records
+        self._read_records = read_records
+        self._iterator = iter(records) if records is not None else read_records()
+        self._count_func = count_func
+        self._count = None
+
+    def count(self):
+        if self._records is not None:
+            return len(self._records)
+        if self._count is None:
+            self._count = self._count_func()
+        return self._count
+
+    def __getitem__(self, item):
+        if self._records is None:
+            # Read all of the results so they can be indexed by position,
+            # whatever has already been iterated over
+            self._records = list(self._read_records())
+        return self._make_record(self._records[item])
+
+    def _fetch_next(self):
+        return next(self._iterator)
@@ -1,19 +1,45 @@
 
 import logging
+import time
+from collections import deque
 
 from rev.db import DBProvider
-from rev.db.records import ModelRecordSet, ModelRecord
+from rev.db.exceptions import BulkWriteError
+from rev.db.indexes import get_model_indexes
+from rev.db.criteria import get_criteria_shape
+from rev.db.records import ModelRecordSet
+from rev.db.query import Param, compile_template
+from rev.db.providers.lazybson import LazyBSONRecord
 import pymongo
+import pymongo.errors
+from pymongo.read_preferences import ReadPreference
 from bson.objectid import ObjectId
-from copy import deepcopy
+
+try:
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+except ImportError:  # pymongo < 3.2
+    RawBSONDocument = None
 
 import re
 
+# pymongo 3.0 renamed find()'s 'spec' and 'fields' arguments, and moved
+# per-query read preferences to Collection.with_options()
+PYMONGO_3 = pymongo.version_tuple[0] >= 3
+
 ORDER_BY_OPTIONS = {
     'asc' : pymongo.ASCENDING,
     'desc' : pymongo.DESCENDING,
 }
 
+READ_PREFERENCE_OPTIONS = {
+    'primary' : ReadPreference.PRIMARY,
+    'primary_preferred' : ReadPreference.PRIMARY_PREFERRED,
+    'secondary' : ReadPreference.SECONDARY,
+    'secondary_preferred' : ReadPreference.SECONDARY_PREFERRED,
+    'nearest' : ReadPreference.NEAREST,
+}
+
 # Mongo DB Database Provider
 
 class DatabaseProvider(DBProvider):
@@ -21,16 +47,81 @@ class DatabaseProvider(DBProvider):
     def __init__(self, db_config, name):
         # Initialise database provider including recording settings from app.config
         self.name = name
-        self.host = db_config['host']
-        self.port = db_config['port']
+        self.host = db_config.get('host')
+        self.port = db_config.get('port')
         self.db_name = db_config['database']
         
+        # Replica set settings. 'hosts' is a seed list of 'host:port' strings,
+        # which is also used instead of 'host' and 'port' without a replica set
+        self.hosts = db_config.get('hosts', None)
+        self.replica_set = db_config.get('replica_set', None)
+        self.read_preference = db_config.get('read_preference', 'primary')
+        self.max_staleness = db_config.get('max_staleness', None)
+        if self.max_staleness and pymongo.version_tuple[:2] < (3, 4):
+            logging.warning("The 'max_staleness' setting requires pymongo 3.4 or later, so has been disabled.")
+            self.max_staleness = None
+        self._get_read_preference(self.read_preference) # Validate the setting
+        
+        self.batch_size = db_config.get('batch_size', None)
+        
+        # Fetch documents as raw BSON and only decode the fields that are read
+        self.lazy_decode = db_config.get('lazy_decode', False)
+        if self.lazy_decode and RawBSONDocument is None:
+            logging.warning("The 'lazy_decode' setting requires pymongo 3.2 or later, so has been disabled.")
+            self.lazy_decode = False
+        self.async_workers = db_config.get('async_workers', self.async_workers)
+        self.stale_indexes = {}  # Dictionary of ModelName => [index names]
+        
+        # Slow query logging. slow_queries holds the most recent slow queries
+        # when 'slow_query_log_size' is set
+        self.slow_query_ms = db_config.get('slow_query_ms', None)
+        self.slow_queries = None
+        if self.slow_query_ms is not None and db_config.get('slow_query_log_size'):
+            self.slow_queries = deque(maxlen=db_config['slow_query_log_size'])
+        
         # Connect to Database
-        logging.info("Database Server: {}:{}".format(self.host, self.port))
+        if self.replica_set:
+            hosts = self.hosts or ['{}:{}'.format(self.host, self.port)]
+            logging.info("Database Replica Set: {} ({})".format(self.replica_set, ', '.join(hosts)))
+            logging.info("Default Read Preference: {}".format(self.read_preference))
+        elif self.hosts:
+            logging.info("Database Servers: {}".format(', '.join(self.hosts)))
+        else:
+            logging.info("Database Server: {}:{}".format(self.host, self.port))
         logging.info("Database Name: {}".format(self.db_name))
 
-        self._dbclient = pymongo.MongoClient(self.host, self.port)
+        if self.replica_set:
+            client_options = {
+                'replicaSet' : self.replica_set,
+                'read_preference' : self._get_read_preference(self.read_preference),
+            }
+            if self.max_staleness:
+                # Requires MongoDB 3.4+
+                client_options['maxStalenessSeconds'] = self.max_staleness
+            # pymongo 2.x only routes reads to secondaries via MongoReplicaSetClient
+            client_class = getattr(pymongo, 'MongoReplicaSetClient', pymongo.MongoClient)
+            self._dbclient = client_class(','.join(hosts), **client_options)
+        elif self.hosts:
+            self._dbclient = pymongo.MongoClient(list(self.hosts))
+        else:
+            self._dbclient = pymongo.MongoClient(self.host, self.port)
         self._db = self._dbclient[self.db_name]
+
+    def _get_read_preference(self, read_preference):
+        if read_preference not in READ_PREFERENCE_OPTIONS:
+            raise Exception("Invalid read preference '{}'. Valid options are: {}".format(
+                                read_preference, ', '.join(sorted(READ_PREFERENCE_OPTIONS.keys()))))
+        return READ_PREFERENCE_OPTIONS[read_preference]
+
+    def _get_model_read_preference(self, model, context):
+        """
+        Returns the read preference for a query, from context['read_preference']
+        or the model's _read_preference property, or None for the default
+        """
+        read_preference = context.get('read_preference', getattr(model, '_read_preference', None))
+        if read_preference is None:
+            return None
+        return self._get_read_preference(read_preference)
         
     def init_model(self, model):
         # Create collection for specified model if it does not already exist
@@ -46,66 +137,162 @@ class DatabaseProvider(DBProvider):
             logging.info('Creating Collection: %s', model._table_name)
             db.create_collection(model._table_name)
         
-        if hasattr(model, '_unique'):
-            for unq_key in model._unique:
-                if unq_key:
-                    logging.debug('Ensuring Unique Constraint for: %s', unq_key)
-                    if isinstance(unq_key, str):
-                        db[model._table_name].ensure_index(unq_key, unique=True )
-                    elif isinstance(unq_key, (list, tuple)):
-                        index_spec = []
-                        for unq_field in unq_key:
-                            index_spec.append((unq_field, pymongo.ASCENDING))
-                        db[model._table_name].ensure_index(index_spec, unique=True )
+        self._reconcile_indexes(model)
 
+    def _reconcile_indexes(self, model):
+        """
+        Create any indexes declared on the model that do not exist yet, and
+        report existing indexes that are no longer declared
+        """
+        coll = self._db[model._table_name]
+        existing = coll.index_information()
+        existing_keys = {}
+        for index_name, index_info in existing.items():
+            existing_keys[tuple(tuple(key) for key in index_info['key'])] = index_name
+        
+        declared_keys = set()
+        for index_spec, unique in get_model_indexes(model):
+            db_spec = [(fld, ORDER_BY_OPTIONS[direction]) for fld, direction in index_spec]
+            declared_keys.add(tuple(db_spec))
+            if tuple(db_spec) not in existing_keys:
+                logging.info('Creating {}Index on {}: {}'.format(
+                                'Unique ' if unique else '', model._table_name, index_spec))
+                coll.ensure_index(db_spec, unique=unique)
+        
+        stale_indexes = [index_name for key, index_name in existing_keys.items()
+                            if key not in declared_keys and index_name != '_id_']
+        if stale_indexes:
+            logging.warning("Collection '{}' has indexes that are not declared on model '{}': {}".format(
+                                model._table_name, model._name, ', '.join(sorted(stale_indexes))))
+        self.stale_indexes[model._name] = stale_indexes
     
+    def _get_db_criteria(self, criteria):
+        """
+        Returns a copy of criteria with 'id' replaced by mongo's '_id', with
+        string ids converted to BSON ObjectIds
+        """
+        db_criteria = {}
+        for key, val in criteria.items():
+            if key == 'id':
+                db_criteria['_id'] = _get_object_ids(val)
+            elif key in ['$and', '$or', '$nor']:
+                db_criteria[key] = [self._get_db_criteria(sub_criteria) for sub_criteria in val]
+            else:
+                db_criteria[key] = val
+        return db_criteria
+
+    def _get_db_vals(self, vals):
+        """
+        Returns a copy of the values for a new record, with any 'id' set by
+        create_record_id() converted to mongo's '_id'
+        """
+        vals = dict(vals)
+        record_id = vals.pop('id', None)
+        if record_id:
+            vals['_id'] = ObjectId(record_id)
+        return vals
+
+    def create_record_id(self, model, vals, context={}):
+        """
+        Generate a unique ID for a new record
+        """
+        return str(ObjectId())
+
+    def _get_db_sort(self, order_by):
+        """
+        Returns order_by as a pymongo sort specification
+        """
+        return [('_id' if ob[0] == 'id' else ob[0], ORDER_BY_OPTIONS[ob[1]]) for ob in order_by]
+
     def find(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
         """
         Search the database using the specified criteria, and return the matching data
         """
 
-        if 'id' in criteria:
-            # replace 'id' with '_id' and also convert the string values to BSON ObjectIds
-            if isinstance(criteria['id'], str):
-                criteria['_id'] = ObjectId(criteria['id'])
-            elif isinstance(criteria['id'], dict) and isinstance(criteria['id'].get('$in'), list):
-                criteria['_id'] = {'$in' : [ObjectId(x) for x in criteria['id']['$in']]}
-
-            del criteria['id']
+        criteria = self._get_db_criteria(criteria)
+        
+        # Make sure we read all fields for '*'
+        db_read_fields = None if read_fields == '*' else read_fields
+        sort = self._get_db_sort(order_by) if order_by else None
+        
+        return self._find(model, self._db[model._table_name], criteria, read_fields, db_read_fields,
+                          sort, limit, offset, count_only, context)
+    
+    def _find(self, model, collection, criteria, read_fields, db_read_fields, sort, limit, offset, count_only, context):
+        """
+        Run a find() with criteria, fields and sort already converted for mongo
+        """
         
         if count_only:
-            read_fields = []
-            order_by = None
-            limit = None
-            offset = None
-        else:
-            db_read_fields = read_fields
-            if read_fields == '*':
-                # Make sure we read all fields then
-                db_read_fields = None
-            if order_by:
-                # Replace asc / desc with db value
-                for ob_key, ob_val in enumerate(order_by):
-                    ob_val[1] = ORDER_BY_OPTIONS[ob_val[1]]
+            db_read_fields = []
+            sort = limit = offset = None
         
-        db = self._db
-        cr = db[model._table_name].find(spec=criteria, fields=db_read_fields, sort=order_by, limit=limit, skip=offset)
+        query = {
+            'spec' : criteria,
+            'fields' : db_read_fields,
+            'sort' : sort,
+            'limit' : limit,
+            'skip' : offset,
+        }
+        read_preference = self._get_model_read_preference(model, context)
+        if read_preference is not None:
+            query['read_preference'] = read_preference
+        raw = not count_only and self.lazy_decode and context.get('lazy_decode', True)
+        cr = self._run_find(collection, query, raw)
         
         if count_only:
-            return cr.count()
+            if self.slow_query_ms is None:
+                return cr.count()
+            start = time.time()
+            count = cr.count()
+            self._check_slow_query(model, 'count', query, time.time() - start)
+            return count
         else:
-            return MongoDBRecordSet(model, read_fields, cr)
+            batch_size = context.get('batch_size', self.batch_size)
+            res = MongoDBRecordSet(model, read_fields, cr, batch_size)
+            if self.slow_query_ms is not None:
+                res._slow_query_check = (self, query)
+            return res
+    
+    def _run_find(self, collection, query, raw=False):
+        """
+        Call collection.find() for a query dictionary from _find(), in a form
+        that both pymongo 2.x and 3.x accept. With 'raw', documents are
+        returned as RawBSONDocuments (pymongo 3.2+)
+        """
+        options = {}
+        if raw:
+            options['codec_options'] = CodecOptions(document_class=RawBSONDocument)
+        kwargs = {
+            'sort' : query.get('sort'),
+            'limit' : query.get('limit') or 0,
+            'skip' : query.get('skip') or 0,
+        }
+        read_preference = query.get('read_preference')
+        if read_preference is not None:
+            if PYMONGO_3:
+                options['read_preference'] = read_preference
+            else:
+                kwargs['read_preference'] = read_preference
+        if options:
+            collection = collection.with_options(**options)
+        # The criteria and fields are the first two arguments in both versions
+        return collection.find(query['spec'], query.get('fields'), **kwargs)
+    
+    def prepare_query(self, model, criteria, read_fields='*', order_by=None):
+        """
+        Returns a MongoDBPreparedQuery for a criteria template
+        """
+        return MongoDBPreparedQuery(self, model, criteria, read_fields, order_by)
         
     def create(self, model, vals, context={}):
         """
         Creates a new record. Returns the id of the created record
         """
         
-        if 'id' in vals:
-            del vals['id'] # Temporary workaround until we figure out a good way to handle mongo's _id
-            
-        id = self._db[model._table_name].insert(vals)
-        return id        
+        id = self._db[model._table_name].insert(self._get_db_vals(vals))
+        # Record ids are always returned as strings, as they are by find()
+        return str(id)
 
     def update(self, model, criteria, vals, limit=0, context={}):
         """
@@ -113,16 +300,13 @@ class DatabaseProvider(DBProvider):
         TODO: Implement 'limit'
         """
         
-        if 'id' in criteria:
-            criteria = deepcopy(criteria)
-            if isinstance(criteria['id'], str):
-                criteria['_id'] = ObjectId(criteria['id'])
-                del criteria['id']
-            else:
-                criteria['_id'] = {'$in' : [ObjectId(id) for id in criteria['id']['$in']]}
-                del criteria['id']
-        
-        res = self._db[model._table_name].update(criteria, {'$set' : vals}, multi=True)
+        return self._update(model, self._db[model._table_name], self._get_db_criteria(criteria), vals)
+    
+    def _update(self, model, collection, criteria, vals):
+        start = time.time()
+        res = collection.update(criteria, {'$set' : vals}, multi=True)
+        if self.slow_query_ms is not None:
+            self._check_slow_query(model, 'update', {'spec' : criteria}, time.time() - start)
         
         return True
     
@@ -132,42 +316,255 @@ class DatabaseProvider(DBProvider):
         TODO: Implement 'limit'
         """
 
-        if 'id' in criteria:
-            criteria = deepcopy(criteria)
-            if isinstance(criteria['id'], str):
-                criteria['_id'] = ObjectId(criteria['id'])
-                del criteria['id']
-            else:
-                criteria['_id'] = {'$in' : [ObjectId(id) for id in criteria['id']['$in']]}
-                del criteria['id']
+        criteria = self._get_db_criteria(criteria)
         
+        start = time.time()
         res = self._db[model._table_name].remove(criteria, multi=True)
+        if self.slow_query_ms is not None:
+            self._check_slow_query(model, 'delete', {'spec' : criteria}, time.time() - start)
+
+    def _check_slow_query(self, model, operation, query, elapsed):
+        """
+        Log the query, and the plan the server chose for it, if it took
+        longer than the 'slow_query_ms' setting
+        """
+        elapsed_ms = elapsed * 1000
+        if elapsed_ms < self.slow_query_ms:
+            return
+        
+        try:
+            explain = self._run_find(self._db[model._table_name], query).explain()
+            if 'queryPlanner' in explain:
+                plan = _get_plan_shape(explain['queryPlanner'].get('winningPlan'))
+            else:
+                plan = explain.get('cursor') # MongoDB < 3.0
+        except Exception as e:
+            plan = 'explain() failed: {}'.format(e)
+        
+        slow_query = {
+            'time' : time.time(),
+            'model' : model._name,
+            'operation' : operation,
+            'criteria' : get_criteria_shape(query['spec']),
+            'projection' : query.get('fields'),
+            'sort' : query.get('sort'),
+            'limit' : query.get('limit'),
+            'elapsed_ms' : round(elapsed_ms, 3),
+            'plan' : plan,
+        }
+        logging.warning("Slow Query ({elapsed_ms}ms): {model}.{operation} criteria={criteria} "
+                        "projection={projection} sort={sort} limit={limit} plan={plan}".format(**slow_query))
+        if self.slow_queries is not None:
+            self.slow_queries.append(slow_query)
+
+    def aggregate(self, model, criteria={}, group_by=[], metrics={}, context={}):
+        """
+        Calculate aggregate values using an aggregation pipeline
+        """
+        
+        group_id = None
+        if group_by:
+            group_id = dict((fld, '$_id' if fld == 'id' else '$' + fld) for fld in group_by)
+        group = {'_id' : group_id}
+        for metric_name, (func, field_name) in metrics.items():
+            if func == 'count':
+                group[metric_name] = {'$sum' : 1}
+            else:
+                group[metric_name] = {'$' + func : '$' + field_name}
+        
+        pipeline = []
+        if criteria:
+            pipeline.append({'$match' : self._get_db_criteria(criteria)})
+        pipeline.append({'$group' : group})
+        
+        collection = self._db[model._table_name]
+        aggregate_options = {'cursor' : {}}
+        read_preference = self._get_model_read_preference(model, context)
+        if read_preference is not None:
+            # pymongo 3.x no longer accepts read_preference as an argument
+            if PYMONGO_3:
+                collection = collection.with_options(read_preference=read_preference)
+            else:
+                aggregate_options['read_preference'] = read_preference
+        
+        res = []
+        for row in collection.aggregate(pipeline, **aggregate_options):
+            group_vals = row.pop('_id') or {}
+            if 'id' in group_vals:
+                group_vals['id'] = str(group_vals['id'])
+            row.update(group_vals)
+            res.append(row)
+        return res
+
+    def bulk_write(self, model, operations, ordered=True, context={}):
+        """
+        Sends a list of create / update / delete / upsert operations to the
+        database as a single bulk write. See DBProvider.bulk_write()
+        """
+        
+        if not operations:
+            return []
+        
+        coll = self._db[model._table_name]
+        if ordered:
+            bulk = coll.initialize_ordered_bulk_op()
+        else:
+            bulk = coll.initialize_unordered_bulk_op()
+        
+        created_docs = {}
+        for idx, op in enumerate(operations):
+            if op[0] == 'create':
+                doc = self._get_db_vals(op[1])
+                bulk.insert(doc)
+                created_docs[idx] = doc
+            elif op[0] == 'update':
+                bulk.find(self._get_db_criteria(op[1])).update({'$set' : op[2]})
+            elif op[0] == 'delete':
+                bulk.find(self._get_db_criteria(op[1])).remove()
+            elif op[0] == 'upsert':
+                vals = dict(op[2])
+                if 'id' in vals:
+                    del vals['id']
+                update_spec = {'$set' : vals}
+                if op[3]:
+                    update_spec['$setOnInsert'] = op[3]
+                bulk.find(self._get_db_criteria(op[1])).upsert().update_one(update_spec)
+            else:
+                raise ValueError("Invalid bulk operation '{}'".format(op[0]))
+        
+        try:
+            res = bulk.execute()
+        except pymongo.errors.BulkWriteError as e:
+            errors = [(err['index'], err['errmsg']) for err in e.details.get('writeErrors', [])]
+            raise BulkWriteError("{} bulk write operation(s) failed for model '{}'".format(len(errors), model._name), errors)
+        
+        results = [None] * len(operations)
+        for idx, doc in created_docs.items():
+            results[idx] = str(doc['_id'])
+        for upserted in res.get('upserted', []):
+            results[upserted['index']] = str(upserted['_id'])
+        return results
+
+
+def _get_object_ids(ids):
+    """
+    Converts an id, or an operator dictionary of ids, to BSON ObjectIds
+    """
+    if isinstance(ids, str):
+        return ObjectId(ids)
+    elif isinstance(ids, Param):
+        # Convert the parameter's value when it is bound
+        return Param(ids.name, _get_object_ids)
+    elif isinstance(ids, list):
+        return [ObjectId(x) for x in ids]
+    elif isinstance(ids, dict):
+        return dict((op, _get_object_ids(val)) for op, val in ids.items())
+    return ids
+
+class MongoDBPreparedQuery():
+    """
+    A prepared query with its criteria template, projection, sort
+    specification and collection worked out once
+    """
+    def __init__(self, provider, model, criteria, read_fields='*', order_by=None):
+        self.provider = provider
+        self.model = model
+        self.read_fields = read_fields
+        self.db_read_fields = None if read_fields == '*' else read_fields
+        self.sort = provider._get_db_sort(order_by) if order_by else None
+        self.collection = provider._db[model._table_name]
+        self._bind = compile_template(provider._get_db_criteria(criteria))
+    
+    def find(self, params, limit=0, offset=0, count_only=False, context={}):
+        return self.provider._find(self.model, self.collection, self._bind(params), self.read_fields,
+                                   self.db_read_fields, self.sort, limit, offset, count_only, context)
+    
+    def update(self, params, vals, limit=0, context={}):
+        return self.provider._update(self.model, self.collection, self._bind(params), vals)
+
+def _get_plan_shape(plan):
+    """
+    Returns a copy of an explain() plan with the query values redacted
+    """
+    if isinstance(plan, dict):
+        res = {}
+        for key, val in plan.items():
+            if key in ['filter', 'indexBounds', 'parsedQuery']:
+                res[key] = get_criteria_shape(val)
+            else:
+                res[key] = _get_plan_shape(val)
+        return res
+    elif isinstance(plan, list):
+        return [_get_plan_shape(item) for item in plan]
+    return plan
 
 
 class MongoDBRecordSet(ModelRecordSet):
     """
     Encapsulates the results of a find() on a Model from MongoDB
+    
+    Records are streamed from the cursor in batches of 'batch_size' (or the
+    driver default). The total is only queried when count() or len() is
+    called, and then only once.
+    
+    With the 'lazy_decode' setting (pymongo 3.2+), records are
+    LazyBSONRecords that decode each field when it is first read.
     """
-    def __init__(self, model, read_fields, cr):
+    def __init__(self, model, read_fields, cr, batch_size=None):
         super().__init__(model, read_fields)
         self.cr = cr
+        self._count = None
+        self._fetched = 0  # Records read from the cursor
+        self._slow_query_check = None  # (provider, query) to check on the first fetch
+        if batch_size:
+            self.cr.batch_size(batch_size)
         
-    def __len__(self):
-        return self.cr.count()
+    def count(self):
+        if self._count is None:
+            self._count = self.cr.count(with_limit_and_skip=True)
+        return self._count
 
     def _process_record(self, record):
+        if RawBSONDocument is not None and isinstance(record, RawBSONDocument):
+            # Decode fields (and translate '_id') only as they are read
+            return LazyBSONRecord(record.raw)
         if record['_id']:
             record['id'] = str(record['_id'])
             del record['_id']
         return record
 
     def __getitem__(self, item):
-        record = self._process_record(self.cr[item])
-        return ModelRecord(self.model, self.read_fields, record)
+        # Index by position in the whole result. Records that have been
+        # fetched but not yet iterated over are served from the buffer;
+        # otherwise the record is read with a copy of the cursor, which
+        # starts from the beginning of the result even if this one has started
+        if item < 0:
+            item += self.count()
+            if item < 0:
+                raise IndexError(item)
+        buffer_start = self._fetched - len(self._buffer)
+        if buffer_start <= item < self._fetched:
+            return self._make_record(self._buffer[item - buffer_start])
+        return self._make_record(self._process_record(self.cr.clone()[item]))
     
-    def __iter__(self):
-        return self
+    def _fetch_next(self):
+        if self._slow_query_check is None:
+            record = self.cr.__next__()
+        else:
+            # Time the round trip that returns the first batch of results
+            provider, query = self._slow_query_check
+            self._slow_query_check = None
+            start = time.time()
+            try:
+                record = self.cr.__next__()
+            finally:
+                provider._check_slow_query(self.model, 'find', query, time.time() - start)
+        self._fetched += 1
+        return self._process_record(record)
     
-    def __next__(self):
-        record = self._process_record(self.cr.__next__())
-        return ModelRecord(self.model, self.read_fields, record)
+    def iter_chunks(self, size):
+        try:
+            self.cr.batch_size(size)
+        except pymongo.errors.InvalidOperation:
+            pass # Cursor has already started, so keep its batch size
+        return super().iter_chunks(size)
@@ -1,11 +1,19 @@
 
+import asyncio
+import itertools
 import logging
+import threading
+from uuid import uuid4
 
 from rev.db.exceptions import ValidationError
 from rev.db import DBProvider
-from rev.db.records import ModelRecordSet, ModelRecord
+from rev.db.records import ModelRecordSet
+from rev.db.aggregation import aggregate_records
+from rev.db.criteria import match_criteria, sort_records
+from rev.db.indexes import get_model_indexes, get_candidate_ids, HashIndex
 
-# DatbaseProvider that uses a Dictionary in the user's Session to store its data
+# In-memory DatabaseProvider. Records are held in a dictionary per model, with
+# hash indexes for the model's _unique constraints and declared indexes
 
 class DatabaseProvider(DBProvider):
     
@@ -13,42 +21,101 @@ class DatabaseProvider(DBProvider):
         self.name = name
                 
         logging.warning("Initialising Dict Storage InMemoryModelProvider - DO NOT USE IN PRODUCTION !")
-        self._data = {}
+        self._data = {}  # Dictionary of ModelName => {id : record}
+        self._indexes = {}  # Dictionary of ModelName => [HashIndex]
+        self._positions = {}  # Dictionary of ModelName => {id : insert position}
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()
         
     def init_model(self, model):
         # Create collection for specified model if it does not already exist
         
         logging.debug('Creating Cache for: %s', model._name)
-        self._data[model._name] = {}
-        
-        if hasattr(model, '_unique'):
-            logging.warning('Cannot create unique constraints on InMemoryModels!')
+        with self._lock:
+            model_data = self._data.setdefault(model._name, {})
+            self._positions.setdefault(model._name, {})
+            self._indexes[model._name] = indexes = []
+            for index_spec, unique in get_model_indexes(model):
+                index = HashIndex(model, [field_name for field_name, direction in index_spec], unique)
+                for record in model_data.values():
+                    index.add(record)
+                indexes.append(index)
     
     def find(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
         """
         Search the model data using the specified criteria, and return the matching data
         Returns a ModelRecords iterable object
         """
+        with self._lock:
+            if count_only:
+                return len(self._find_records(model, criteria))
 
-        if criteria == {}:
-            return SessionRecordSet(self, [self._data[model._name][id] for id in self._data.keys()])
+            if order_by:
+                records = self._find_records(model, criteria)
+                sort_records(records, order_by)
+            else:
+                records = self._find_records(model, criteria, (limit + offset) if limit else 0)
+            if offset:
+                records = records[offset:]
+            if limit:
+                records = records[:limit]
 
-        # We currently only allow searching by id
-        if 'id' not in criteria:
-            raise ValidationError("InMemoryModel records can only be searched by 'id'")
-        if isinstance(criteria['id'], str):
-            if criteria['id'] in self._data[model._name]:
-                return SessionRecordSet(self, [self._data[model._name][criteria['id']]])
+            # Return copies, so changes to the results do not affect the data
+            if read_fields == '*':
+                records = [dict(record) for record in records]
             else:
-                return SessionRecordSet(self, [])
+                fields = ['id'] + [fld for fld in read_fields if fld != 'id']
+                records = [dict((fld, record[fld]) for fld in fields if fld in record) for record in records]
+
+        return SessionRecordSet(model, read_fields, records)
+
+    def _run_async(self, func, *args, **kwargs):
+        """
+        In-memory operations never wait on I/O, so the async methods run them
+        directly instead of in a thread pool
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _find_records(self, model, criteria, limit=0):
+        """
+        Returns a list of the stored record dictionaries that match criteria,
+        in insertion order. Lookups by id, and on indexed fields, only
+        check the records with matching values.
+        """
+        model_data = self._data[model._name]
+
+        candidate_ids = get_candidate_ids(self._indexes[model._name], criteria)
+        if candidate_ids is None:
+            candidates = model_data.values()
         else:
-            return SessionRecordSet(self, [self._data[model._name][id] for id in criteria['id']['$in'] if id in self._data[model._name]])        
+            positions = self._positions[model._name]
+            candidates = sorted((model_data[id] for id in candidate_ids if id in model_data),
+                                key=lambda record: positions[record['id']])
+
+        records = []
+        for record in candidates:
+            if match_criteria(record, criteria):
+                records.append(record)
+                if limit and len(records) >= limit:
+                    break
+        return records
+
+    def aggregate(self, model, criteria={}, group_by=[], metrics={}, context={}):
+        """
+        Calculate aggregate values for the matching records
+        """
+        with self._lock:
+            return aggregate_records(self._find_records(model, criteria), group_by, metrics)
 
     def create_record_id(self, model, vals, context={}):
         """
         Generate a unique ID for the new record
         """
-        from uuid import uuid4
         return str(uuid4())
     
     def create(self, model, vals, context={}):
@@ -56,83 +123,102 @@ class DatabaseProvider(DBProvider):
         Creates a new record. Returns the id of the created record
         """
                         
-        if vals['id'] in self._data[model._name]:
-            raise ValidationError("The id '{}' already exists".format(vals['id']))
+        record = dict(vals)
+        if not record.get('id'):
+            record['id'] = self.create_record_id(model, vals, context)
         
-        # Do Create
-        self._data[model._name][vals['id']] = vals
+        with self._lock:
+            model_data = self._data[model._name]
+            if record['id'] in model_data:
+                raise ValidationError("The id '{}' already exists".format(record['id']))
         
-        return vals['id']        
+            indexes = self._indexes[model._name]
+            for index in indexes:
+                index.check_unique(record)
+
+            # Do Create
+            model_data[record['id']] = record
+            self._positions[model._name][record['id']] = next(self._sequence)
+            for index in indexes:
+                index.add(record)
+
+        return record['id']
 
     def update(self, model, criteria, vals, limit=0, context={}):
         """
         Updates existing records. Returns True if successful
-        #TODO: Implement 'limit'
         """
         
-        if isinstance(criteria['id'], str):
-            self._data[model._name][criteria['id']].update(vals)
-        else:
-            for id in criteria['id']['$in']:
-                self._data[model._name][id].update(vals)
+        with self._lock:
+            indexes = self._indexes[model._name]
+            records = self._find_records(model, criteria, limit)
+            new_records = []
+            for record in records:
+                if vals.get('id', record['id']) != record['id']:
+                    raise ValidationError("The id of an existing record cannot be changed")
+                new_record = dict(record)
+                new_record.update(vals)
+                new_records.append(new_record)
+            
+            # Index the new values of every record before changing any, so
+            # a duplicate unique value leaves all of them unchanged
+            for index in indexes:
+                for record in records:
+                    index.remove(record)
+            try:
+                for new_record in new_records:
+                    for index in indexes:
+                        index.check_unique(new_record)
+                        index.add(new_record)
+            except ValidationError:
+                for index in indexes:
+                    for new_record in new_records:
+                        index.remove(new_record)
+                    for record in records:
+                        index.add(record)
+                raise
+            
+            for record in records:
+                record.update(vals)
         
         return True
     
     def delete(self, model, criteria, limit=0, context={}):
         """
         Deletes existing records. Returns True if successful
-        #TODO: Implement 'limit'
         """
 
-        if 'id' not in criteria:
-            raise ValidationError("InMemoryModel records can only be deleted by 'id'")
-
-        if isinstance(criteria['id'], str):
-            del self._data[model._name][criteria['id']]
-        else:
-            for id in criteria['id']['$in']:
-                del self._data[model._name][id]
+        with self._lock:
+            model_data = self._data[model._name]
+            indexes = self._indexes[model._name]
+            for record in self._find_records(model, criteria, limit):
+                for index in indexes:
+                    index.remove(record)
+                del model_data[record['id']]
+                del self._positions[model._name][record['id']]
             
         return True
 
 
 class SessionRecordSet(ModelRecordSet):
     """
-    Encapsulates the results of a find() on an InMemoryRecordSet
+    Encapsulates the results of a find() on an in-memory model
     """
-    def __init__(self, model, records):
-        super().__init__(model)
+    def __init__(self, model, read_fields, records):
+        super().__init__(model, read_fields)
         self._records = records
         self._current_record_idx = 0
         
-    def __len__(self):
+    def count(self):
         return len(self._records)
 
     def __getitem__(self, key):
-        return SessionRecord(self._model, self._records[key])
+        return self._make_record(self._records[key])
     
-    def __iter__(self):
-        return self
-    
-    def __next__(self):
+    def _fetch_next(self):
         if self._current_record_idx < len(self._records):
-            item, \
-            self._current_record_idx = \
-                SessionRecord(self._model, self._records[self._current_record_idx]), \
-                self._current_record_idx + 1
-            return item
+            record = self._records[self._current_record_idx]
+            self._current_record_idx += 1
+            return record
         else:
             raise StopIteration()
-
-class SessionRecord(ModelRecord):
-    """
-    Encapsulates a single in-memory record, normally returned from an InMemoryRecordSet
-    """
-    def __init__(self, model, record):
-        super().__init__(model)
-        self._record = record
-        
-    def __getitem__(self, key):
-        if key not in self.fields.keys():
-            raise KeyError(key)
-        return self._record.get(key, None)
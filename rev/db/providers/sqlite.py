@@ -0,0 +1,515 @@
+
+import datetime
+import decimal
+import json
+import logging
+import re
+import sqlite3
+import threading
+import weakref
+from uuid import uuid4
+
+from rev.db import DBProvider, fields
+from rev.db.exceptions import ValidationError
+from rev.db.records import ModelRecordSet
+from rev.db.indexes import get_model_indexes
+from rev.db.criteria import CRITERIA_OPERATORS
+from rev.db.serialization import encode_json
+
+ORDER_BY_OPTIONS = {
+    'asc' : 'ASC',
+    'desc' : 'DESC',
+}
+
+AGGREGATE_FUNCTIONS = {
+    'sum' : 'SUM',
+    'avg' : 'AVG',
+    'min' : 'MIN',
+    'max' : 'MAX',
+}
+
+COMPARISON_OPERATORS = {
+    '$gt' : '>',
+    '$gte' : '>=',
+    '$lt' : '<',
+    '$lte' : '<=',
+}
+
+# SQLite Database Provider. Each model is stored in a table with an "id"
+# column plus a column per stored field. List values (MultiSelectionField,
+# JSONField and multi RecordLinkField values) are stored as JSON and are
+# searched using SQLite's JSON1 functions.
+#
+# Settings:
+#   'database' - path of the database file, or ':memory:'
+#   'batch_size' - number of rows fetched at a time (default 100)
+#   'statement_cache_size' - prepared statements cached per connection (default 256)
+#   'timeout' - seconds to wait for a lock held by another connection (default 5)
+
+class DatabaseProvider(DBProvider):
+
+    def __init__(self, db_config, name):
+        # Initialise database provider including recording settings from app.config
+        self.name = name
+        self.database = db_config['database']
+        self.batch_size = db_config.get('batch_size', 100)
+        self.statement_cache_size = db_config.get('statement_cache_size', 256)
+        self.timeout = db_config.get('timeout', 5)
+        self.async_workers = db_config.get('async_workers', self.async_workers)
+
+        self._uri = False
+        if self.database == ':memory:':
+            # Share one in-memory database between the per-thread connections
+            self.database = 'file:rev_{}_{}?mode=memory&cache=shared'.format(name, id(self))
+            self._uri = True
+
+        self._tables = {}  # Dictionary of ModelName => SQLiteTable
+        self._local = threading.local()
+        self._connections = set()
+        self._connections_lock = threading.RLock()
+
+        # Connect to Database
+        logging.info("Opening SQLite database '{}' ...".format(db_config['database']))
+        self._get_connection()
+        if self._uri:
+            # An in-memory database is dropped with its last connection, so
+            # keep one open until close() in case every thread using it exits
+            connection = sqlite3.connect(self.database, uri=True, check_same_thread=False)
+            self._connections.add(connection)
+
+    def _get_connection(self):
+        """
+        Returns the current thread's connection, opening it if needed.
+        Connections are reused for the life of the thread, and closed when
+        the thread exits
+        """
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            # check_same_thread is off only so that close() can close every
+            # thread's connection. Each connection is still used by one thread
+            connection = sqlite3.connect(self.database, timeout=self.timeout, uri=self._uri, check_same_thread=False,
+                                         isolation_level=None, cached_statements=self.statement_cache_size)
+            if not self._uri:
+                # Write-ahead logging lets readers continue while a write is in progress
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+            with self._connections_lock:
+                self._connections.add(connection)
+            # The thread's local data (and so the holder) is dropped when the
+            # thread exits. The finalizer does not refer to the provider, so
+            # it does not keep the provider alive
+            holder = self._local.holder = _ConnectionHolder(connection)
+            weakref.finalize(holder, _close_connection, connection, self._connections, self._connections_lock)
+        return holder.connection
+
+    def close(self):
+        """
+        Close all connections
+        """
+        # Dropping the thread local data closes the current thread's connection
+        self._local = threading.local()
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def _execute(self, sql, params=()):
+        return self._get_connection().execute(sql, params)
+
+    def init_model(self, model):
+        # Create table for specified model if it does not already exist
+
+        # _table_name is CamelCaseName converted to camel_case_name
+        model._table_name = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', model._name)
+        model._table_name = re.sub('([a-z0-9])([A-Z])', r'\1_\2', model._table_name).lower()
+
+        table = self._tables[model._name] = SQLiteTable(model)
+
+        columns = ['"id" TEXT PRIMARY KEY'] + ['"{}" {}'.format(col, table.column_types[col]) for col in table.columns]
+        self._execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(model._table_name, ', '.join(columns)))
+
+        existing_columns = set(row[1] for row in self._execute('PRAGMA table_info("{}")'.format(model._table_name)))
+        for col in table.columns:
+            if col not in existing_columns:
+                logging.info('Adding Column: %s.%s', model._table_name, col)
+                self._execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(model._table_name, col, table.column_types[col]))
+
+        for index_spec, unique in get_model_indexes(model):
+            missing = [field_name for field_name, direction in index_spec if field_name not in table.column_types]
+            if missing:
+                logging.warning("Cannot index '{}' on model '{}'. They are not stored fields.".format(', '.join(missing), model._name))
+                continue
+            index_name = '{}_{}_{}'.format('ux' if unique else 'ix', model._table_name,
+                                           '_'.join(field_name for field_name, direction in index_spec))
+            index_cols = ', '.join('"{}" {}'.format(field_name, ORDER_BY_OPTIONS[direction]) for field_name, direction in index_spec)
+            self._execute('CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+                            'UNIQUE ' if unique else '', index_name, model._table_name, index_cols))
+
+    def find(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
+        """
+        Search the database using the specified criteria, and return the matching data
+        """
+        table = self._tables[model._name]
+        params = []
+        where = table.get_where(criteria, params)
+
+        if count_only:
+            sql = 'SELECT COUNT(*) FROM "{}" WHERE {}'.format(model._table_name, where)
+            return self._execute(sql, params).fetchone()[0]
+
+        columns = table.get_read_columns(read_fields)
+        sql = 'SELECT {} FROM "{}" WHERE {}'.format(', '.join('"{}"'.format(col) for col in columns), model._table_name, where)
+        if order_by:
+            sql += ' ORDER BY ' + table.get_order_by(order_by)
+
+        batch_size = context.get('batch_size', self.batch_size)
+        return SQLiteRecordSet(model, read_fields, self, table, columns, sql, params, limit, offset, batch_size)
+
+    def create_record_id(self, model, vals, context={}):
+        """
+        Generate a unique ID for a new record
+        """
+        return str(uuid4())
+
+    def create(self, model, vals, context={}):
+        """
+        Creates a new record. Returns the id of the created record
+        """
+        table = self._tables[model._name]
+        record_id = vals.get('id') or self.create_record_id(model, vals, context)
+        columns = tuple(col for col in vals if col != 'id' and col in table.column_types)
+
+        sql = table.insert_sql.get(columns)
+        if sql is None:
+            sql = table.insert_sql[columns] = 'INSERT INTO "{}" ("id"{}) VALUES (?{})'.format(
+                    model._table_name, ''.join(', "{}"'.format(col) for col in columns), ', ?' * len(columns))
+
+        params = [record_id] + [table.to_db[col](vals[col]) for col in columns]
+        try:
+            self._execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise ValidationError("Could not create '{}' record: {}".format(model._name, e))
+        return record_id
+
+    def _get_limited_where(self, model, where, params, limit):
+        if limit:
+            params.append(limit)
+            return '"id" IN (SELECT "id" FROM "{}" WHERE {} LIMIT ?)'.format(model._table_name, where)
+        return where
+
+    def update(self, model, criteria, vals, limit=0, context={}):
+        """
+        Updates existing records. Returns True if successful
+        """
+        table = self._tables[model._name]
+        columns = [col for col in vals if col != 'id' and col in table.column_types]
+        if not columns:
+            return True
+
+        params = [table.to_db[col](vals[col]) for col in columns]
+        where = self._get_limited_where(model, table.get_where(criteria, params), params, limit)
+        sql = 'UPDATE "{}" SET {} WHERE {}'.format(model._table_name, ', '.join('"{}" = ?'.format(col) for col in columns), where)
+        try:
+            self._execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise ValidationError("Could not update '{}' records: {}".format(model._name, e))
+        return True
+
+    def delete(self, model, criteria, limit=0, context={}):
+        """
+        Deletes existing records. Returns True if successful
+        """
+        table = self._tables[model._name]
+        params = []
+        where = self._get_limited_where(model, table.get_where(criteria, params), params, limit)
+        self._execute('DELETE FROM "{}" WHERE {}'.format(model._table_name, where), params)
+        return True
+
+    def aggregate(self, model, criteria={}, group_by=[], metrics={}, context={}):
+        """
+        Calculate aggregate values with a GROUP BY query
+        """
+        table = self._tables[model._name]
+        for field_name in group_by:
+            table.get_column(field_name)
+
+        select = ['"{}"'.format(field_name) for field_name in group_by]
+        for metric_name, (func, field_name) in metrics.items():
+            if func == 'count':
+                select.append('COUNT(*)')
+            else:
+                select.append('{}("{}")'.format(AGGREGATE_FUNCTIONS[func], table.get_column(field_name)))
+
+        params = []
+        sql = 'SELECT {} FROM "{}" WHERE {}'.format(', '.join(select), model._table_name, table.get_where(criteria, params))
+        if group_by:
+            sql += ' GROUP BY ' + ', '.join('"{}"'.format(field_name) for field_name in group_by)
+
+        res = []
+        for row in self._execute(sql, params):
+            res_row = {}
+            for col_idx, field_name in enumerate(group_by):
+                res_row[field_name] = table.from_db[field_name](row[col_idx])
+            for col_idx, (metric_name, (func, field_name)) in enumerate(metrics.items(), len(group_by)):
+                value = row[col_idx]
+                if func in ('min', 'max'):
+                    value = table.from_db[field_name](value)
+                res_row[metric_name] = value
+            res.append(res_row)
+        return res
+
+    def bulk_write(self, model, operations, ordered=True, context={}):
+        """
+        Applies a list of write operations in a single transaction. See
+        DBProvider.bulk_write(). Operations that succeed are committed even
+        if others fail
+        """
+        connection = self._get_connection()
+        if connection.in_transaction:
+            return super().bulk_write(model, operations, ordered, context)
+        connection.execute('BEGIN')
+        try:
+            return super().bulk_write(model, operations, ordered, context)
+        finally:
+            connection.execute('COMMIT')
+
+class _ConnectionHolder():
+    # A thread's connection, stored in the provider's thread local data
+    def __init__(self, connection):
+        self.connection = connection
+
+def _close_connection(connection, connections, lock):
+    with lock:
+        connections.discard(connection)
+    connection.close()
+
+def _to_sql_value(value):
+    # Convert a value for comparison with a JSON list item
+    if isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        return str(value)
+    elif isinstance(value, (list, dict)):
+        return encode_json(value)
+    return value
+
+def _from_iso_datetime(value):
+    return datetime.datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def _from_iso_date(value):
+    return datetime.date.fromisoformat(value) if isinstance(value, str) else value
+
+def _from_bool(value):
+    return bool(value) if value is not None else None
+
+def _from_decimal(value):
+    return decimal.Decimal(value) if value is not None else None
+
+def _from_json(value):
+    return json.loads(value) if value is not None else None
+
+def _to_json(value):
+    return encode_json(value) if value is not None else None
+
+def _no_conversion(value):
+    return value
+
+class SQLiteTable():
+    """
+    Column names, types and value conversions for a model's table, and
+    translation of find() criteria to SQL
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.columns = []
+        self.column_types = {'id' : 'TEXT'}
+        self.to_db = {'id' : _no_conversion}
+        self.from_db = {'id' : _no_conversion}
+        self.list_fields = set()  # Fields stored as JSON lists
+        self.insert_sql = {}  # Dictionary of column tuple => INSERT statement
+
+        for field_name in sorted(model._fields):
+            fld = model._fields[field_name]
+            if not fld.stored or field_name == 'id':
+                continue
+            self.columns.append(field_name)
+            column_type, to_db, from_db = 'TEXT', _no_conversion, _no_conversion
+            if isinstance(fld, fields.IntegerField):
+                column_type = 'INTEGER'
+            elif isinstance(fld, fields.FloatField):
+                column_type = 'REAL'
+            elif isinstance(fld, fields.BooleanField):
+                column_type, to_db, from_db = 'INTEGER', _to_sql_value, _from_bool
+            elif isinstance(fld, fields.DecimalField):
+                to_db, from_db = _to_sql_value, _from_decimal
+            elif isinstance(fld, fields.DateTimeField):
+                to_db, from_db = _to_sql_value, _from_iso_datetime
+            elif isinstance(fld, fields.DateField):
+                to_db, from_db = _to_sql_value, _from_iso_date
+            elif isinstance(fld, (fields.MultiSelectionField, fields.JSONField)) or \
+                    (isinstance(fld, fields.RecordLinkField) and fld.multi):
+                to_db, from_db = _to_json, _from_json
+                self.list_fields.add(field_name)
+            self.column_types[field_name] = column_type
+            self.to_db[field_name] = to_db
+            self.from_db[field_name] = from_db
+
+    def get_column(self, field_name):
+        if field_name not in self.column_types:
+            raise ValidationError("Model '{}' has no stored field '{}'".format(self.model._name, field_name))
+        return field_name
+
+    def get_read_columns(self, read_fields):
+        if read_fields == '*':
+            return ['id'] + self.columns
+        return ['id'] + [field_name for field_name in read_fields if field_name != 'id' and field_name in self.column_types]
+
+    def get_order_by(self, order_by):
+        return ', '.join('"{}" {}'.format(self.get_column(ob[0]), ORDER_BY_OPTIONS[ob[1]]) for ob in order_by)
+
+    def get_where(self, criteria, params):
+        """
+        Returns criteria as an SQL condition, adding its parameters to 'params'
+        """
+        clauses = []
+        for key, val in criteria.items():
+            if key in ('$and', '$or', '$nor'):
+                sub_clauses = ['({})'.format(self.get_where(sub_criteria, params)) for sub_criteria in val]
+                if key == '$and':
+                    clauses.append(' AND '.join(sub_clauses) or '1')
+                elif key == '$or':
+                    clauses.append('({})'.format(' OR '.join(sub_clauses)) if sub_clauses else '0')
+                else:
+                    clauses.append('NOT ({})'.format(' OR '.join(sub_clauses)) if sub_clauses else '1')
+            elif isinstance(val, dict) and val and all(op[:1] == '$' for op in val):
+                for op, op_val in val.items():
+                    clauses.append(self._get_condition(key, op, op_val, params))
+            else:
+                clauses.append(self._get_condition(key, '$eq', val, params))
+        return ' AND '.join(clauses) if clauses else '1'
+
+    def _get_condition(self, field_name, op, value, params):
+        col = '"{}"'.format(self.get_column(field_name))
+
+        if op == '$exists':
+            return '{} IS {}NULL'.format(col, 'NOT ' if value else '')
+
+        if field_name in self.list_fields:
+            # Match against the whole list, or any item in it
+            if op in ('$eq', '$ne'):
+                condition = self._get_list_in_condition(col, [value], params)
+                return condition if op == '$eq' else 'NOT ({})'.format(condition)
+            elif op in ('$in', '$nin'):
+                condition = self._get_list_in_condition(col, value, params)
+                return condition if op == '$in' else 'NOT ({})'.format(condition)
+            elif op in COMPARISON_OPERATORS:
+                params.append(_to_sql_value(value))
+                return 'EXISTS (SELECT 1 FROM json_each({}) WHERE value {} ?)'.format(col, COMPARISON_OPERATORS[op])
+
+        else:
+            to_db = self.to_db[field_name]
+            if op == '$eq':
+                params.append(to_db(value))
+                return '{} IS ?'.format(col)
+            elif op == '$ne':
+                params.append(to_db(value))
+                return '{} IS NOT ?'.format(col)
+            elif op in ('$in', '$nin'):
+                values = [to_db(item) for item in value if item is not None]
+                params.extend(values)
+                conditions = []
+                if values:
+                    conditions.append('{} IN ({})'.format(col, ', '.join('?' * len(values))))
+                if None in value:
+                    conditions.append('{} IS NULL'.format(col))
+                condition = '({})'.format(' OR '.join(conditions)) if conditions else '0'
+                return condition if op == '$in' else 'NOT COALESCE({}, 0)'.format(condition)
+            elif op in COMPARISON_OPERATORS:
+                params.append(to_db(value))
+                return '{} {} ?'.format(col, COMPARISON_OPERATORS[op])
+
+        raise ValidationError("Unsupported criteria operator '{}'. Valid options are: {}".format(op, ', '.join(CRITERIA_OPERATORS)))
+
+    def _get_list_in_condition(self, col, values, params):
+        conditions = []
+        items = [_to_sql_value(item) for item in values if item is not None and not isinstance(item, list)]
+        if items:
+            params.extend(items)
+            conditions.append('EXISTS (SELECT 1 FROM json_each({}) WHERE value IN ({}))'.format(col, ', '.join('?' * len(items))))
+        for item in values:
+            if isinstance(item, list):
+                params.append(encode_json(item))
+                conditions.append('{} = ?'.format(col))
+        if None in values:
+            conditions.append('{} IS NULL'.format(col))
+        return '({})'.format(' OR '.join(conditions)) if conditions else '0'
+
+class SQLiteRecordSet(ModelRecordSet):
+    """
+    Encapsulates the results of a find() on a Model from SQLite
+
+    Rows are streamed from the cursor 'batch_size' at a time. The total is
+    only queried when count() or len() is called, and then only once.
+    """
+    def __init__(self, model, read_fields, provider, table, columns, sql, params, limit, offset, batch_size):
+        super().__init__(model, read_fields)
+        self.provider = provider
+        self.batch_size = batch_size
+        self._sql = sql
+        self._params = params
+        self._limit = limit
+        self._offset = offset
+        self._count = None
+        self._cursor = None
+        self._rows = []
+        self._row_idx = 0
+        self._columns = columns
+        self._converters = [(col_idx, col, table.from_db[col]) for col_idx, col in enumerate(columns)
+                                if table.from_db[col] is not _no_conversion]
+
+    def _get_sql(self, limit, offset):
+        if not limit and not offset:
+            return self._sql, self._params
+        return self._sql + ' LIMIT ? OFFSET ?', self._params + [limit or -1, offset or 0]
+
+    def _make_record_dict(self, row):
+        record = dict(zip(self._columns, row))
+        for col_idx, col, from_db in self._converters:
+            record[col] = from_db(row[col_idx])
+        return record
+
+    def count(self):
+        if self._count is None:
+            sql, params = self._get_sql(self._limit, self._offset)
+            self._count = self.provider._execute('SELECT COUNT(*) FROM ({})'.format(sql), params).fetchone()[0]
+        return self._count
+
+    def __getitem__(self, item):
+        if item < 0:
+            item += self.count()
+        if item < 0 or (self._limit and item >= self._limit):
+            raise IndexError(item)
+        sql, params = self._get_sql(1, self._offset + item)
+        row = self.provider._execute(sql, params).fetchone()
+        if row is None:
+            raise IndexError(item)
+        return self._make_record(self._make_record_dict(row))
+
+    def _fetch_next(self):
+        if self._row_idx >= len(self._rows):
+            if self._cursor is None:
+                self._cursor = self.provider._execute(*self._get_sql(self._limit, self._offset))
+            self._rows = self._cursor.fetchmany(self.batch_size)
+            self._row_idx = 0
+            if not self._rows:
+                raise StopIteration()
+        row = self._rows[self._row_idx]
+        self._row_idx += 1
+        return self._make_record_dict(row)
+
+    def iter_chunks(self, size):
+        self.batch_size = size
+        return super().iter_chunks(size)
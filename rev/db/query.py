@@ -0,0 +1,130 @@
+
+class Param():
+    """
+    A named parameter in the criteria passed to Model.prepare(). 'convert'
+    is an optional function applied to the value when it is bound
+    """
+    __slots__ = ('name', 'convert')
+
+    def __init__(self, name, convert=None):
+        self.name = name
+        self.convert = convert
+
+    def __repr__(self):
+        return 'Param({!r})'.format(self.name)
+
+def get_param_names(template):
+    """
+    Returns the set of Param names used in a criteria template
+    """
+    if isinstance(template, Param):
+        return {template.name}
+    names = set()
+    if isinstance(template, dict):
+        for val in template.values():
+            names.update(get_param_names(val))
+    elif isinstance(template, (list, tuple)):
+        for val in template:
+            names.update(get_param_names(val))
+    return names
+
+def compile_template(template):
+    """
+    Returns a function that takes a dictionary of parameter values and
+    returns a copy of 'template' with its Params replaced by their values.
+    Parts of the template without Params are shared between calls, not copied
+    """
+    if isinstance(template, Param):
+        name, convert = template.name, template.convert
+        if convert is None:
+            return lambda params: params[name]
+        return lambda params: convert(params[name])
+    if not get_param_names(template):
+        return lambda params: template
+    if isinstance(template, dict):
+        builders = [(key, compile_template(val)) for key, val in template.items()]
+        return lambda params: dict([(key, build(params)) for key, build in builders])
+    builders = [compile_template(val) for val in template]
+    if isinstance(template, tuple):
+        return lambda params: tuple([build(params) for build in builders])
+    return lambda params: [build(params) for build in builders]
+
+class PreparedQuery():
+    """
+    A find() or update() on a model that is run many times with different
+    parameter values. Create it with Model.prepare()
+
+    The criteria are normalised, and the read fields and sort order
+    converted for the database, once. Running the query only binds the
+    parameters. Queries on models with a query cache, and id lookups on
+    models using the identity map, are run through Model.find() so they
+    still use them.
+    """
+
+    def __init__(self, model, criteria, read_fields='*', order_by=None):
+        self.model = model
+        self.criteria = criteria
+        self.read_fields = read_fields if read_fields == '*' else list(read_fields)
+        self.order_by = [tuple(ob) for ob in order_by] if order_by else None
+        self.param_names = get_param_names(criteria)
+        self._bind = compile_template(criteria)
+
+        # Queries that need Model.find()'s caching are not run directly
+        self._direct = model._query_cache is None and not (model._use_identity_map and 'id' in criteria)
+        self._db_query = model._database.prepare_query(model, criteria, self.read_fields, self.order_by)
+
+        if model._index_advisor is not None:
+            model._index_advisor.check(model, criteria, self.order_by)
+
+    def bind(self, params):
+        """
+        Returns the criteria for the given parameter values
+        """
+        self._check_params(params)
+        return self._bind(params)
+
+    def _check_params(self, params):
+        if len(params) != len(self.param_names) or not self.param_names.issuperset(params):
+            missing = self.param_names - set(params)
+            if missing:
+                raise Exception("Missing query parameters: {}".format(', '.join(sorted(missing))))
+            raise Exception("Unknown query parameters: {}".format(', '.join(sorted(set(params) - self.param_names))))
+
+    def find(self, params={}, limit=0, offset=0, count_only=False, context={}, raw=False):
+        """
+        Run the query with the given parameter values. Returns the same
+        results as Model.find()
+        """
+        if not self._direct:
+            return self.model.find(self.bind(params), self.read_fields, self.order_by, limit, offset, count_only, context, raw=raw)
+
+        if self._db_query is not None:
+            # The prepared query binds the parameters itself
+            self._check_params(params)
+            res = self._db_query.find(params, limit, offset, count_only, context)
+        else:
+            res = self.model._database.find(self.model, self.bind(params), self.read_fields, self.order_by, limit, offset, count_only, context)
+        if raw and not count_only:
+            res.raw = raw
+        return res
+
+    def update(self, vals, params={}, limit=0, context={}):
+        """
+        Update the records matching the query's criteria. Returns True if successful
+        """
+        model = self.model
+        model.validate_field_values(vals)
+
+        unit_of_work = model._get_unit_of_work(limit)
+        if unit_of_work is not None:
+            unit_of_work.add(model, ('update', self.bind(params), vals))
+            return True
+
+        if self._db_query is not None:
+            self._check_params(params)
+            self._db_query.update(params, vals, limit, context)
+        else:
+            model._database.update(model, self.bind(params), vals, limit, context)
+        model._invalidate_caches('update')
+
+        return True
@@ -0,0 +1,56 @@
+
+import hashlib
+import json
+import time
+
+class QueryCache():
+    """
+    Caches the results of a model's find() calls in the application cache.
+    
+    Enable it by giving a model a _cache_queries property, e.g.:
+    
+        _cache_queries = {'ttl' : 60}
+    
+    Cache keys include a per-model generation number which is incremented
+    whenever the model's records are written to, so invalidating the cache
+    is a single operation and stale entries simply expire.
+    """
+    
+    def __init__(self, cache, model, ttl=60):
+        self.cache = cache
+        self.model = model
+        self.ttl = ttl
+        self._generation_key = 'rev_qc_gen:{}'.format(model._name)
+    
+    def _get_generation(self):
+        generation = self.cache.get(self._generation_key)
+        if generation is None:
+            # Seed from the clock so that a generation number lost from the
+            # cache does not restart at a value that was already used
+            generation = int(time.time() * 1000)
+            self.cache.set(self._generation_key, generation, timeout=0)
+        return generation
+    
+    def get_key(self, criteria, read_fields, order_by, limit, offset, count_only):
+        """
+        Returns the cache key for a find() call
+        """
+        if read_fields != '*':
+            read_fields = sorted(read_fields)
+        query = json.dumps([criteria, read_fields, order_by, limit, offset, count_only],
+                           sort_keys=True, default=repr)
+        return 'rev_qc:{}:{}:{}'.format(self.model._name, self._get_generation(),
+                                        hashlib.sha1(query.encode('utf-8')).hexdigest())
+    
+    def get(self, key):
+        return self.cache.get(key)
+    
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl)
+    
+    def invalidate(self):
+        """
+        Invalidate all cached results for the model
+        """
+        self._get_generation()
+        self.cache.inc(self._generation_key)
@@ -1,59 +1,375 @@
 
+import time
+from collections import deque, namedtuple
+
+from rev.db.related import get_related_records
+from rev.db.pagination import encode_token
+from rev.db.serialization import encode_json, iter_json_list
+from rev.db.columns import Column, get_use_numpy
+
 class ModelRecordSet():
     """
     Encapsulates the results of a find() on a Model
     DatabaseProviders must subclass this and return it from a find() call
+
+    Subclasses supply records via _fetch_next() and the total via count().
+    Iteration is single-pass and records are only fetched as they are needed.
+    
+    Fields that were not in read_fields are loaded on first access, for the
+    current block of up to 'lazy_batch_size' records in a single query.
+    
+    If 'raw' is set, records are returned as plain dictionaries (raw=True)
+    or as named tuples of the id and read_fields (raw='tuple') rather than
+    as ModelRecord objects. Fields that were not read are not loaded.
     """
+    lazy_batch_size = 100
+    
     def __init__(self, model, read_fields='*'):
         self.model = model
         self.read_fields = read_fields
+        self.raw = False
+        self._buffer = deque()
+        self._block = []  # Records fetched by the last read-ahead
+        self._deferred_fields = set()
+        self.related = {}  # Prefetched related records. FieldName => {id : related}
+        self.keyset_order = None  # Sort order when using keyset pagination
+        self._last_record = None
+        self._fetch_observer = None  # Called with the number of records and seconds taken to fetch each block
+    
+    @property
+    def read_fields(self):
+        return self._read_fields
+    
+    @read_fields.setter
+    def read_fields(self, read_fields):
+        # Work out which fields can be read once for the whole record set
+        self._read_fields = read_fields
+        self.field_names = get_field_names(self.model, read_fields)
+        self._tuple_type = None
+    
+    def _fetch_next(self):
+        raise Exception('ModelRecordSet object should implement _fetch_next()')
+    def count(self):
+        raise Exception('ModelRecordSet object should implement count()')
     def __len__(self):
-        raise Exception('ModelRecordSet object should implement __len__()')
+        return self.count()
+    def __bool__(self):
+        # Peek at the next record rather than counting the whole result
+        if not self._buffer:
+            self._read_ahead(1)
+        return bool(self._buffer)
     def __getitem__(self, item):
         raise Exception('ModelRecordSet object should implement __getitem__()')
     def __iter__(self):
-        raise Exception('ModelRecordSet object should implement __iter__()')
+        return self
     def __next__(self):
-        raise Exception('ModelRecordSet object should implement __next__()')
+        if not self._buffer:
+            self._read_ahead(self.lazy_batch_size if self._deferred_fields else 1)
+            if not self._buffer:
+                raise StopIteration()
+        self._last_record = self._buffer.popleft()
+        return self._make_record(self._last_record)
+
+    def _make_record(self, record):
+        """
+        Returns the object to return for a record dictionary
+        """
+        if not self.raw:
+            return ModelRecord(self.model, self._read_fields, record, self)
+        if self.raw == 'tuple':
+            if self._tuple_type is None:
+                field_names = sorted(self.field_names) if self._read_fields == '*' else self._read_fields
+                self._tuple_fields = ['id'] + [fld for fld in field_names if fld != 'id']
+                self._tuple_type = namedtuple(self.model._name + 'Record', self._tuple_fields, rename=True)
+            return self._tuple_type._make(map(record.get, self._tuple_fields))
+        return record
+
+    def get_next_token(self):
+        """
+        Returns the continuation token to pass as find(after=...) to get the
+        page following the last record read, or None if no records were read
+        """
+        if self.keyset_order is None:
+            raise Exception('get_next_token() requires a find() with the after parameter')
+        if self._last_record is None:
+            return None
+        return encode_token([self._last_record.get(fld) for fld, direction in self.keyset_order])
+
+    def _read_ahead(self, size):
+        """
+        Fetch up to 'size' records into the buffer, and load any deferred
+        fields for them
+        """
+        block = []
+        observer = self._fetch_observer
+        if observer is not None:
+            start = time.perf_counter()
+        try:
+            while len(block) < size:
+                block.append(self._fetch_next())
+        except StopIteration:
+            pass
+        if observer is not None:
+            observer(len(block), time.perf_counter() - start)
+        if block:
+            self._block = block
+            self._buffer.extend(block)
+            if self._deferred_fields:
+                self._load_fields(self._deferred_fields, block)
+
+    def _load_deferred_field(self, field, record):
+        """
+        Called by ModelRecord when a field that was not read is accessed.
+        Loads the field for the record and the rest of its block at once
+        """
+        self._deferred_fields.add(field)
+        # Read ahead so the following records are loaded by the same query
+        observer = self._fetch_observer
+        if observer is not None:
+            start = time.perf_counter()
+        fetched = 0
+        try:
+            while len(self._buffer) < self.lazy_batch_size:
+                next_record = self._fetch_next()
+                self._buffer.append(next_record)
+                self._block.append(next_record)
+                fetched += 1
+        except StopIteration:
+            pass
+        if observer is not None:
+            observer(fetched, time.perf_counter() - start)
+        records = [rec for rec in self._block if field not in rec]
+        if field not in record and not any(rec is record for rec in records):
+            records.append(record)
+        self._load_fields([field], records)
+
+    def _load_fields(self, fields, records):
+        """
+        Read additional fields for the given records with a single query
+        """
+        ids = [rec['id'] for rec in records if rec.get('id')]
+        if not ids:
+            return
+        loaded = {}
+        for rec in self.model._database.find(self.model, {'id' : {'$in' : ids}}, read_fields=list(fields)):
+            loaded[rec.record['id']] = rec.record
+        for rec in records:
+            loaded_rec = loaded.get(rec.get('id'), {})
+            for field in fields:
+                rec[field] = loaded_rec.get(field, None)
+
+    def iter_chunks(self, size):
+        """
+        Iterate over the remaining records in lists of at most 'size' records
+        """
+        chunk = []
+        for record in self:
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     def __repr__(self):
         return "{}('{}')".format(self.__class__.__name__, self.model)
 
     def to_list(self):
+        if self.raw:
+            return list(self)
         return [record.to_dict() for record in self]
 
+    def to_columns(self, fields=None, use_numpy=None):
+        """
+        Read the remaining records into one array per field, and return a
+        dictionary of field name => array. 'fields' defaults to 'id' and the
+        read_fields.
+        
+        IntegerField, FloatField and BooleanField values are returned in
+        typed arrays (int64, float64 and bool). Missing values are stored
+        as NaN, so integer columns with missing values are float64. NumPy
+        arrays are returned if NumPy is installed, unless use_numpy=False, in
+        which case Python arrays and lists are returned.
+        """
+        use_numpy = get_use_numpy(use_numpy)
+        if fields is None:
+            fields = ['id'] + sorted(fld for fld in self.field_names if fld != 'id')
+        columns = {}
+        newly_deferred = []
+        for fld in fields:
+            if fld != 'id' and fld not in self.model._fields:
+                raise Exception("Field '{}' does not exist in model '{}'".format(fld, self.model))
+            columns[fld] = Column(self.model._fields.get(fld))
+            if fld != 'id' and fld not in self.field_names and fld not in self._deferred_fields:
+                # Load fields that were not read with each block of records
+                self._deferred_fields.add(fld)
+                newly_deferred.append(fld)
+        
+        # Records that were already buffered (e.g. by a peek) were read
+        # before the fields were deferred
+        if newly_deferred and self._buffer:
+            self._load_fields(newly_deferred, list(self._buffer))
+        
+        # Fill the columns a block at a time, straight from the record dictionaries
+        while True:
+            if not self._buffer:
+                self._read_ahead(self.lazy_batch_size)
+                if not self._buffer:
+                    break
+            block, self._buffer = self._buffer, deque()
+            self._last_record = block[-1]
+            for fld, column in columns.items():
+                column.extend([record.get(fld) for record in block])
+        
+        return dict((fld, column.get_values(use_numpy)) for fld, column in columns.items())
+
+    def _to_json_value(self, record):
+        if not self.raw:
+            return record.to_dict()
+        if self.raw == 'tuple':
+            return record._asdict()
+        return record
+
+    def iter_json(self, chunk_size=100):
+        """
+        Encode the remaining records as a JSON list, reading and yielding
+        'chunk_size' records at a time. The generator can be returned as a
+        Flask response, so large results are not held in memory, e.g.:
+        
+            return Response(records.iter_json(), mimetype='application/json')
+        """
+        return iter_json_list([self._to_json_value(record) for record in chunk]
+                                for chunk in self.iter_chunks(chunk_size))
+
     def to_json(self):
-        return str(self.to_list())
+        return ''.join(self.iter_json())
+
+class ListRecordSet(ModelRecordSet):
+    """
+    A ModelRecordSet over a list of record dictionaries that have already
+    been retrieved, e.g. from a cache
+    """
+    def __init__(self, model, read_fields, records):
+        super().__init__(model, read_fields)
+        self._records = records
+        self._current_record_idx = 0
+
+    def count(self):
+        return len(self._records)
+
+    def __getitem__(self, item):
+        return self._make_record(self._records[item])
+
+    def _fetch_next(self):
+        if self._current_record_idx < len(self._records):
+            record = self._records[self._current_record_idx]
+            self._current_record_idx += 1
+            return record
+        else:
+            raise StopIteration()
+
+class AsyncRecordSet():
+    """
+    Wraps a ModelRecordSet for use with 'async for'. Records are fetched in
+    chunks via the provider's _run_async(), so the event loop is not blocked
+    while waiting for the database.
+    
+    Note that accessing fields that were not read will still load them
+    synchronously.
+    """
+    def __init__(self, recordset, provider, chunk_size=100):
+        self.recordset = recordset
+        self.provider = provider
+        self.chunk_size = chunk_size
+        self._chunk = deque()
+        self._exhausted = False
+
+    def __repr__(self):
+        return "{}('{}')".format(self.__class__.__name__, self.recordset.model)
+
+    def _next_chunk(self):
+        chunk = []
+        for record in self.recordset:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size:
+                break
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._chunk:
+            if not self._exhausted:
+                chunk = await self.provider._run_async(self._next_chunk)
+                self._exhausted = len(chunk) < self.chunk_size
+                self._chunk.extend(chunk)
+            if not self._chunk:
+                raise StopAsyncIteration()
+        return self._chunk.popleft()
+
+    async def count(self):
+        return await self.provider._run_async(self.recordset.count)
+
+    async def to_list(self):
+        if self.recordset.raw:
+            return [record async for record in self]
+        return [record.to_dict() async for record in self]
+
+def get_field_names(model, read_fields):
+    """
+    Returns the names of the fields that can be read from records read
+    with 'read_fields'
+    """
+    if read_fields == '*':
+        return model._fields.keys()
+    return frozenset(read_fields)
 
 class ModelRecord():
     """
     Encapsulates a single database record, normally returned from a ModelRecordSet
     """
-    def __init__(self, model, read_fields='*', record={}):
+    __slots__ = ('model', 'read_fields', 'record', 'recordset', '_field_names')
+    
+    def __init__(self, model, read_fields='*', record={}, recordset=None):
         self.model = model
         self.read_fields = read_fields
         self.record = record
+        self.recordset = recordset
+        if recordset is not None:
+            self._field_names = recordset.field_names
+        else:
+            self._field_names = get_field_names(model, read_fields)
         
     def __getitem__(self, item):
-        if self.read_fields == '*':
-            if item not in self.model._fields.keys():
-                raise Exception("Field '{}' does not exist in model '{}'".format(item, self.model))
+        if item in self._field_names:
             return self.record[item]
-        else:
-            if item not in self.read_fields:
-                #TODO: Implement additional automatic lookups for non-read fields
+        if self.read_fields == '*':
+            raise Exception("Field '{}' does not exist in model '{}'".format(item, self.model))
+        if item not in self.record:
+            if item not in self.model._fields or self.recordset is None:
                 raise Exception("Field '{}' was not read as part of your find() call.".format(item))
-            else:
-                return self.record[item]
+            # Load the field for this record and its neighbours
+            self.recordset._load_deferred_field(item, self.record)
+        return self.record[item]
 
     def __repr__(self):
         return "{}('{}')".format(self.__class__.__name__, self.model)
     
     def __contains__(self, item):
-        if self.read_fields == '*':
-            return (item in self.model._fields.keys())
-        else:
-            return (item in self.read_fields)
+        return (item in self._field_names)
+    
+    def related(self, field_name):
+        """
+        Returns the record linked by a RecordLinkField (or a list of records
+        if the field is 'multi'), or the list of records for a RecordListField
+        """
+        if self.recordset is not None and field_name in self.recordset.related:
+            return self.recordset.related[field_name].get(self.record['id'])
+        if field_name not in self.record and field_name in self.model._fields.keys() \
+                and self.model._fields[field_name].stored and self.read_fields != '*':
+            self[field_name]  # Load the link field if it was not read
+        return get_related_records(self.model, field_name, [self.record])[self.record['id']]
     
     def to_dict(self):
         res = {}
@@ -63,4 +379,4 @@ class ModelRecord():
         return res
     
     def to_json(self):
-        return str(self.to_dict())
+        return encode_json(self.to_dict())
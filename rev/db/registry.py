@@ -1,5 +1,6 @@
 
 from .exceptions import ModelNotFoundError
+from .unitofwork import UnitOfWork, get_unit_of_work
 
 class ModelRegistry():
     """
@@ -25,5 +26,15 @@ class ModelRegistry():
     def model_exists(self, model_name):
         return True if model_name in self._models else False
     
+    def unit_of_work(self):
+        """
+        Returns the active UnitOfWork, or a new one. Use as:
+        
+            with registry.unit_of_work():
+                ...
+        """
+        unit_of_work = get_unit_of_work()
+        return unit_of_work if unit_of_work is not None else UnitOfWork()
+    
     def validate(self):
         pass # TODO: Validate model registry, checking referential integrity, etc.
\ No newline at end of file
@@ -0,0 +1,52 @@
+
+from rev.db import fields
+from rev.db.exceptions import ValidationError
+
+def get_related_records(model, field_name, records):
+    """
+    Resolves a RecordLinkField or RecordListField for a list of record
+    dictionaries, using a single query on the related model.
+    
+    Returns a dictionary of record id => related record(s). For a
+    RecordLinkField this is the linked ModelRecord (or None), or a list of
+    them if the field is 'multi'. For a RecordListField it is the list of
+    related records whose 'filter' field links back to the record.
+    """
+    field = model._fields.get(field_name)
+    res = {}
+    
+    if isinstance(field, fields.RecordLinkField):
+        related_model = model._registry.get(field.related_model)
+        link_ids = set()
+        for rec in records:
+            link = rec.get(field_name)
+            if field.multi:
+                link_ids.update(link or [])
+            elif link:
+                link_ids.add(link)
+        linked = {}
+        if link_ids:
+            for related_rec in related_model.find({'id' : {'$in' : list(link_ids)}}):
+                linked[related_rec.record['id']] = related_rec
+        for rec in records:
+            link = rec.get(field_name)
+            if field.multi:
+                res[rec['id']] = [linked[link_id] for link_id in (link or []) if link_id in linked]
+            else:
+                res[rec['id']] = linked.get(link)
+    
+    elif isinstance(field, fields.RecordListField):
+        related_model = model._registry.get(field.related_model)
+        for rec in records:
+            res[rec['id']] = []
+        if res:
+            for related_rec in related_model.find({field.filter : {'$in' : list(res.keys())}}):
+                link = related_rec[field.filter]
+                for link_id in (link if isinstance(link, list) else [link]):
+                    if link_id in res:
+                        res[link_id].append(related_rec)
+    
+    else:
+        raise ValidationError("Field '{}' of model '{}' is not a RecordLinkField or RecordListField".format(field_name, model._name))
+    
+    return res
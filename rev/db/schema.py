@@ -0,0 +1,82 @@
+
+from rev.db import fields
+from rev.db.exceptions import ValidationError
+
+_schemas = {}  # Dictionary of Model class => ModelSchema
+
+_REQUIRED = object()  # Check that uses the default Field.validate_value()
+
+def get_model_schema(model_class):
+    """
+    Returns the ModelSchema for a Model class, creating it on first use
+    """
+    schema = _schemas.get(model_class)
+    if schema is None:
+        schema = _schemas[model_class] = ModelSchema(model_class)
+    return schema
+
+class ModelSchema():
+    """
+    The fields of a Model class, and the lookup tables used to apply
+    defaults and validate values, worked out once per class
+    """
+
+    def __init__(self, model_class):
+        self.fields = {}
+        for attr in dir(model_class):
+            value = getattr(model_class, attr)
+            if isinstance(value, fields.Field):
+                self.fields[attr] = value
+
+        self.field_names = frozenset(self.fields)
+        self.stored_fields = frozenset(name for name, fld in self.fields.items() if fld.stored)
+
+        # Fields using the default get_default_value() can be copied from a
+        # dictionary; others are called for each record
+        self.defaults = {}
+        self.default_fields = []
+        for name in sorted(self.stored_fields):
+            fld = self.fields[name]
+            if type(fld).get_default_value is fields.Field.get_default_value:
+                self.defaults[name] = fld.default_value
+            else:
+                self.default_fields.append((name, fld))
+
+        # Field name => None (no check), _REQUIRED or a validate_value() method
+        self.checks = {}
+        for name, fld in self.fields.items():
+            if type(fld).validate_value is not fields.Field.validate_value:
+                self.checks[name] = fld.validate_value
+            elif fld.required and name != 'id':
+                self.checks[name] = _REQUIRED
+            else:
+                self.checks[name] = None
+
+    def get_default_vals(self):
+        """
+        Returns a dictionary of default values for the stored fields
+        """
+        vals = dict(self.defaults)
+        for name, fld in self.default_fields:
+            vals[name] = fld.get_default_value()
+        return vals
+
+    def validate(self, model, vals):
+        """
+        Validate a dictionary of field values for 'model'. Raises a
+        ValidationError if there is a problem
+        """
+        if not self.field_names.issuperset(vals):
+            extra_fields = [name for name in vals if name not in self.field_names]
+            raise ValidationError("Object '{}' does not have the following fields: {}".format(model._name, ', '.join(extra_fields)))
+        
+        checks = self.checks
+        for name, value in vals.items():
+            check = checks[name]
+            if check is None:
+                continue
+            if check is _REQUIRED:
+                if not value:
+                    raise ValidationError("Field '{}' on object '{}' is required!".format(name, model._name))
+            else:
+                check(model, name, value)
@@ -0,0 +1,53 @@
+
+import base64
+import datetime
+import decimal
+import json
+from collections.abc import Mapping
+
+try:
+    from bson.objectid import ObjectId
+except ImportError:
+    ObjectId = None
+
+class RecordJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder for database values. ObjectIds are encoded as strings,
+    dates and times in ISO 8601 format, Decimals as strings (so they keep
+    their precision) and binary data as base64 strings
+    """
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+            return o.isoformat()
+        if isinstance(o, decimal.Decimal):
+            return str(o)
+        if ObjectId is not None and isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, Mapping):
+            return dict(o)
+        if isinstance(o, (set, frozenset)):
+            return list(o)
+        if isinstance(o, bytes):
+            return base64.b64encode(o).decode('ascii')
+        return super().default(o)
+
+_encoder = RecordJSONEncoder()
+
+def encode_json(value):
+    """
+    Returns 'value' encoded as a JSON string
+    """
+    return _encoder.encode(value)
+
+def iter_json_list(chunks):
+    """
+    Encode an iterable of lists of values (e.g. from iter_chunks()) as a
+    single JSON list, yielding one string per chunk
+    """
+    yield '['
+    separator = ''
+    for chunk in chunks:
+        if chunk:
+            yield separator + ','.join(_encoder.encode(item) for item in chunk)
+            separator = ','
+    yield ']'
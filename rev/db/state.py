@@ -0,0 +1,77 @@
+import contextvars
+import os
+import sys
+import threading
+
+from flask import g, has_request_context
+
+import rev
+
+REV_PATH = os.path.dirname(os.path.abspath(rev.__file__)) + os.sep
+
+_thread_state = threading.local()
+
+# Where the async operation run by the current thread was started
+_async_call_site = contextvars.ContextVar('rev_async_call_site', default=None)
+
+# The attributes of the request (or thread) state that are carried over to
+# the threads that run async database operations
+BOUND_ATTRIBUTES = ['_rev_unit_of_work', '_rev_identity_map', '_rev_db_profile']
+
+def get_state():
+    """
+    Returns the object that holds the database state of the current request,
+    i.e. flask.g, or of the current thread when used outside of a request
+    """
+    return g if has_request_context() else _thread_state
+
+def get_call_site():
+    """
+    Returns (filename, line number, function) of the innermost frame outside
+    of the rev package, i.e. the application code that made a call, or None.
+    For async operations, this is where the operation was started
+    """
+    call_site = _async_call_site.get()
+    if call_site is not None:
+        return call_site
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not os.path.abspath(filename).startswith(REV_PATH):
+            return (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+def bind_state(func):
+    """
+    Returns a function that calls func with the caller's unit of work,
+    identity map and database profile (and context variables), so it can be
+    run in another thread, e.g. by the async methods' thread pool
+    """
+    from rev.db.identitymap import get_identity_map
+    # Create the request's identity map before it is copied, as it cannot
+    # be created in a thread without a request context
+    get_identity_map()
+    state = get_state()
+    values = dict((attr, getattr(state, attr, None)) for attr in BOUND_ATTRIBUTES)
+    # The pool thread's stack does not include the calling code, so record
+    # where the operation was started for the database profiler
+    call_site = get_call_site() if values['_rev_db_profile'] is not None else None
+    context = contextvars.copy_context()
+
+    def run_with_state():
+        # Pool threads never have a request context, so use the thread state
+        previous = dict((attr, getattr(_thread_state, attr, None)) for attr in BOUND_ATTRIBUTES)
+        for attr, value in values.items():
+            setattr(_thread_state, attr, value)
+        try:
+            return context.run(_run_from_call_site, call_site, func)
+        finally:
+            for attr, value in previous.items():
+                setattr(_thread_state, attr, value)
+    return run_with_state
+
+def _run_from_call_site(call_site, func):
+    # Only changes the context copied by bind_state()
+    _async_call_site.set(call_site)
+    return func()
@@ -0,0 +1,113 @@
+
+from collections import OrderedDict
+
+from rev.db.exceptions import BulkWriteError
+from rev.db.state import get_state
+
+def get_unit_of_work():
+    """
+    Returns the active UnitOfWork of the current request, or of the current
+    thread when used outside of a request, or None
+    """
+    return getattr(get_state(), '_rev_unit_of_work', None)
+
+class UnitOfWork():
+    """
+    Queues Model creates, updates and deletes and writes them with one bulk
+    write per model when the unit of work is flushed. Use it via:
+    
+        with registry.unit_of_work():
+            ...
+    
+    The queued operations are flushed at the end of the 'with' block, or
+    discarded if an exception is raised. Nested 'with' blocks join the
+    active unit of work. Set DB_REQUEST_UNIT_OF_WORK to use one unit of
+    work for each HTTP request.
+    
+    Note that find() does not see queued writes until they are flushed.
+    """
+    
+    def __init__(self):
+        self._operations = []  # List of (model, bulk_write operation) tuples
+        self._depth = 0
+    
+    def __enter__(self):
+        if self._depth == 0:
+            get_state()._rev_unit_of_work = self
+        self._depth += 1
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth == 0:
+            get_state()._rev_unit_of_work = None
+            if exc_type is None:
+                self.flush()
+            else:
+                self.discard()
+        return False
+    
+    def __len__(self):
+        return len(self._operations)
+    
+    def add(self, model, operation):
+        """
+        Queue a DBProvider.bulk_write() operation for the model. An update is
+        merged into the model's previous queued operation if that was an
+        update with the same criteria
+        """
+        if operation[0] == 'update':
+            for prev_model, prev_operation in reversed(self._operations):
+                if prev_model is model:
+                    if prev_operation[0] == 'update' and prev_operation[1] == operation[1]:
+                        prev_operation[2].update(operation[2])
+                        return
+                    break
+            operation = ('update', operation[1], dict(operation[2]))
+        self._operations.append((model, operation))
+    
+    def discard(self):
+        self._operations = []
+    
+    def flush(self):
+        """
+        Write all queued operations. Operations for each model are sent as a
+        single ordered bulk write, with models written in the order that they
+        were first used.
+        
+        If any operations fail, a BulkWriteError is raised whose 'errors' are
+        (operation_index, message) tuples, indexed by the order in which the
+        operations were queued. Operations for models after the one that
+        failed are not written.
+        """
+        operations, self._operations = self._operations, []
+        
+        model_operations = OrderedDict()
+        for op_idx, (model, operation) in enumerate(operations):
+            model_operations.setdefault(model, []).append((op_idx, operation))
+        
+        for model, model_ops in model_operations.items():
+            try:
+                model._database.bulk_write(model, [operation for op_idx, operation in model_ops])
+            except BulkWriteError as e:
+                errors = [(model_ops[model_op_idx][0], "{}.{}: {}".format(model._name, model_ops[model_op_idx][1][0], message))
+                            for model_op_idx, message in e.errors]
+                raise BulkWriteError("{} operation(s) failed while flushing the unit of work".format(len(errors)), errors)
+            finally:
+                only_creates = all(operation[0] == 'create' for op_idx, operation in model_ops)
+                model._invalidate_caches('create' if only_creates else 'update')
+
+def begin_request_unit_of_work():
+    UnitOfWork().__enter__()
+
+def end_request_unit_of_work(response):
+    unit_of_work = get_unit_of_work()
+    if unit_of_work is not None:
+        unit_of_work.__exit__(None, None, None)
+    return response
+
+def discard_request_unit_of_work(exception=None):
+    # Only still active if the request ended with an exception
+    unit_of_work = get_unit_of_work()
+    if unit_of_work is not None:
+        unit_of_work.__exit__(Exception, exception, None)
@@ -33,9 +33,9 @@ class Module(Model):
     module_description = fields.TextField(_('Description'), required=False)
     module_version = fields.TextField(_('Module Version'))
     db_version = fields.TextField(_('Installed Version'))
-    status = fields.SelectionField(_('Status'), MODULE_STATUSES, default_value='not_installed')
+    status = fields.SelectionField(_('Status'), MODULE_STATUSES, default_value='not_installed', index=True)
     module_data_hash = fields.TextField(_('Module Data Checksum'), required=False)
-    depends = fields.MultiSelectionField(_('Dependancies'), None, required=False)
+    depends = fields.MultiSelectionField(_('Dependancies'), None, required=False, index=True)
     
     _unique = ['name']
         
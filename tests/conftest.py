@@ -0,0 +1,32 @@
+import pytest
+from flask import Flask
+
+
+class Registry():
+    """
+    The parts of ModelRegistry that Model needs, for models created outside
+    of a RevApp
+    """
+    def __init__(self, app):
+        self.app = app
+        self.models = {}
+
+    def get(self, name):
+        return self.models[name]
+
+    def set(self, name, model):
+        self.models[name] = model
+
+
+@pytest.fixture
+def make_registry():
+    """
+    Returns a function that creates a Registry for an app using the given
+    database provider and config
+    """
+    def make(provider, config={}):
+        app = Flask('tests')
+        app.config.update(config)
+        app.databases = {'default' : provider}
+        return Registry(app)
+    return make
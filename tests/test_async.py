@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+from flask import g
+
+from rev.db import Model, fields
+from rev.db.providers.logstore import DatabaseProvider
+from rev.db.unitofwork import UnitOfWork
+
+
+class AsyncItem(Model):
+    _description = 'Async Item'
+    code = fields.TextField('Code')
+
+
+@pytest.fixture
+def provider(tmpdir):
+    provider = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    yield provider
+    provider.shutdown_executor()
+    provider.close()
+
+
+def test_acreate_joins_the_callers_unit_of_work(provider, make_registry):
+    items = AsyncItem(make_registry(provider))
+    with UnitOfWork() as unit_of_work:
+        record_id = asyncio.run(items.acreate({'code' : 'a'}))
+        assert len(unit_of_work) == 1
+        assert items.find({}, count_only=True) == 0
+    assert [rec.record['id'] for rec in items.find({})] == [record_id]
+
+
+def test_afind_uses_the_requests_identity_map(provider, make_registry):
+    registry = make_registry(provider, {'DB_IDENTITY_MAP' : True})
+    items = AsyncItem(registry)
+    record_id = items.create({'code' : 'a'})
+    with registry.app.test_request_context('/'):
+        recs = asyncio.run(items.afind({'id' : record_id}))
+        assert [rec['code'] for rec in asyncio.run(recs.to_list())] == ['a']
+        assert g._rev_identity_map.get(items, record_id, '*') is not None
+
+
+def test_shutdown_executor_allows_restart(provider, make_registry):
+    items = AsyncItem(make_registry(provider))
+    asyncio.run(items.acreate({'code' : 'a'}))
+    provider.shutdown_executor()
+    asyncio.run(items.acreate({'code' : 'b'}))
+    assert items.find({}, count_only=True) == 2
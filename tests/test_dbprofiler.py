@@ -0,0 +1,120 @@
+import asyncio
+import re
+import time
+
+import pytest
+from flask import Flask
+
+from rev.app.dbprofiler import DBProfiler, RequestProfile
+from rev.app.instrumentation import InstrumentedProvider
+from rev.db import Model, fields
+from rev.db.providers.logstore import DatabaseProvider
+from rev.db.records import ListRecordSet
+
+
+class SlowCursorRecordSet(ListRecordSet):
+    """
+    Like a database cursor, only runs the query when records are first read
+    """
+    def _fetch_next(self):
+        if self._current_record_idx == 0:
+            time.sleep(0.05)
+        return super()._fetch_next()
+
+
+class LazyProvider():
+    name = 'default'
+
+    def find(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
+        if count_only:
+            return 1
+        return SlowCursorRecordSet(model, read_fields, [{'id' : '1', 'name' : 'one'}])
+
+
+class Thing():
+    _name = 'Thing'
+    _fields = {}
+
+
+@pytest.fixture
+def app():
+    app = Flask('tests')
+    app.db_profiler = DBProfiler(app)
+    app.db_profiler.register(app)
+    app.provider = InstrumentedProvider(LazyProvider(), [app.db_profiler])
+    return app
+
+
+def test_find_time_includes_reading_records(app):
+    @app.route('/one')
+    def one():
+        res = app.provider.find(Thing(), {'id' : '1'})
+        res.raw = True
+        return ','.join(rec['name'] for rec in res)
+
+    response = app.test_client().get('/one')
+    assert response.get_data(as_text=True) == 'one'
+    operation = app.db_profiler.get_profiles()[0].operations[0]
+    assert operation['rows'] == 1
+    assert operation['duration_ms'] >= 50
+    assert response.headers['X-Rev-DB'].startswith('1 queries / ')
+    assert int(response.headers['X-Rev-DB'].split('/ ')[1][:-2]) >= 50
+
+
+class ProfiledItem(Model):
+    _description = 'Profiled Item'
+    code = fields.TextField('Code')
+
+
+def test_async_queries_are_profiled(app, tmpdir, make_registry):
+    provider = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    items = ProfiledItem(make_registry(InstrumentedProvider(provider, [app.db_profiler])))
+    items.create({'code' : 'a'})
+
+    @app.route('/items')
+    def list_items():
+        async def read_items():
+            recs = await items.afind({'code' : 'a'}, read_fields=['code'])
+            return await recs.to_list()
+        return ','.join(rec['code'] for rec in asyncio.run(read_items()))
+
+    try:
+        response = app.test_client().get('/items')
+    finally:
+        provider.shutdown_executor()
+        provider.close()
+    assert response.get_data(as_text=True) == 'a'
+    assert response.headers['X-Rev-DB'].startswith('1 queries / ')
+    operation = app.db_profiler.get_profiles()[0].operations[0]
+    assert operation['operation'] == 'find'
+    assert operation['rows'] == 1
+    assert 'read_items' in operation['call_site']
+
+
+def test_repeated_queries_are_flagged(app):
+    @app.route('/loop')
+    def loop():
+        for record_id in ['1', '2', '3']:
+            app.provider.find(Thing(), {'id' : record_id}, count_only=True)
+        app.provider.find(Thing(), {'name' : 'one'}, count_only=True)
+        return 'ok'
+
+    response = app.test_client().get('/loop')
+    assert re.match(r'^4 queries / \d+ms, 1 N\+1 patterns$', response.headers['X-Rev-DB'])
+    pattern, = app.db_profiler.get_profiles()[0].n_plus_one
+    assert pattern['count'] == 3
+    assert pattern['model'] == 'Thing'
+    assert pattern['criteria'] == {'id' : '?'}
+    assert 'loop' in pattern['call_site']
+
+
+def test_n_plus_one_threshold():
+    profile = RequestProfile('1', 'GET', '/')
+    for call_site in [('app.py', 10, 'view'), ('app.py', 10, 'view'), ('app.py', 12, 'view')]:
+        profile.add_operation(LazyProvider(), Thing(), 'find', {'id' : '1'}, 0.001, None, call_site)
+    profile.finish(200, 3)
+    assert profile.n_plus_one == []
+    assert profile.get_summary() == '3 queries / 3ms'
+    profile.finish(200, 2)
+    assert [pattern['count'] for pattern in profile.n_plus_one] == [2]
+    assert profile.n_plus_one[0]['call_site'] == 'app.py:10 (view)'
@@ -0,0 +1,39 @@
+import pytest
+
+from rev.db import Model, fields
+from rev.db.identitymap import get_identity_map
+from rev.db.providers.logstore import DatabaseProvider
+from rev.db.unitofwork import UnitOfWork
+
+
+class MappedItem(Model):
+    _description = 'Mapped Item'
+    code = fields.TextField('Code')
+
+
+@pytest.fixture
+def registry(tmpdir, make_registry):
+    provider = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    yield make_registry(provider, {'DB_IDENTITY_MAP' : True})
+    provider.close()
+
+
+def test_create_invalidates_missing_records(registry):
+    items = MappedItem(registry)
+    with registry.app.test_request_context('/'):
+        with UnitOfWork():
+            record_id = items.create({'code' : 'a'})
+            # Queued creates are not found until they are flushed
+            assert not items.find({'id' : record_id})
+        assert [rec['code'] for rec in items.find({'id' : record_id})] == ['a']
+
+
+def test_raw_results_are_copies(registry):
+    items = MappedItem(registry)
+    record_id = items.create({'code' : 'a'})
+    with registry.app.test_request_context('/'):
+        for attempt in range(2):
+            rec = next(items.find({'id' : record_id}, raw=True))
+            assert rec['code'] == 'a'
+            rec['code'] = 'changed'
+        assert get_identity_map().hits == 1
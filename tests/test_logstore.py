@@ -0,0 +1,110 @@
+import pytest
+
+from rev.db import Model, fields
+from rev.db.exceptions import ValidationError
+from rev.db.providers.logstore import DatabaseProvider
+
+
+class LogItem(Model):
+    _description = 'Log Item'
+    _unique = ['code']
+    code = fields.TextField('Code')
+    qty = fields.IntegerField('Quantity', required=False)
+
+
+@pytest.fixture
+def provider(tmpdir):
+    provider = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    yield provider
+    provider.close()
+
+
+@pytest.fixture
+def items(provider, make_registry):
+    items = LogItem(make_registry(provider))
+    for idx in range(3):
+        items.create({'code' : 'c{}'.format(idx), 'qty' : idx})
+    return items
+
+
+def test_getitem_after_bool_returns_first_record(items):
+    recs = items.find({}, read_fields=['code'])
+    assert recs
+    assert recs[0]['code'] == 'c0'
+    assert [rec['code'] for rec in recs] == ['c0', 'c1', 'c2']
+
+
+def test_getitem_after_partial_iteration(items):
+    recs = items.find({})
+    assert next(recs)['code'] == 'c0'
+    assert recs
+    assert recs[0]['code'] == 'c0'
+    assert recs[1]['code'] == 'c1'
+    assert [rec['code'] for rec in recs] == ['c1', 'c2']
+    recs = items.find({}, order_by=[('code', 'asc')])
+    assert next(recs)['code'] == 'c0'
+    assert recs[0]['code'] == 'c0'
+
+
+def test_records_survive_reopen(provider, items, tmpdir, make_registry):
+    items.update({'code' : 'c1'}, {'qty' : 10})
+    items.delete({'code' : 'c2'})
+    provider.close()
+
+    reopened = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    try:
+        items = LogItem(make_registry(reopened))
+        assert [(rec['code'], rec['qty']) for rec in items.find({}, order_by=[('code', 'asc')])] == \
+            [('c0', 0), ('c1', 10)]
+    finally:
+        reopened.close()
+
+
+def test_crash_after_compaction_swap_rebuilds_index(provider, tmpdir, make_registry, monkeypatch):
+    items = LogItem(make_registry(provider))
+    items.create({'code' : 'c0', 'qty' : 0})
+    # An early checkpoint, whose size fits inside the compacted file
+    provider._segments['LogItem'].write_checkpoint()
+    items.create({'code' : 'c1', 'qty' : 1})
+    for qty in range(50):
+        items.update({'code' : 'c0'}, {'qty' : qty})
+
+    # Simulate a crash between swapping in the compacted file and writing
+    # its checkpoint
+    from rev.db.providers import logstore
+    monkeypatch.setattr(logstore.Segment, 'write_checkpoint', lambda self: None)
+    provider.compact('LogItem')
+    monkeypatch.undo()
+    provider._segments = {}
+
+    reopened = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    try:
+        items = LogItem(make_registry(reopened))
+        assert [(rec['code'], rec['qty']) for rec in items.find({}, order_by=[('code', 'asc')])] == \
+            [('c0', 49), ('c1', 1)]
+    finally:
+        reopened.close()
+
+
+def test_to_columns_loads_fields_for_buffered_records(items):
+    recs = items.find({}, read_fields=['code'])
+    assert recs
+    columns = recs.to_columns(['code', 'qty'], use_numpy=False)
+    assert list(columns['code']) == ['c0', 'c1', 'c2']
+    assert list(columns['qty']) == [0, 1, 2]
+
+
+def test_sorted_find_with_read_fields(items):
+    recs = items.find({}, read_fields=['code'], order_by=[('qty', 'desc')])
+    assert len(recs) == 3
+    assert recs[0]['code'] == 'c2'
+    assert [rec['code'] for rec in recs] == ['c2', 'c1', 'c0']
+
+
+def test_update_is_not_applied_when_a_record_fails(items):
+    with pytest.raises(ValidationError):
+        items.update({}, {'code' : 'dup'})
+    assert sorted(rec['code'] for rec in items.find({})) == ['c0', 'c1', 'c2']
+    assert not items.find({'code' : 'dup'})
+    items.update({'code' : 'c1'}, {'code' : 'c3'})
+    assert [rec['qty'] for rec in items.find({'code' : 'c3'})] == [1]
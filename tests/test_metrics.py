@@ -0,0 +1,95 @@
+import gc
+import time
+
+from rev.app.metrics import MetricsRegistry, DBMetrics
+from rev.app.instrumentation import InstrumentedProvider
+from rev.db import Model, fields
+from rev.db.providers.session import DatabaseProvider
+from rev.db.records import ListRecordSet
+
+
+class SlowCursorRecordSet(ListRecordSet):
+    """
+    Like a database cursor, only runs the query when records are first read
+    """
+    def _fetch_next(self):
+        if self._current_record_idx == 0:
+            time.sleep(0.05)
+        return super()._fetch_next()
+
+
+class LazyProvider():
+    name = 'default'
+
+    def find(self, model, criteria={}, read_fields='*', order_by=None, limit=0, offset=0, count_only=False, context={}):
+        if count_only:
+            return 2
+        return SlowCursorRecordSet(model, read_fields, [{'id' : '1'}, {'id' : '2'}])
+
+
+class Thing():
+    _name = 'Thing'
+    _fields = {}
+
+
+class MeteredItem(Model):
+    _description = 'Metered Item'
+    code = fields.TextField('Code')
+
+
+def get_provider():
+    metrics = MetricsRegistry()
+    return metrics, InstrumentedProvider(LazyProvider(), [DBMetrics(metrics)])
+
+
+def test_find_duration_includes_first_fetch():
+    metrics, provider = get_provider()
+    res = provider.find(Thing(), {})
+    res.raw = True
+    durations = metrics.metrics['rev_db_operation_duration_seconds']
+    assert durations.get_values() == {}
+    assert [rec['id'] for rec in res] == ['1', '2']
+
+    counts, total = durations.get_values()[('default', 'Thing', 'find')]
+    assert sum(counts) == 1
+    assert total >= 0.05
+    assert metrics.metrics['rev_db_records_read_total'].get_values() == {('default', 'Thing') : 2}
+    assert metrics.metrics['rev_db_fetch_seconds_total'].get_values()[('default', 'Thing')] >= 0.05
+
+
+def test_count_only_find_is_recorded_immediately():
+    metrics, provider = get_provider()
+    assert provider.find(Thing(), {}, count_only=True) == 2
+    counts, total = metrics.metrics['rev_db_operation_duration_seconds'].get_values()[('default', 'Thing', 'find')]
+    assert sum(counts) == 1
+
+
+def test_render_prometheus_histogram():
+    metrics = MetricsRegistry()
+    hist = metrics.histogram('op_seconds', 'Op time', ['op'], buckets=[0.1, 1])
+    hist.observe(0.05, ('find',))
+    hist.observe(5, ('find',))
+    assert metrics.render().splitlines() == [
+        '# HELP op_seconds Op time',
+        '# TYPE op_seconds histogram',
+        'op_seconds_bucket{op="find",le="0.1"} 1',
+        'op_seconds_bucket{op="find",le="1"} 1',
+        'op_seconds_bucket{op="find",le="+Inf"} 2',
+        'op_seconds_sum{op="find"} 5.05',
+        'op_seconds_count{op="find"} 2',
+    ]
+
+
+def test_finds_that_are_not_iterated_are_recorded(make_registry):
+    metrics = MetricsRegistry()
+    provider = InstrumentedProvider(DatabaseProvider({}, 'default'), [DBMetrics(metrics)])
+    items = MeteredItem(make_registry(provider))
+    items.create({'code' : 'a'})
+    res = items.find({})
+    assert len(res) == 1
+    res = items.find({})
+    assert res[0]['code'] == 'a'
+    del res
+    gc.collect()
+    counts, total = metrics.metrics['rev_db_operation_duration_seconds'].get_values()[('default', 'MeteredItem', 'find')]
+    assert sum(counts) == 2
@@ -0,0 +1,120 @@
+import pytest
+
+pymongo = pytest.importorskip('pymongo')
+
+from rev.db.providers import mongodb
+from rev.db.providers.mongodb import DatabaseProvider, MongoDBRecordSet
+
+
+class FakeCursor():
+    """
+    Behaves like a pymongo Cursor, which cannot be indexed once iteration
+    has started
+    """
+    def __init__(self, documents, skip=0):
+        self.documents = documents
+        self.skip = skip
+        self.position = skip
+        self.started = False
+
+    def batch_size(self, size):
+        pass
+
+    def clone(self):
+        # Copies the query options, not the iteration state
+        return FakeCursor(self.documents, self.skip)
+
+    def __next__(self):
+        self.started = True
+        if self.position >= len(self.documents):
+            raise StopIteration()
+        self.position += 1
+        return dict(self.documents[self.position - 1])
+
+    def __getitem__(self, index):
+        if self.started:
+            raise Exception('Cannot set cursor options after executing query')
+        if self.skip + index >= len(self.documents):
+            raise IndexError('no such item for Cursor instance')
+        return dict(self.documents[self.skip + index])
+
+
+class Thing():
+    _name = 'Thing'
+    _fields = {}
+
+
+@pytest.fixture
+def recs():
+    documents = [{'_id' : 'id{}'.format(idx)} for idx in range(3)]
+    res = MongoDBRecordSet(Thing(), '*', FakeCursor(documents))
+    res.raw = True
+    return res
+
+
+def test_getitem_after_bool(recs):
+    assert recs
+    assert recs[0]['id'] == 'id0'
+    assert recs[1]['id'] == 'id1'
+    assert [rec['id'] for rec in recs] == ['id0', 'id1', 'id2']
+
+
+def test_getitem_after_partial_iteration(recs):
+    assert next(recs)['id'] == 'id0'
+    assert recs
+    assert recs[0]['id'] == 'id0'
+    assert recs[1]['id'] == 'id1'
+    assert recs[2]['id'] == 'id2'
+    with pytest.raises(IndexError):
+        recs[3]
+    assert [rec['id'] for rec in recs] == ['id1', 'id2']
+
+
+class FakeClient():
+    """
+    Records the arguments pymongo.MongoClient is created with
+    """
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.collection = FakeCollection()
+
+    def __getitem__(self, name):
+        return {'things' : self.collection}
+
+
+class FakeCollection():
+
+    def __init__(self, read_preference=None):
+        self.read_preference = read_preference
+        self.aggregate_options = None
+
+    def with_options(self, read_preference):
+        self.copy = FakeCollection(read_preference)
+        return self.copy
+
+    def aggregate(self, pipeline, **kwargs):
+        self.aggregate_options = kwargs
+        return [{'_id' : None, 'total' : 1}]
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    monkeypatch.setattr(pymongo, 'MongoClient', FakeClient)
+    return DatabaseProvider({'database' : 'test', 'hosts' : ['db1:27017', 'db2:27017']}, 'default')
+
+
+def test_hosts_are_used_without_a_replica_set(provider):
+    assert provider._dbclient.args == (['db1:27017', 'db2:27017'],)
+
+
+def test_aggregate_read_preference(provider):
+    thing = Thing()
+    thing._table_name = 'things'
+    thing._read_preference = 'secondary'
+    assert provider.aggregate(thing, metrics={'total' : ('count', None)}) == [{'total' : 1}]
+    collection = provider._dbclient.collection
+    if mongodb.PYMONGO_3:
+        assert collection.copy.read_preference == pymongo.ReadPreference.SECONDARY
+        assert 'read_preference' not in collection.copy.aggregate_options
+    else:
+        assert collection.aggregate_options['read_preference'] == pymongo.ReadPreference.SECONDARY
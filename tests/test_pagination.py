@@ -0,0 +1,39 @@
+import pytest
+
+from rev.db import Model, fields
+from rev.db.providers.logstore import DatabaseProvider
+
+
+class RankedItem(Model):
+    _description = 'Ranked Item'
+    code = fields.TextField('Code')
+    rank = fields.IntegerField('Rank', required=False)
+
+
+@pytest.fixture
+def items(tmpdir, make_registry):
+    provider = DatabaseProvider({'path' : str(tmpdir), 'maintenance_interval' : 0}, 'default')
+    items = RankedItem(make_registry(provider))
+    for code, rank in [('a', 2), ('b', None), ('c', 1), ('d', None), ('e', 2)]:
+        items.create({'code' : code, 'rank' : rank})
+    yield items
+    provider.close()
+
+
+def read_pages(items, order_by):
+    codes = []
+    token = ''
+    while token is not None:
+        recs = items.find({}, read_fields=['code'], order_by=order_by, limit=1, after=token)
+        codes.extend(rec['code'] for rec in recs)
+        token = recs.get_next_token()
+    return codes
+
+
+@pytest.mark.parametrize('direction', ['asc', 'desc'])
+def test_pages_include_null_sort_keys(items, direction):
+    order_by = [('rank', direction)]
+    expected = [rec['code'] for rec in items.find({}, read_fields=['code'],
+                order_by=order_by + [('id', direction)])]
+    assert sorted(expected) == ['a', 'b', 'c', 'd', 'e']
+    assert read_pages(items, order_by) == expected
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from rev.app.profiler import SamplingProfiler
+from rev.cli.profile import load_requests
+
+
+def test_collapsed_format():
+    profiler = SamplingProfiler()
+    profiler.samples = {
+        ('main', 'outer (app.py:1)', 'inner (app.py:5)') : 3,
+        ('main', 'outer (app.py:1)') : 2,
+        ('main', 'semi;colon (app.py:9)') : 1,
+    }
+    assert profiler.get_collapsed() == (
+        'main;outer (app.py:1) 2\n'
+        'main;outer (app.py:1);inner (app.py:5) 3\n'
+        'main;semi:colon (app.py:9) 1\n'
+    )
+    assert SamplingProfiler().get_collapsed() == ''
+
+
+def test_sample_records_the_current_stack():
+    profiler = SamplingProfiler(thread_ids=[threading.get_ident()])
+    profiler.sample()
+    stack, = profiler.samples
+    assert stack[0] == threading.current_thread().name
+    assert stack[-1].startswith('sample (')
+    assert any(frame.startswith('test_sample_records_the_current_stack (') for frame in stack)
+    assert profiler.sample_count == 1
+
+
+def test_load_json_requests(tmpdir):
+    path = tmpdir.join('requests.json')
+    path.write('[{"method": "POST", "path": "/orders", "json": {"item": "abc"}}, {"path": "/"}]')
+    assert load_requests(str(path)) == [
+        {'method' : 'POST', 'path' : '/orders', 'json' : {'item' : 'abc'}},
+        {'path' : '/'},
+    ]
+
+
+def test_load_text_requests(tmpdir):
+    path = tmpdir.join('requests.txt')
+    path.write('# Comment\nGET /orders?page=2\n\n  post /orders  \n')
+    assert load_requests(str(path)) == [
+        {'method' : 'GET', 'path' : '/orders?page=2'},
+        {'method' : 'post', 'path' : '/orders'},
+    ]
+
+
+def test_load_requests_requires_paths(tmpdir):
+    path = tmpdir.join('requests.json')
+    path.write('[{"method": "GET"}]')
+    with pytest.raises(Exception):
+        load_requests(str(path))
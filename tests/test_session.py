@@ -0,0 +1,35 @@
+import pytest
+
+from rev.db import Model, fields
+from rev.db.exceptions import ValidationError
+from rev.db.providers.session import DatabaseProvider
+
+
+class SessionItem(Model):
+    _description = 'Session Item'
+    _unique = ['code']
+    code = fields.TextField('Code')
+    group = fields.TextField('Group')
+
+
+def test_update_is_not_applied_when_a_record_fails(make_registry):
+    items = SessionItem(make_registry(DatabaseProvider({}, 'default')))
+    items.create({'code' : 'a', 'group' : 'g'})
+    items.create({'code' : 'b', 'group' : 'g'})
+    with pytest.raises(ValidationError):
+        items.update({'group' : 'g'}, {'code' : 'c'})
+    assert sorted(rec['code'] for rec in items.find({})) == ['a', 'b']
+    assert [rec['code'] for rec in items.find({'code' : 'a'})] == ['a']
+    assert not items.find({'code' : 'c'})
+    items.update({'code' : 'a'}, {'code' : 'c'})
+    assert [rec['code'] for rec in items.find({'code' : 'c'})] == ['c']
+
+
+def test_upsert_many_validates_the_records_it_creates(make_registry):
+    items = SessionItem(make_registry(DatabaseProvider({}, 'default')))
+    items.create({'code' : 'a', 'group' : 'g'})
+    with pytest.raises(ValidationError):
+        items.upsert_many([{'code' : 'b'}])
+    assert not items.find({'code' : 'b'})
+    assert items.upsert_many([{'code' : 'a', 'group' : 'f'}, {'code' : 'b', 'group' : 'h'}])[0] is None
+    assert sorted(rec['group'] for rec in items.find({})) == ['f', 'h']
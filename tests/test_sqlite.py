@@ -0,0 +1,109 @@
+import gc
+import threading
+
+import pytest
+
+from rev.db import Model, fields
+from rev.db.exceptions import BulkWriteError
+from rev.db.providers.sqlite import DatabaseProvider
+
+
+class SQLiteItem(Model):
+    _description = 'SQLite Item'
+    _unique = ['code']
+    code = fields.TextField('Code')
+    group = fields.TextField('Group', required=False)
+    tags = fields.MultiSelectionField('Tags', [], required=False, default_value=[])
+    qty = fields.IntegerField('Quantity', required=False)
+
+
+@pytest.fixture
+def provider():
+    provider = DatabaseProvider({'database' : ':memory:'}, 'default')
+    yield provider
+    provider.close()
+
+
+@pytest.fixture
+def items(provider, make_registry):
+    items = SQLiteItem(make_registry(provider))
+    items.create({'code' : 'a', 'group' : 'x', 'tags' : ['red', 'blue'], 'qty' : 1})
+    items.create({'code' : 'b', 'group' : 'y', 'tags' : ['green'], 'qty' : 2})
+    items.create({'code' : 'c', 'qty' : 3})
+    return items
+
+
+def codes(recs):
+    return sorted(rec['code'] for rec in recs)
+
+
+def test_in_and_nin_with_none(items):
+    assert codes(items.find({'group' : {'$in' : ['x', None]}})) == ['a', 'c']
+    assert codes(items.find({'group' : {'$nin' : ['x', None]}})) == ['b']
+    assert codes(items.find({'group' : {'$nin' : ['x']}})) == ['b', 'c']
+    assert codes(items.find({'group' : {'$in' : []}})) == []
+    assert codes(items.find({'group' : {'$nin' : []}})) == ['a', 'b', 'c']
+
+
+def test_list_field_criteria(items):
+    assert codes(items.find({'tags' : 'red'})) == ['a']
+    assert codes(items.find({'tags' : ['green']})) == ['b']
+    assert codes(items.find({'tags' : {'$in' : ['blue', 'green']}})) == ['a', 'b']
+    assert codes(items.find({'tags' : {'$in' : [[], 'red']}})) == ['a', 'c']
+    assert codes(items.find({'tags' : {'$nin' : ['red', None]}})) == ['b', 'c']
+    assert codes(items.find({'tags' : {'$ne' : 'red'}})) == ['b', 'c']
+
+
+def test_or_criteria(items):
+    assert codes(items.find({'$or' : [{'code' : 'a'}, {'qty' : {'$gte' : 3}}]})) == ['a', 'c']
+    assert codes(items.find({'$or' : [{'group' : 'x'}], 'qty' : 2})) == []
+    assert codes(items.find({'$or' : []})) == []
+
+
+def test_update_and_delete_with_limit(items):
+    items.update({'qty' : {'$gte' : 1}}, {'group' : 'z'}, limit=2)
+    assert items.find({'group' : 'z'}, count_only=True) == 2
+    items.delete({'group' : 'z'}, limit=1)
+    assert items.find({'group' : 'z'}, count_only=True) == 1
+    assert items.find({}, count_only=True) == 2
+
+
+def test_bulk_write(provider, items):
+    res = provider.bulk_write(items, [
+        ('create', {'code' : 'd', 'qty' : 4}),
+        ('update', {'code' : 'a'}, {'qty' : 10}),
+        ('delete', {'code' : 'b'}),
+        ('upsert', {'code' : 'c'}, {'code' : 'c', 'qty' : 30}, {}),
+        ('upsert', {'code' : 'e'}, {'code' : 'e', 'qty' : 5}, {'group' : 'y'}),
+    ])
+    assert res[1:4] == [None, None, None]
+    assert res[0] is not None and res[4] is not None
+    assert dict((rec['code'], rec['qty']) for rec in items.find({})) == {'a' : 10, 'c' : 30, 'd' : 4, 'e' : 5}
+    assert not provider._get_connection().in_transaction
+
+
+def test_bulk_write_commits_the_operations_before_a_failure(provider, items):
+    with pytest.raises(BulkWriteError) as exc_info:
+        provider.bulk_write(items, [
+            ('create', {'code' : 'd'}),
+            ('create', {'code' : 'a'}),
+            ('create', {'code' : 'e'}),
+        ])
+    assert [idx for idx, message in exc_info.value.errors] == [1]
+    assert codes(items.find({})) == ['a', 'b', 'c', 'd']
+    assert not provider._get_connection().in_transaction
+
+
+def test_connections_are_closed_when_threads_exit(tmpdir, make_registry):
+    provider = DatabaseProvider({'database' : str(tmpdir.join('test.db'))}, 'default')
+    items = SQLiteItem(make_registry(provider))
+    threads = [threading.Thread(target=items.create, args=({'code' : str(idx)},)) for idx in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    gc.collect()
+    assert items.find({}, count_only=True) == 20
+    assert len(provider._connections) == 1
+    provider.close()
+    assert len(provider._connections) == 0